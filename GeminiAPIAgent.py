@@ -1,13 +1,16 @@
 # Import libraries
-import vertexai, googlemaps
-from vertexai.generative_models import GenerativeModel, Part
-import json, requests
+import json
 from uagents import Agent, Context, Bureau, Model
 
-from timezonefinder import TimezoneFinder
-from datetime import datetime
-import pytz
-import asyncio
+import httpx
+
+from http_client import places_nearby
+from places_cache import PlacesCache
+from prompt_cache import MusicPromptGenerator, PromptCache, context_key
+from prompt_retrieval import PromptIndex
+from rounds import RoundTracker
+from time_context import TimeContext, TimeContextResolver
+from weather_service import WeatherService
 
 
 class NearbyArea(Model):
@@ -16,7 +19,15 @@ class NearbyArea(Model):
     radius: float
 
 
+class AreaRequest(Model):
+    round_id: str
+    latitude: float
+    longitude: float
+    radius: float
+
+
 class Buildings(Model):
+    round_id: str
     buildings: dict
 
 
@@ -24,114 +35,110 @@ class Message(Model):
     msg: str
 
 
-sound_scape = Agent(name="SoundScape", seed="EnvironmentToMusic")
-nearby_buildings = Agent(name="NearbyBuildings", seed="WhatsNearby")
-weather_API = Agent(name="WeatherAPI", seed="WeatherWhiz")
-time_API = Agent(name="TimeAPI", seed="TimeWhiz")
+class ContextReply(Model):
+    round_id: str
+    msg: str
 
 
-def generate_response(project_id: str, location: str, query: str) -> str:
-    # Initialize Vertex AI
-    vertexai.init(project=project_id, location=location)
-    # Load the model
-    multimodal_model = GenerativeModel("gemini-1.0-pro-vision")
+class TimeReply(Model):
+    round_id: str
+    timezone: str
+    hour: int
+    minute: int
+    bucket: str
 
-    # Query the model
-    response = multimodal_model.generate_content(
-        [
-            # Add an example query
-            query
-        ]
-    )
-
-    return response
 
+sound_scape = Agent(name="SoundScape", seed="EnvironmentToMusic")
+nearby_buildings = Agent(name="NearbyBuildings", seed="WhatsNearby")
+weather_API = Agent(name="WeatherAPI", seed="WeatherWhiz")
+time_API = Agent(name="TimeAPI", seed="TimeWhiz")
 
-@nearby_buildings.on_message(model=NearbyArea)
-async def get_nearby_buildings(ctx: Context, sender: str, msg: NearbyArea):
+# nearby-places searches by geohash cell, so listeners that stay in the same area do not hit Places every tick
+places_cache = PlacesCache(ttl=900.0)
+# weather per ~5 km grid cell, shared by all sessions in it and refreshed in the background before it expires
+weather_service = WeatherService(ttl=600.0)
+# loads the time zone polygons once, at import rather than on the event loop
+time_resolver = TimeContextResolver()
+# music prompts by place set, weather category and part of the day, kept across restarts; the Gemini client is built
+# once, for the Gemini Pro server in LA, California
+prompt_generator = MusicPromptGenerator(
+    PromptCache("cache/prompts.json"),
+    location="us-west1",
+    # the closest prompt of dataset.csv answers when Gemini is slow or down
+    retrieval=PromptIndex("dataset.csv"),
+)
+# correlates the replies of the buildings, weather and time agents with the round that asked for them
+rounds = RoundTracker()
+# how long a round waits for the upstream agents before going ahead with what it has
+ROUND_TIMEOUT = 8.0
+
+
+@nearby_buildings.on_message(model=AreaRequest)
+async def get_nearby_buildings(ctx: Context, sender: str, msg: AreaRequest):
     ctx.logger.info(f"Building received message")
     # Get stored values and message values
     GOOGLE_MAPS_KEY = ctx.storage.get("GOOGLE_MAPS_KEY")
-    latitude = msg.latitude
-    longitude = msg.longitude
-    radius = msg.radius
-
-    client = googlemaps.Client(key=GOOGLE_MAPS_KEY)
 
-    # Define search request
-    search_request = {
-        "location": (latitude, longitude),
-        "radius": radius,
-        # Keyword or category filtering can be added here (optional)
-        "type": "point_of_interest",  # Example for category filter
-    }
-
-    # Send Nearby Search request
-    nearby_places = client.places_nearby(**search_request)
+    nearby_places = places_cache.get(msg.latitude, msg.longitude, msg.radius)
+    if nearby_places is None:
+        # Send Nearby Search request, over a wider area than asked so the next ticks can be answered from the cache
+        fetch_radius = places_cache.fetch_radius(msg.radius)
+        try:
+            response = await places_nearby(
+                GOOGLE_MAPS_KEY, msg.latitude, msg.longitude, fetch_radius
+            )
+            places_cache.put(msg.latitude, msg.longitude, fetch_radius, response)
+            nearby_places = response
+            if response.get("status") == "OK":
+                nearby_places = places_cache.within(
+                    response, msg.latitude, msg.longitude, msg.radius
+                )
+        except httpx.HTTPError as e:
+            print(f"Error: Nearby search request failed: {e}")
+            nearby_places = {"status": "REQUEST_FAILED"}
+    else:
+        ctx.logger.info(f"Nearby places served from cache: {places_cache.stats()}")
 
     # Process search results
     if not nearby_places["status"] == "OK":
         print("Error: Nearby search failed")
-        await ctx.send(sound_scape.address, None)
-
-    await ctx.send(sound_scape.address, Buildings(buildings=nearby_places))
+        await ctx.send(sound_scape.address, Buildings(round_id=msg.round_id, buildings={}))
+    else:
+        await ctx.send(sound_scape.address, Buildings(round_id=msg.round_id, buildings=nearby_places))
 
 
-@weather_API.on_message(model=NearbyArea)
-async def get_weather_description(ctx: Context, sender: str, msg: NearbyArea):
+@weather_API.on_message(model=AreaRequest)
+async def get_weather_description(ctx: Context, sender: str, msg: AreaRequest):
     ctx.logger.info(f"Weather received message")
     # Get stored values and message values
     OPEN_WEATHER_KEY = ctx.storage.get("OPEN_WEATHER_KEY")
-    latitude = msg.latitude
-    longitude = msg.longitude
 
-    # Build the API URL with your API key, coordinates, and units (metric)
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={OPEN_WEATHER_KEY}&units=metric"
-
-    # Make the API call using requests library
-    response = requests.get(url)
-
-    # Check for successful response (status code 200)
-    if response.status_code == 200:
-        # Parse the JSON response
-        weather_data = response.json()
-
-        # Extract relevant weather information
-        description = weather_data["weather"][0]["description"]
-
-        await ctx.send(sound_scape.address, Message(msg=description))
-    else:
+    try:
+        description = await weather_service.get(OPEN_WEATHER_KEY, msg.latitude, msg.longitude)
+    except (httpx.HTTPError, KeyError, IndexError) as e:
         # Handle error if API call fails
-        print(f"Error: API request failed with status code {response.status_code}")
-        await ctx.send(sound_scape.address, None)
+        print(f"Error: Weather request failed: {e}")
+        description = ""
+
+    await ctx.send(sound_scape.address, ContextReply(round_id=msg.round_id, msg=description))
 
 
-@time_API.on_message(model=NearbyArea)
-async def time_API_message_handler(ctx: Context, sender: str, msg: NearbyArea):
+@time_API.on_message(model=AreaRequest)
+async def get_time_of_day(ctx: Context, sender: str, msg: AreaRequest):
     ctx.logger.info(f"Time received message")
-    # Get stored values and message values
-    latitude = msg.latitude
-    longitude = msg.longitude
-
-    # Get timezone
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=latitude, lng=longitude)
-
-    # Get current time in the timezone
-    tz = pytz.timezone(timezone_str)
-    current_time = datetime.now(tz)
-    hour_min = str(current_time.hour) + ":"
-    mins = str(current_time.minute)
-    if current_time.minute < 10:
-        mins = "0" + str(current_time.minute)
-    hour_min += mins
-
-    if current_time.hour < 12:
-        hour_min += " AM"
-    else:
-        hour_min += " PM"
 
-    await ctx.send(sound_scape.address, Message(msg=hour_min))
+    time_context = time_resolver.resolve(msg.latitude, msg.longitude)
+
+    await ctx.send(
+        sound_scape.address,
+        TimeReply(
+            round_id=msg.round_id,
+            timezone=time_context.timezone,
+            hour=time_context.hour,
+            minute=time_context.minute,
+            bucket=time_context.bucket,
+        ),
+    )
 
 
 def read_variables_from_file(file_path):
@@ -181,10 +188,6 @@ async def sound_scape_startup(ctx: Context):
     GOOGLE_PROJECT_KEY = variables["PROJECTKEY"]
 
     ctx.storage.set("GOOGLE_PROJECT_KEY", GOOGLE_PROJECT_KEY)
-
-    ctx.storage.set("time_received", False)
-    ctx.storage.set("buildings_received", False)
-    ctx.storage.set("weather_received", False)
     ctx.logger.info(f"startup complete for soundscape")
 
 
@@ -199,124 +202,61 @@ async def generate_prompt(ctx: Context):
 
     radius = 20.0
 
-    # Location of Gemini Pro server in LA, California
-    location = "us-west1"
-
-    nearby_area = NearbyArea(latitude=latitude, longitude=longitude, radius=radius)
-
-    ctx.logger.info(f"Before calls")
-
-    await ctx.send(nearby_buildings.address, nearby_area)
+    round_id = rounds.open(["buildings", "weather", "time"])
+    area_request = AreaRequest(
+        round_id=round_id, latitude=latitude, longitude=longitude, radius=radius
+    )
 
-    ctx.logger.info(f"After first call")
+    await ctx.send(nearby_buildings.address, area_request)
 
-    await ctx.send(weather_API.address, nearby_area)
+    await ctx.send(weather_API.address, area_request)
 
-    await ctx.send(time_API.address, nearby_area)
+    await ctx.send(time_API.address, area_request)
 
-    ctx.logger.info(f"After all calls")
+    replies = await rounds.gather(round_id, timeout=ROUND_TIMEOUT)
 
-    while (
-        ctx.storage.get("time_received") != True
-        or ctx.storage.get("buildings_received") != True
-        or ctx.storage.get("weather_received") != True
-    ):
-        await asyncio.sleep(0.5)
-        # print(ctx.storage.get('time_received'), ctx.storage.get('buildings_received'), ctx.storage.get('weather_received'))
+    missing = {"buildings", "weather", "time"} - set(replies)
+    if missing:
+        # fall back to the values of the last round for the agents that did not answer in time
+        ctx.logger.warning(
+            f"Round {round_id} got no reply for {', '.join(sorted(missing))}, using the last known values"
+        )
 
-    ctx.storage.set("time_received", False)
-    ctx.storage.set("buildings_received", False)
-    ctx.storage.set("weather_received", False)
+    nearby_places = replies.get("buildings", ctx.storage.get("nearby_places"))
+    weather = replies.get("weather", ctx.storage.get("weather") or "")
+    time_context = replies.get("time")
+    if time_context is None and ctx.storage.get("timezone"):
+        # the local time moves on from the last known zone, so the fingerprint matches the last round's
+        time_context = TimeContext.at(ctx.storage.get("timezone"))
+    time_of_day = time_context.describe() if time_context is not None else ""
 
-    nearby_places = ctx.storage.get("nearby_places")
-    weather = ctx.storage.get("weather")
-    time_of_day = ctx.storage.get("time_of_day")
+    ctx.storage.set("nearby_places", nearby_places)
+    ctx.storage.set("weather", weather)
+    if time_context is not None:
+        ctx.storage.set("timezone", time_context.timezone)
 
     ctx.logger.info("time_of_day: " + time_of_day)
 
-    if nearby_places is not None:
-        with open("queries.txt", "w") as outfile:
-            buildings_found = False
-            try:
-                vicinity = nearby_places["results"][0]["vicinity"]
-                name = []
-                for i in range(0, 3):
-                    try:
-                        name[i] = nearby_places["results"][i]["name"]
-                        buildings_found = True
-                    except:
-                        ctx.logger.error(
-                            "Could not process the " + i + " place nearby."
-                        )
-            except:
-                ctx.logger.error(
-                    "No such buildings were found nearby, or a failure occurred during the prompt building process."
-                )
-
-            prompt = ""
-
-            if buildings_found:
-                if len(name) == 1:
-                    prompt = (
-                        "Suppose you are near the establishment/building "
-                        + name[0]
-                        + " in "
-                        + vicinity
-                        + "."
-                    )
-                elif len(name) == 2:
-                    prompt = (
-                        "Suppose you are near these two buildings in "
-                        + vicinity
-                        + ", closest being first and furthest away being last: "
-                        + name[0]
-                        + " and "
-                        + name[1]
-                        + "."
-                    )
-                else:
-                    prompt = (
-                        "Suppose you are near these three buildings in "
-                        + vicinity
-                        + ", closest being first and furthest away being last: "
-                        + name[0]
-                        + ", "
-                        + name[1]
-                        + ", "
-                        + name[2]
-                        + "."
-                    )
-
-                prompt += (
-                    " If you had to come up with a vibe of music for these buildings while taking into account the current time of day ("
-                    + time_of_day
-                    + ") and weather of the area ("
-                    + weather
-                    + "), what would that vibe be? Please consolidate the recommendations for the type of vibe into a list. At the end, can you combine those into a prompt for a music generation model and begin the prompt with a @ symbol so I know where it starts?"
-                )
-                outfile.write(prompt + "\n\n")
-            else:
-                prompt = (
-                    "If you had to come up with a vibe of music for the area around "
-                    + vicinity
-                    + " while taking into account the current time of day ("
-                    + time_of_day
-                    + ") and weather of the area ("
-                    + weather
-                    + "), what would that vibe be? Please consolidate the recommendations for the type of vibe into a list. At the end, can you combine those into a prompt for a music generation model and begin the prompt with a @ symbol so I know where it starts?"
-                )
+    fingerprint = context_key(nearby_places, weather, time_context)
+    if nearby_places is None or fingerprint == ctx.storage.get("fingerprint"):
+        # nothing that shapes the music changed, keep the current prompt and files
+        ctx.logger.info("Context unchanged, keeping the current music prompt")
+        return
 
-            response = generate_response(GOOGLE_PROJECT_KEY, location, prompt)
+    music_prompt, final = await prompt_generator.generate(
+        GOOGLE_PROJECT_KEY, nearby_places, weather, time_context
+    )
+    if music_prompt is None:
+        ctx.logger.error("Failed to get a music prompt")
+        return
 
-            parts = response.text.split("@")
+    if final:
+        ctx.storage.set("fingerprint", fingerprint)
+    # else a dataset prompt stands in for Gemini, the next tick asks again and picks up its late answer from the cache
+    ctx.logger.info(f"Prompt cache: {prompt_generator.cache.stats()}")
 
-            # Check if there is a "@" symbol and return the second part if it exists
-            if len(parts) > 1:
-                music_prompt = parts[1]
-                with open("music_prompt.txt", "w") as outfile:
-                    outfile.write(music_prompt)
-            else:
-                ctx.logger.error("Failed to get a music prompt")
+    with open("music_prompt.txt", "w") as outfile:
+        outfile.write(music_prompt)
 
     with open("buildings.json", "w") as outfile:
         # Use json.dump to write the dictionary to the file
@@ -325,19 +265,23 @@ async def generate_prompt(ctx: Context):
 
 @sound_scape.on_message(model=Buildings)
 async def building_handler(ctx: Context, sender: str, msg: Buildings):
-    # print(msg.buildings)
-    ctx.storage.set("nearby_places", msg.buildings)
-    ctx.storage.set("buildings_received", True)
-
-
-@sound_scape.on_message(model=Message)
-async def message_handler(ctx: Context, sender: str, msg: Message):
-    if sender == weather_API.address:
-        ctx.storage.set("weather", msg.msg)
-        ctx.storage.set("weather_received", True)
-    elif sender == time_API.address:
-        ctx.storage.set("time_of_day", msg.msg)
-        ctx.storage.set("time_received", True)
+    if not rounds.resolve(msg.round_id, "buildings", msg.buildings):
+        ctx.logger.info(f"Ignoring buildings for finished round {msg.round_id}")
+
+
+@sound_scape.on_message(model=ContextReply)
+async def context_handler(ctx: Context, sender: str, msg: ContextReply):
+    if sender != weather_API.address:
+        return
+    if not rounds.resolve(msg.round_id, "weather", msg.msg):
+        ctx.logger.info(f"Ignoring weather for finished round {msg.round_id}")
+
+
+@sound_scape.on_message(model=TimeReply)
+async def time_handler(ctx: Context, sender: str, msg: TimeReply):
+    time_context = TimeContext(msg.timezone, msg.hour, msg.minute, msg.bucket)
+    if not rounds.resolve(msg.round_id, "time", time_context):
+        ctx.logger.info(f"Ignoring time for finished round {msg.round_id}")
 
 
 bureau = Bureau(port=8006)  # endpoint="http://localhost:8006/submit")
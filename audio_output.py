@@ -0,0 +1,232 @@
+"""
+Streaming output stage for generated audio: running loudness normalization with a look-ahead limiter, followed by an
+incremental encoder, so that chunks can be sent to an HTTP response or a file as soon as they are generated instead of
+after the whole track exists.
+"""
+import io
+import struct
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import soundfile as sf
+
+
+class StreamingLoudnessNormalizer:
+    def __init__(
+        self,
+        sampling_rate: int,
+        target_lufs: float = -14.0,
+        lookahead_s: float = 0.1,
+        block_s: float = 0.4,
+        max_gain_db: float = 20.0,
+        ceiling: float = 0.99,
+    ):
+        """
+        Normalizes the loudness of a stream towards `target_lufs` using the loudness measured so far, instead of the
+        loudness of the whole track as `audio_write(..., strategy="loudness")` does.
+        Parameters:
+            sampling_rate (`int`):
+                The sampling rate of the stream.
+            target_lufs (`float`, *optional*, defaults to -14.0):
+                The target loudness, the same as `audio_write`'s default 14 dB headroom.
+            lookahead_s (`float`, *optional*, defaults to 0.1):
+                How far ahead the limiter looks for peaks. The output is delayed by this much.
+            block_s (`float`, *optional*, defaults to 0.4):
+                The length of the gating blocks the loudness is measured on, as in ITU-R BS.1770. The blocks are not
+                K-weighted, so the measure is an approximation of LUFS.
+            max_gain_db (`float`, *optional*, defaults to 20.0):
+                The maximum gain or attenuation applied, so that near-silent openings are not blown up.
+            ceiling (`float`, *optional*, defaults to 0.99):
+                The peak level the limiter keeps the output under.
+        """
+        self.sampling_rate = sampling_rate
+        self.target_lufs = target_lufs
+        self.lookahead = int(lookahead_s * sampling_rate)
+        self.block_size = int(block_s * sampling_rate)
+        self.max_gain_db = max_gain_db
+        self.ceiling = ceiling
+
+        self.pending = None
+        self.block_energies = []
+        self.partial_block = None
+        self.gain = None
+
+    def measure(self, audio: np.ndarray):
+        """Adds the gating blocks completed by `audio` to the running loudness measurement."""
+        if self.partial_block is not None:
+            audio = np.concatenate([self.partial_block, audio])
+        num_blocks = len(audio) // self.block_size
+        for i in range(num_blocks):
+            block = audio[i * self.block_size : (i + 1) * self.block_size]
+            energy = float(np.mean(np.square(block)))
+            # absolute gate of -70 LUFS
+            if energy > 0 and -0.691 + 10 * np.log10(energy) > -70.0:
+                self.block_energies.append(energy)
+        self.partial_block = audio[num_blocks * self.block_size :]
+
+    def loudness(self, audio: np.ndarray) -> Optional[float]:
+        energies = self.block_energies
+        if not energies:
+            # not a full block yet, measure on what has been seen
+            energy = float(np.mean(np.square(audio))) if len(audio) else 0.0
+            energies = [energy] if energy > 0 else []
+        if not energies:
+            return None
+        return -0.691 + 10 * np.log10(np.mean(energies))
+
+    def apply(self, audio: np.ndarray, lookahead: np.ndarray) -> np.ndarray:
+        loudness = self.loudness(audio)
+        gain_db = 0.0 if loudness is None else np.clip(self.target_lufs - loudness, -self.max_gain_db, self.max_gain_db)
+        gain = 10 ** (gain_db / 20)
+
+        # limit the gain so that neither this audio nor the audio right after it goes over the ceiling
+        peak = max(float(np.max(np.abs(audio), initial=0.0)), float(np.max(np.abs(lookahead), initial=0.0)))
+        if peak * gain > self.ceiling:
+            gain = self.ceiling / peak
+
+        # ramp from the previous gain to avoid zipper noise
+        previous_gain = gain if self.gain is None else self.gain
+        ramp = np.linspace(previous_gain, gain, len(audio), dtype=np.float32)
+        if audio.ndim > 1:
+            ramp = ramp[:, None]
+        self.gain = gain
+        return np.clip(audio * ramp, -self.ceiling, self.ceiling).astype(np.float32)
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        """Normalizes a chunk. Returns the audio that is `lookahead_s` behind the input, which may be empty."""
+        self.measure(audio)
+        if self.pending is not None:
+            audio = np.concatenate([self.pending, audio])
+        if len(audio) <= self.lookahead:
+            self.pending = audio
+            return audio[:0]
+
+        ready, self.pending = audio[: len(audio) - self.lookahead], audio[len(audio) - self.lookahead :]
+        return self.apply(ready, self.pending)
+
+    def flush(self) -> np.ndarray:
+        """Returns the audio still held back for the look-ahead, at the end of the stream."""
+        if self.pending is None or not len(self.pending):
+            return np.zeros(0, dtype=np.float32)
+        audio, self.pending = self.pending, None
+        return self.apply(audio, audio[:0])
+
+
+class WavStreamEncoder:
+    """Encodes to 16-bit PCM WAV. The header declares the maximum length, which players treat as a live stream."""
+
+    def __init__(self, sampling_rate: int, channels: int = 1):
+        self.sampling_rate = sampling_rate
+        self.channels = channels
+
+    def start(self) -> bytes:
+        byte_rate = self.sampling_rate * self.channels * 2
+        fmt = struct.pack("<HHIIHH", 1, self.channels, self.sampling_rate, byte_rate, self.channels * 2, 16)
+        unknown_size = struct.pack("<I", 0xFFFFFFFF)
+        return b"RIFF" + unknown_size + b"WAVEfmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + unknown_size
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        return (np.clip(audio, -1.0, 1.0) * np.iinfo(np.int16).max).astype("<i2").tobytes()
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class _ByteSink:
+    """Write-only file object for soundfile that hands out what has been written so far."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.position = 0
+
+    def write(self, data):
+        start = self.position - self.offset
+        self.buffer[start : start + len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readinto(self, buffer):
+        return 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        length = self.offset + len(self.buffer)
+        target = {io.SEEK_SET: offset, io.SEEK_CUR: self.position + offset, io.SEEK_END: length + offset}[whence]
+        if target < self.offset:
+            raise io.UnsupportedOperation("cannot seek back into audio that was already sent")
+        self.position = target
+        return target
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.offset += len(self.buffer)
+        self.buffer = bytearray()
+        return data
+
+
+class OggStreamEncoder:
+    """Encodes to Ogg Vorbis with soundfile, a fraction of the size of WAV, handing out each page as it is written."""
+
+    def __init__(self, sampling_rate: int, channels: int = 1):
+        self.sink = _ByteSink()
+        self.file = sf.SoundFile(
+            self.sink, "w", samplerate=sampling_rate, channels=channels, format="OGG", subtype="VORBIS"
+        )
+
+    def start(self) -> bytes:
+        return self.sink.drain()
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        self.file.write(np.clip(audio, -1.0, 1.0))
+        return self.sink.drain()
+
+    def finish(self) -> bytes:
+        self.file.close()
+        return self.sink.drain()
+
+
+ENCODERS = {"wav": WavStreamEncoder, "ogg": OggStreamEncoder}
+MEDIA_TYPES = {"wav": "audio/wav", "ogg": "audio/ogg"}
+
+
+def encode_stream(
+    chunks: Iterable[np.ndarray],
+    sampling_rate: int,
+    format: str = "wav",
+    normalize: bool = True,
+    channels: int = 1,
+) -> Iterator[bytes]:
+    """
+    Turns an iterator of float audio chunks (e.g. a `MusicgenStreamer`) into an iterator of encoded bytes, loudness
+    normalized on the fly, which can be sent as a chunked HTTP response or appended to a file.
+    """
+    encoder = ENCODERS[format](sampling_rate, channels=channels)
+    normalizer = StreamingLoudnessNormalizer(sampling_rate) if normalize else None
+
+    yield encoder.start()
+    for audio in chunks:
+        if normalizer is not None:
+            audio = normalizer.process(audio)
+        if len(audio):
+            yield encoder.encode(audio)
+    if normalizer is not None:
+        yield encoder.encode(normalizer.flush())
+    yield encoder.finish()
+
+
+def write_stream(chunks: Iterable[np.ndarray], path: str, sampling_rate: int, **kwargs):
+    """Encodes a stream of chunks to a file as they arrive, without holding the whole track in memory."""
+    with open(path, "wb") as outfile:
+        for data in encode_stream(chunks, sampling_rate, **kwargs):
+            outfile.write(data)
+            outfile.flush()
+        if kwargs.get("format", "wav") == "wav":
+            # the file is complete, so the header can declare the real sizes instead of a live stream
+            size = outfile.tell()
+            outfile.seek(4)
+            outfile.write(struct.pack("<I", size - 8))
+            outfile.seek(40)
+            outfile.write(struct.pack("<I", size - 44))
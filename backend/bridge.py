@@ -0,0 +1,126 @@
+"""
+How the backend reaches the SoundScape coordinator agent. `SOUNDSCAPE_BRIDGE` picks the deployment:
+
+- `query` (default): the Bureau runs as its own process (`python pipeline_bureau.py`) and every call is a signed uAgents
+  query to `AGENT_ADDRESS`, submitted over HTTP; started with `SOUNDSCAPE_BACKEND_URL`, it posts its prompt changes to
+  the backend;
+- `inprocess`: the Bureau's agents run on the backend's event loop and calls go straight to the coordinator's functions,
+  which also push prompt changes to the backend instead of being polled.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Optional
+
+from uagents import Model
+from uagents.query import query
+
+logger = logging.getLogger("uvicorn")
+
+AGENT_ADDRESS = "agent1q2vkuxhncyl56rvc6r6zvs3lk3a9fuqet9zgdanysyvusschs6ttq6s07r7"
+QUERY_TIMEOUT = 15.0
+
+
+class NearbyArea(Model):
+    session_id: str
+    latitude: float
+    longitude: float
+    radius: float
+
+
+class Message(Model):
+    msg: str
+
+
+class SessionState(Model):
+    prompt: str
+    # weather category, empty until the weather of the session is known
+    weather: str
+    # TimeContext fields of the local time at the session's location
+    time: dict
+
+
+class QueryBridge:
+    """Calls the coordinator of a separate Bureau with uAgents queries."""
+
+    # prompt changes come from the coordinator over HTTP instead, see SOUNDSCAPE_BACKEND_URL in pipeline_bureau.py
+    pushes = False
+
+    def __init__(self, address: str = AGENT_ADDRESS, timeout: float = QUERY_TIMEOUT, resolver=None):
+        self.address = address
+        self.timeout = timeout
+        self.resolver = resolver
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @staticmethod
+    def reply_text(response) -> str:
+        try:
+            return json.loads(response.decode_payload())["msg"]
+        except (AttributeError, KeyError, ValueError) as e:
+            logger.error(f"Unexpected reply from the SoundScape agent: {response!r} ({e})")
+            return ""
+
+    async def update_location(
+        self, session_id: str, latitude: float, longitude: float, radius: float
+    ) -> Optional[SessionState]:
+        """Moves a session and returns its current prompt and conditions, in a single query."""
+        message = NearbyArea(session_id=session_id, latitude=latitude, longitude=longitude, radius=radius)
+        response = await query(destination=self.address, message=message, resolver=self.resolver, timeout=self.timeout)
+        try:
+            return SessionState.parse_raw(response.decode_payload())
+        except (AttributeError, ValueError) as e:
+            logger.error(f"Unexpected reply from the SoundScape agent: {response!r} ({e})")
+            return None
+
+    async def prompt(self, session_id: str) -> str:
+        response = await query(
+            destination=self.address, message=Message(msg=session_id), resolver=self.resolver, timeout=self.timeout
+        )
+        return self.reply_text(response)
+
+
+class InProcessBridge:
+    """Runs the Bureau on the backend's event loop and calls the coordinator directly."""
+
+    pushes = True
+
+    def __init__(self):
+        self.pipeline = None
+        self.bureau_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # imported here, on the running loop, so that the agents and the Bureau are bound to it
+        import pipeline_bureau
+
+        self.pipeline = pipeline_bureau
+        self.bureau_task = asyncio.create_task(pipeline_bureau.bureau.run_async())
+
+    async def stop(self):
+        if self.bureau_task is not None:
+            self.bureau_task.cancel()
+
+    async def update_location(self, session_id: str, latitude: float, longitude: float, radius: float):
+        return self.pipeline.update_location(session_id, latitude, longitude, radius)
+
+    async def prompt(self, session_id: str) -> str:
+        return self.pipeline.current_prompt(session_id)
+
+    def on_prompt(self, callback: Callable[[str, str], None]):
+        """Calls `callback(session_id, music_prompt)` on the event loop whenever a session's prompt changes."""
+        self.pipeline.prompt_listeners.append(callback)
+
+
+BRIDGES = {"query": QueryBridge, "inprocess": InProcessBridge}
+
+
+def make_bridge(mode: Optional[str] = None):
+    mode = mode or os.environ.get("SOUNDSCAPE_BRIDGE", "query")
+    if mode not in BRIDGES:
+        raise ValueError(f"Unknown SOUNDSCAPE_BRIDGE {mode!r}, expected one of {', '.join(BRIDGES)}")
+    return BRIDGES[mode]()
@@ -1,41 +1,297 @@
-from fastapi import FastAPI
-from pymongo import MongoClient
-from uagents import Model
-from uagents.query import query
+import os
+import sys
+
+import asyncio
+import hmac
+
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from pymongo.errors import PyMongoError
 import time, requests, json, base64, logging
-from typing import Optional
+from typing import Dict, Optional, Set, Tuple
 import uvicorn
 
+# the generation stack lives at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_output import MEDIA_TYPES, encode_stream
+from bridge import make_bridge
+from generation_service import frame_rate, sampling_rate, start_workers, stream_chunks, track_id
+from persistence import persistence
+from push import SessionHub
+from sessions import SessionStore
+from streaming import LiveTrack, file_slice, parse_range, render_track, track_available, valid_track_id
+from time_context import TimeContext
+from track_index import IndexedTrack, TrackIndex
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("uvicorn")
 app = FastAPI()
 
-# Connect to MongoDB
-client = MongoClient("mongodb://localhost:27017")
-db = client["mydatabase"]
-collection = db["mycollection"]
+# session used by clients that do not send their own id
+DEFAULT_SESSION = "default"
+# seconds of audio per streamed chunk
+PLAY_STEPS_S = 1.5
+# length and seed of the tracks generated for sessions in the background, the defaults of /api/stream so it replays them
+DEFAULT_DURATION_S = 30.0
+DEFAULT_SEED = 0
+# how many of those are generated at once
+MAX_BACKGROUND_GENERATIONS = 2
+# how often the sessions with a push client are touched at the coordinator, well within the 600 s after which it drops
+# idle sessions, so a listener standing still keeps getting updates; and how many of those run at once
+KEEPALIVE_S = 120.0
+MAX_CONCURRENT_KEEPALIVES = 32
+# shared with a Bureau running as a separate process; without it its prompt notifications are all rejected
+PUSH_TOKEN = os.environ.get("SOUNDSCAPE_PUSH_TOKEN", "")
+# comment line sent on idle SSE streams so proxies do not close them
+SSE_KEEPALIVE_S = 15.0
+
+# latest prompt and track of each session, for the WebSocket, SSE and long-poll clients
+hub = SessionHub()
+# the SoundScape coordinator, queried over uAgents or running in this process depending on SOUNDSCAPE_BRIDGE
+bridge = make_bridge()
+# last location and conditions of each session, for the records of the tracks it streams
+sessions = SessionStore(ttl=600.0)
+# generated tracks by location, part of the day and weather, so sessions in an area covered before hear one right away
+track_index = TrackIndex()
+# background generations by track id, shared by the sessions waiting for the same track
+generations: Dict[str, asyncio.Task] = {}
+# the audio of those as it is generated, for the streams of the same track to follow
+live_tracks: Dict[str, LiveTrack] = {}
+# (session id, track id) of the sessions waiting to be handed over to their own track
+handovers: Set[Tuple[str, str]] = set()
+
+
+async def session_prompt(session_id: str) -> str:
+    """The current music prompt of a session, empty if the agent has none yet."""
+    return await bridge.prompt(session_id)
+
+
+def update_payload(session_id: str, etag: str, state: dict) -> dict:
+    payload = dict(state, type="update", etag=etag, stream_url=f"/api/stream?session_id={session_id}")
+    if "track_id" in state:
+        payload["track_url"] = f"/api/tracks/{state['track_id']}"
+    return payload
+
+
+async def touch_session(session_id: str):
+    """Marks a session as active at the coordinator and here, and publishes its prompt if an update of it was missed."""
+    sessions.get(session_id)
+    music_prompt = await session_prompt(session_id)
+    if music_prompt and music_prompt != hub.current(session_id)[1].get("prompt"):
+        publish_prompt(session_id, music_prompt)
+
+
+async def keep_sessions_alive():
+    """
+    Touches the sessions that have a push client every `KEEPALIVE_S`. Clients only send a location when they move, and
+    prompt changes are pushed by the coordinator, so without this a listener standing still would expire.
+    """
+    limit = asyncio.Semaphore(MAX_CONCURRENT_KEEPALIVES)
+
+    async def touch(session_id: str):
+        async with limit:
+            try:
+                await touch_session(session_id)
+            except Exception as e:
+                logger.error(f"Could not touch session {session_id}: {e!r}")
+
+    while True:
+        await asyncio.sleep(KEEPALIVE_S)
+        await asyncio.gather(*(touch(session_id) for session_id in hub.watched()))
+
+
+def generation_steps(duration: float) -> Tuple[int, int]:
+    """`(max_new_tokens, play_steps)` of a track of `duration` seconds."""
+    return int(frame_rate * duration), int(frame_rate * PLAY_STEPS_S)
+
+
+def track_entry(track: str, session_id: str, music_prompt: str) -> Optional[IndexedTrack]:
+    """Where and in which conditions a track is generated for a session, `None` while those are not known."""
+    session = sessions.get(session_id)
+    if session is None or session.time_context is None:
+        return None
+    return IndexedTrack(
+        track, session.latitude, session.longitude, session.time_context.bucket, session.weather, music_prompt
+    )
+
+
+def track_finished(
+    track: str, session_id: str, music_prompt: str, duration: float, seed: int, entry: Optional[IndexedTrack]
+):
+    """Records a generated track and indexes it for the sessions that come to the same area later."""
+    persistence.record_track(
+        track,
+        session_id,
+        music_prompt,
+        duration,
+        seed,
+        location=(entry.latitude, entry.longitude) if entry is not None else None,
+        weather=entry.weather if entry is not None else "",
+        time_bucket=entry.time_bucket if entry is not None else "",
+    )
+    if entry is not None:
+        track_index.add(entry)
+
+
+async def generate_track(track: str, session_id: str, music_prompt: str):
+    max_new_tokens, play_steps = generation_steps(DEFAULT_DURATION_S)
+    entry = track_entry(track, session_id, music_prompt)
+    live = live_tracks[track] = LiveTrack()
+
+    def generate():
+        for chunk in stream_chunks(music_prompt, max_new_tokens, play_steps, DEFAULT_SEED):
+            live.append(chunk)
+
+    try:
+        async with app.state.generation_limit:
+            await run_in_threadpool(generate)
+    except BaseException:
+        live.finish(failed=True)
+        raise
+    finally:
+        live_tracks.pop(track, None)
+    live.finish()
+    track_finished(track, session_id, music_prompt, DEFAULT_DURATION_S, DEFAULT_SEED, entry)
+
+
+async def hand_over(session_id: str, music_prompt: str, track: str):
+    """Generates a session's own track in the background, and switches the session to it once it is ready."""
+    task = generations.get(track)
+    if task is None:
+        task = asyncio.create_task(generate_track(track, session_id, music_prompt))
+        generations[track] = task
+        task.add_done_callback(lambda _: generations.pop(track, None))
+    try:
+        await asyncio.shield(task)
+    except Exception as e:
+        logger.error(f"Background generation for session {session_id} failed: {e!r}")
+        return
+    finally:
+        handovers.discard((session_id, track))
+    # the session may have moved on to another prompt meanwhile
+    if hub.current(session_id)[1].get("prompt") == music_prompt:
+        hub.publish(session_id, track_id=track, track_source="generated")
+
+
+def serve_soundscape(session_id: str, music_prompt: str):
+    """
+    Points a session at a track right away: its own if its prompt was generated before, otherwise the closest
+    compatible track generated nearby, while its own is generated in the background.
+    """
+    if music_prompt:
+        max_new_tokens, play_steps = generation_steps(DEFAULT_DURATION_S)
+        track = track_id(music_prompt, max_new_tokens, play_steps, DEFAULT_SEED)
+        if track_available(track):
+            hub.publish(session_id, track_id=track, track_source="generated")
+            return
+        if (session_id, track) not in handovers:
+            handovers.add((session_id, track))
+            asyncio.create_task(hand_over(session_id, music_prompt, track))
 
-AGENT_ADDRESS = "agent1q2vkuxhncyl56rvc6r6zvs3lk3a9fuqet9zgdanysyvusschs6ttq6s07r7"
+    session = sessions.get(session_id)
+    if session is None or session.time_context is None:
+        return
+    nearby = track_index.nearest(
+        session.latitude, session.longitude, session.time_context.bucket, session.weather, available=track_available
+    )
+    if nearby is not None:
+        hub.publish(session_id, track_id=nearby.track_id, track_source="nearby")
 
 
-class NearbyArea(Model):
-    latitude: float
-    longitude: float
-    radius: float
+def publish_prompt(session_id: str, music_prompt: str):
+    if music_prompt:
+        hub.publish(session_id, prompt=music_prompt)
+    serve_soundscape(session_id, music_prompt)
 
 
-class Message(Model):
-    msg: str
+async def load_track_index():
+    """Indexes the tracks of earlier runs that can still be served."""
+    try:
+        documents = await persistence.recent_tracks(track_index.max_entries)
+    except PyMongoError as e:
+        logger.error(f"Could not load the generated tracks from MongoDB: {e}")
+        return
+    documents = [document for document in documents if document.get("time_bucket")]
+    documents = await run_in_threadpool(lambda: [d for d in documents if track_available(d["_id"])])
+    # oldest first, so the newest tracks are the last to be evicted
+    for document in reversed(documents):
+        longitude, latitude = document["location"]["coordinates"]
+        track_index.add(
+            IndexedTrack(
+                document["_id"],
+                latitude,
+                longitude,
+                document["time_bucket"],
+                document.get("weather", ""),
+                document.get("prompt", ""),
+                document["created_at"].timestamp(),
+            )
+        )
+    logger.info(f"Track index: {track_index.stats()}")
 
 
-async def agent_audio_query(req: Message):
-    response = await query(destination=AGENT_ADDRESS, message=req, timeout=15.0)
-    return response
+@app.on_event("startup")
+async def start_bridge():
+    # first, while this process has no other thread: the generation workers are forked from it
+    start_workers()
+    # sessions, prompts and tracks are written to MongoDB in the background, never on the request path
+    await persistence.start()
+    app.state.generation_limit = asyncio.Semaphore(MAX_BACKGROUND_GENERATIONS)
+    app.state.track_loader = asyncio.create_task(load_track_index())
+    await bridge.start()
+    if bridge.pushes:
+        # the coordinator runs in this process and reports its prompt changes itself
+        bridge.on_prompt(publish_prompt)
+    # otherwise a coordinator started with SOUNDSCAPE_BACKEND_URL posts them to /api/internal/prompts
+    app.state.session_keepalive = asyncio.create_task(keep_sessions_alive())
 
 
-async def agent_location_send(req: NearbyArea):
-    response = await query(destination=AGENT_ADDRESS, message=req, timeout=15.0)
-    return response
+@app.on_event("shutdown")
+async def stop_bridge():
+    app.state.session_keepalive.cancel()
+    app.state.track_loader.cancel()
+    await bridge.stop()
+    await persistence.stop()
+
+
+async def update_location(session_id: str, latitude: float, longitude: float, radius: float) -> str:
+    """
+    Moves a session and returns its current prompt, in one round-trip to the coordinator, and points it at the track
+    to play there.
+    """
+    state = await bridge.update_location(session_id, latitude, longitude, radius)
+    sessions.expire()
+    session = sessions.update_location(session_id, latitude, longitude, radius)
+    music_prompt = ""
+    if state is not None:
+        music_prompt = state.prompt
+        session.weather = state.weather
+        session.time_context = TimeContext(**state.time) if state.time else None
+    persistence.record_session(session_id, latitude, longitude, radius, music_prompt)
+    publish_prompt(session_id, music_prompt)
+    return music_prompt
+
+
+class PromptPush(BaseModel):
+    session_id: str
+    prompt: str
+
+
+@app.post("/api/internal/prompts")
+async def prompt_changed(body: PromptPush, request: Request):
+    """
+    Prompt changes pushed by a coordinator running as a separate process. Each one can start a generation, so they are
+    only accepted with the shared `SOUNDSCAPE_PUSH_TOKEN`, and not at all when none is configured.
+    """
+    if not PUSH_TOKEN:
+        raise HTTPException(status_code=403, detail="Prompt pushes are disabled, SOUNDSCAPE_PUSH_TOKEN is not set")
+    if not hmac.compare_digest(request.headers.get("x-soundscape-token", ""), PUSH_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid push token")
+    publish_prompt(body.session_id, body.prompt)
+    return {"ok": True}
 
 
 @app.get("/")
@@ -43,27 +299,178 @@ def read_root():
     return {"Hello": "World"}
 
 
-@app.get("/api/audio")
-async def get_audio():
-    logger.info("Handling get request for audio")
-    data = await agent_audio_query(Message(msg=""))
-    file_path = "music_prompt.txt"
-    logger.info("Handled get for audio correctly")
-    return file_path
-
-
 @app.post("/api/location")
 @app.post("/api/location/")
 async def send_coordinates(body: dict):
     latitude = float(body["latitude"])
     longitude = float(body["longitude"])
     radius = float(body["radius"])
+    session_id = str(body.get("session_id", DEFAULT_SESSION))
     logger.info("Handling post request for location")
-    nearby_area = NearbyArea(latitude=latitude, longitude=longitude, radius=radius)
-    data = await agent_location_send(nearby_area)
-    logger.info("Handled post for location correctly, grabbing audio now")
-    file_path = await get_audio()
-    return file_path
+    # the reply to the location update already carries the session's prompt
+    music_prompt = await update_location(session_id, latitude, longitude, radius)
+    logger.info("Handled post for location correctly")
+    reply = {
+        "session_id": session_id,
+        "prompt": music_prompt,
+        "stream_url": f"/api/stream?session_id={session_id}",
+    }
+    # a track to play right away, generated for this prompt or nearby; updates say when the session's own is ready
+    _, state = hub.current(session_id)
+    if "track_id" in state:
+        reply["track_url"] = f"/api/tracks/{state['track_id']}"
+        reply["track_source"] = state["track_source"]
+    return reply
+
+
+@app.get("/api/stream")
+async def stream_audio(
+    session_id: str = DEFAULT_SESSION,
+    format: str = "wav",
+    duration: float = DEFAULT_DURATION_S,
+    seed: int = DEFAULT_SEED,
+):
+    """
+    Generates the soundscape of a session's current prompt and sends the encoded audio as it is generated, so clients
+    can start playing on the first chunk. The `X-Track-Id` header names the track for `/api/tracks/{track_id}` once it
+    is complete.
+    """
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported format {format}")
+    music_prompt = await session_prompt(session_id)
+    if not music_prompt:
+        raise HTTPException(status_code=404, detail="No music prompt for this session yet")
+
+    max_new_tokens, play_steps = generation_steps(duration)
+    track = track_id(music_prompt, max_new_tokens, play_steps, seed)
+    entry = track_entry(track, session_id, music_prompt)
+    loop = asyncio.get_running_loop()
+
+    def finished():
+        hub.publish(session_id, track_id=track, track_source="generated")
+        track_finished(track, session_id, music_prompt, duration, seed, entry)
+
+    def chunks():
+        yield from stream_chunks(music_prompt, max_new_tokens, play_steps, seed)
+        # runs in the threadpool the response is iterated in, the hub and the store live on the event loop
+        loop.call_soon_threadsafe(finished)
+
+    # the session's track is already being generated in the background: follow it rather than generate it twice
+    live = live_tracks.get(track)
+    logger.info(f"Streaming {duration}s of audio for session {session_id}{' (following)' if live else ''}")
+    return StreamingResponse(
+        encode_stream(iter(live) if live is not None else chunks(), sampling_rate, format=format),
+        media_type=MEDIA_TYPES[format],
+        headers={"X-Track-Id": track, "Cache-Control": "no-store"},
+    )
+
+
+@app.get("/api/tracks/{track_id}")
+async def get_track(track_id: str, request: Request, format: str = "wav"):
+    """Serves a generated track with its length and byte ranges, so players can seek and interrupted downloads resume."""
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported format {format}")
+    # the id names files on disk
+    if not valid_track_id(track_id):
+        raise HTTPException(status_code=404, detail="Unknown track")
+    path = await run_in_threadpool(render_track, track_id, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Unknown track")
+
+    size = os.path.getsize(path)
+    headers = {"Accept-Ranges": "bytes", "ETag": f'"{track_id}.{format}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(file_slice(path, 0, size - 1), media_type=MEDIA_TYPES[format], headers=headers)
+    try:
+        start, end = parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        file_slice(path, start, end), status_code=206, media_type=MEDIA_TYPES[format], headers=headers
+    )
+
+
+@app.websocket("/ws/sessions/{session_id}")
+async def session_socket(websocket: WebSocket, session_id: str):
+    """
+    Push channel of a session: the client sends its location whenever it moved (any of `latitude`, `longitude` and
+    `radius`, the others are kept), and receives an update each time the session's prompt or track changes.
+    """
+    await websocket.accept()
+    location = {}
+
+    async def receive_locations():
+        while True:
+            location.update(await websocket.receive_json())
+            try:
+                await update_location(
+                    session_id,
+                    float(location["latitude"]),
+                    float(location["longitude"]),
+                    float(location.get("radius", 10.0)),
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                await websocket.send_json({"type": "error", "detail": f"Invalid location: {e}"})
+
+    async def push_updates():
+        etag = None
+        while True:
+            etag, state = await hub.wait(session_id, etag)
+            await websocket.send_json(update_payload(session_id, etag, state))
+
+    with hub.subscription(session_id):
+        # keeps the session alive at the coordinator from the moment the client connects, the keepalive takes over
+        await touch_session(session_id)
+        tasks = [asyncio.create_task(receive_locations()), asyncio.create_task(push_updates())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not isinstance(task.exception(), WebSocketDisconnect):
+                    logger.error(f"Push channel of session {session_id} failed: {task.exception()!r}")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+@app.get("/api/sessions/{session_id}/events")
+async def session_events(session_id: str, request: Request):
+    """Server-Sent Events version of the push channel, for clients that only need the updates."""
+
+    async def events():
+        etag = request.headers.get("last-event-id")
+        with hub.subscription(session_id):
+            await touch_session(session_id)
+            while not await request.is_disconnected():
+                update = await hub.wait(session_id, etag, timeout=SSE_KEEPALIVE_S)
+                if update is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                etag, state = update
+                yield f"id: {etag}\nevent: update\ndata: {json.dumps(update_payload(session_id, etag, state))}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/api/sessions/{session_id}/state")
+async def session_state(session_id: str, request: Request, wait: float = 25.0):
+    """
+    Long-poll fallback: answers as soon as the session's state differs from the `If-None-Match` ETag, or with 304 after
+    `wait` seconds without a change.
+    """
+    etag = request.headers.get("if-none-match")
+    with hub.subscription(session_id):
+        update = await hub.wait(session_id, etag, timeout=min(max(wait, 0.0), 60.0))
+    if update is None:
+        return Response(status_code=304, headers={"ETag": etag} if etag else {})
+    etag, state = update
+    return JSONResponse(update_payload(session_id, etag, state), headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+import json
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+
+class SessionHub:
+    """
+    Latest soundscape state of each session (its music prompt, and the last finished track) with an ETag that changes
+    with it, so that WebSocket, SSE and long-poll clients are woken up only when something actually changed.
+
+    `publish` must be called on the event loop; threads go through `loop.call_soon_threadsafe`.
+    """
+
+    def __init__(self):
+        self.states: Dict[str, dict] = {}
+        self.etags: Dict[str, str] = {}
+        self.changed: Dict[str, asyncio.Event] = {}
+        self.subscribers: Counter = Counter()
+
+    @staticmethod
+    def make_etag(state: dict) -> str:
+        return '"' + hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()[:16] + '"'
+
+    def current(self, session_id: str) -> Tuple[Optional[str], dict]:
+        return self.etags.get(session_id), self.states.get(session_id, {})
+
+    def publish(self, session_id: str, **fields) -> bool:
+        """Merges `fields` into the session's state, and wakes its waiters if that changed it."""
+        state = dict(self.states.get(session_id, {}), **fields)
+        etag = self.make_etag(state)
+        if etag == self.etags.get(session_id):
+            return False
+        self.states[session_id] = state
+        self.etags[session_id] = etag
+        # waiters hold on to the event they got, a fresh one is handed out for the next change
+        event = self.changed.pop(session_id, None)
+        if event is not None:
+            event.set()
+        return True
+
+    async def wait(
+        self, session_id: str, etag: Optional[str], timeout: Optional[float] = None
+    ) -> Optional[Tuple[str, dict]]:
+        """
+        Returns `(etag, state)` as soon as the session's ETag differs from `etag`, or `None` if it did not change
+        within `timeout` seconds.
+        """
+        while True:
+            current, state = self.current(session_id)
+            if current is not None and current != etag:
+                return current, state
+            event = self.changed.setdefault(session_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    @contextmanager
+    def subscription(self, session_id: str):
+        """Marks the session as watched for as long as a push client is connected to it."""
+        self.subscribers[session_id] += 1
+        try:
+            yield
+        finally:
+            self.subscribers[session_id] -= 1
+            if self.subscribers[session_id] <= 0:
+                del self.subscribers[session_id]
+
+    def watched(self) -> List[str]:
+        return list(self.subscribers)
@@ -0,0 +1,124 @@
+import os
+import re
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from audio_output import MEDIA_TYPES, write_stream
+from generation_service import archived_chunks, frame_rate, track_archive
+
+AUDIO_DIR = "cache/audio"
+BLOCK_SIZE = 64 * 1024
+# seconds of audio decoded at a time when rendering a track
+RENDER_CHUNK_S = 10
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+# track ids are the sha256 keys of the track archive
+TRACK_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class LiveTrack:
+    """
+    The chunks of a track being generated, so that other requests for the same track follow the generation instead of
+    running it again. Chunks are appended from the generating thread and read from the threads streaming responses.
+    """
+
+    def __init__(self):
+        self.chunks: List[np.ndarray] = []
+        self.done = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    def append(self, chunk: np.ndarray):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, failed: bool = False):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.condition.notify_all()
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        """Yields every chunk from the first one, waiting for those not generated yet."""
+        position = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.chunks) > position or self.done)
+                if position == len(self.chunks):
+                    if self.failed:
+                        raise RuntimeError("The generation of the track failed")
+                    return
+                chunk = self.chunks[position]
+            position += 1
+            yield chunk
+
+
+def valid_track_id(track_id: str) -> bool:
+    return TRACK_ID_PATTERN.fullmatch(track_id) is not None
+
+
+def track_path(track_id: str, format: str) -> str:
+    return os.path.join(AUDIO_DIR, f"{track_id}.{format}")
+
+
+def track_available(track_id: str) -> bool:
+    """Whether a track can still be served, rendered already or from its codes in the track archive."""
+    rendered = any(os.path.exists(track_path(track_id, format)) for format in MEDIA_TYPES)
+    return rendered or track_id in track_archive
+
+
+def render_track(track_id: str, format: str) -> Optional[str]:
+    """
+    Decodes an archived track and encodes it to a file once, so that it can be served with a known length and byte
+    ranges. Returns `None` if the track is not in the track archive.
+    """
+    if not valid_track_id(track_id):
+        return None
+    path = track_path(track_id, format)
+    if os.path.exists(path):
+        return path
+    metadata = track_archive.get(track_id)
+    if metadata is None:
+        return None
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    # write to a temporary file first so a concurrent request never serves a partial track
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    chunks = archived_chunks(track_id, RENDER_CHUNK_S * frame_rate)
+    write_stream(chunks, tmp_path, metadata["sampling_rate"], format=format)
+    os.replace(tmp_path, path)
+    return path
+
+
+def parse_range(header: str, size: int) -> Tuple[int, int]:
+    """
+    Parses a single `Range: bytes=start-end` header into an inclusive `(start, end)` within a file of `size` bytes.
+    Raises `ValueError` if it cannot be satisfied.
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        raise ValueError(f"Unsupported range {header!r}")
+    if match.group(1) == "":
+        # suffix range: the last N bytes
+        start, end = max(0, size - int(match.group(2))), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end or start >= size:
+        raise ValueError(f"Range {header!r} is outside of the {size} bytes of the track")
+    return start, end
+
+
+def file_slice(path: str, start: int, end: int) -> Iterator[bytes]:
+    """Yields the bytes of a file from `start` to `end` inclusive, one block at a time."""
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = file.read(min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
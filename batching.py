@@ -0,0 +1,202 @@
+import time
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import List, Optional
+
+import torch
+from transformers import (
+    GenerationConfig,
+    LogitsProcessor,
+    LogitsProcessorList,
+    MusicgenForConditionalGeneration,
+    MusicgenProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from musicgen_streamer import BatchedMusicgenStreamer, MusicgenStreamer
+
+
+def logits_warpers(generation_config: GenerationConfig) -> LogitsProcessorList:
+    """The temperature, top-k and top-p warpers `.generate()` samples with for `generation_config`, in its order."""
+    warpers = LogitsProcessorList()
+    if generation_config.temperature is not None and generation_config.temperature != 1.0:
+        warpers.append(TemperatureLogitsWarper(generation_config.temperature))
+    if generation_config.top_k is not None and generation_config.top_k != 0:
+        warpers.append(TopKLogitsWarper(top_k=generation_config.top_k, min_tokens_to_keep=1))
+    if generation_config.top_p is not None and generation_config.top_p < 1.0:
+        warpers.append(TopPLogitsWarper(top_p=generation_config.top_p, min_tokens_to_keep=1))
+    return warpers
+
+
+class SeededSampler(LogitsProcessor):
+    """
+    Samples the next tokens of each element of a batch with its own random number generator, seeded with that element's
+    seed, so a seeded request generates the same audio whether it runs alone or batched with others.
+
+    `.generate()` only samples with the global generator, so this samples itself: it applies classifier free guidance
+    and the model's logits warpers (temperature, top-k, top-p) like `.generate()` would, draws each element's tokens
+    from its own generator and returns logits that leave only the drawn token possible. Those pass unchanged through
+    the guidance processor `.generate()` appends after this one (both halves are identical) and through the warpers.
+    """
+
+    def __init__(self, model: MusicgenForConditionalGeneration, seeds: List[int]):
+        self.num_codebooks = model.decoder.num_codebooks
+        self.guidance_scale = model.generation_config.guidance_scale
+        self.warpers = logits_warpers(model.generation_config)
+        self.generators = [torch.Generator(device=model.device).manual_seed(seed) for seed in seeds]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        rows = len(self.generators) * self.num_codebooks
+        guided = scores.shape[0] == 2 * rows
+        logits = scores
+        if guided:
+            # the conditional rows come first, then the unconditional ones
+            cond_logits, uncond_logits = scores.split(rows, dim=0)
+            logits = uncond_logits + (cond_logits - uncond_logits) * self.guidance_scale
+        probs = torch.softmax(self.warpers(input_ids[:rows], logits).float(), dim=-1)
+
+        # rows are grouped by batch element, one per codebook
+        tokens = torch.cat(
+            [
+                torch.multinomial(probs[i * self.num_codebooks : (i + 1) * self.num_codebooks], 1, generator=generator)
+                for i, generator in enumerate(self.generators)
+            ]
+        )
+        if guided:
+            tokens = tokens.repeat(2, 1)
+        forced = torch.full_like(scores, torch.finfo(scores.dtype).min)
+        return forced.scatter_(1, tokens, 0.0)
+
+
+def seeded_sampling(model: MusicgenForConditionalGeneration, seeds: List[int]) -> LogitsProcessorList:
+    """The `logits_processor` of a `.generate()` call for a batch with these seeds, empty for a model that does not sample."""
+    if not model.generation_config.do_sample:
+        return LogitsProcessorList()
+    return LogitsProcessorList([SeededSampler(model, seeds)])
+
+
+@dataclass
+class GenerationRequest:
+    text_prompt: str
+    max_new_tokens: int
+    seed: int
+    streamer: MusicgenStreamer
+    arrival: float = field(default_factory=time.monotonic)
+
+
+class GenerationBatcher:
+    def __init__(
+        self,
+        model: MusicgenForConditionalGeneration,
+        processor: MusicgenProcessor,
+        max_batch_size: int = 8,
+        batch_window_s: float = 0.05,
+        num_workers: int = 1,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Scheduler that merges the prompts arriving within a short window into one batched `.generate()` call, instead
+        of running one decoder pass per request. Each request gets its own `MusicgenStreamer` to iterate over.
+        Parameters:
+            model (`MusicgenForConditionalGeneration`):
+                The MusicGen model shared by all the batches.
+            processor (`MusicgenProcessor`):
+                The processor used to tokenize and pad the prompts of a batch together.
+            max_batch_size (`int`, *optional*, defaults to 8):
+                The maximum number of prompts generated together.
+            batch_window_s (`float`, *optional*, defaults to 0.05):
+                How long to wait after the first pending request for more requests to join its batch. This bounds the
+                delay added to the time-to-first-chunk of a request on an idle worker.
+            num_workers (`int`, *optional*, defaults to 1):
+                The number of batches that can be generated at the same time. With more than one worker a new batch can
+                start while a long one is still running.
+            timeout (`float`, *optional*):
+                The timeout of the audio queue of each request's streamer.
+        Every request samples with its own generator seeded with its seed (see `SeededSampler`), so requests with
+        different seeds share batches and a seed reproduces the same audio whichever batch its request lands in.
+        """
+        self.model = model
+        self.processor = processor
+        self.max_batch_size = max_batch_size
+        self.batch_window_s = batch_window_s
+        self.timeout = timeout
+
+        self.pending: List[GenerationRequest] = []
+        self.condition = Condition()
+        self.num_batches = 0
+        self.num_requests = 0
+
+        self.workers = [Thread(target=self.run, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, text_prompt: str, max_new_tokens: int, play_steps: int, seed: int = 0, **streamer_kwargs):
+        """Queues a prompt for generation and returns the streamer its audio chunks will be put in."""
+        streamer = MusicgenStreamer(
+            self.model,
+            play_steps=play_steps,
+            timeout=self.timeout,
+            max_new_tokens=max_new_tokens,
+            **streamer_kwargs,
+        )
+        request = GenerationRequest(text_prompt=text_prompt, max_new_tokens=max_new_tokens, seed=seed, streamer=streamer)
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify_all()
+        return streamer
+
+    def next_batch(self):
+        """Waits for a pending request, then for the batch window to elapse or the batch to fill up."""
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+
+            deadline = self.pending[0].arrival + self.batch_window_s
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = self.pending[: self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size :]
+            return batch
+
+    def generate(self, batch: List[GenerationRequest]):
+        inputs = self.processor(
+            text=[request.text_prompt for request in batch],
+            padding=True,
+            return_tensors="pt",
+        )
+        streamer = BatchedMusicgenStreamer([request.streamer for request in batch])
+
+        try:
+            self.model.generate(
+                **inputs.to(self.model.device),
+                streamer=streamer,
+                max_new_tokens=max(request.max_new_tokens for request in batch),
+                logits_processor=seeded_sampling(self.model, [request.seed for request in batch]),
+            )
+        finally:
+            # make sure no requester is left waiting on its queue if generation failed
+            streamer.end()
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            try:
+                self.generate(batch)
+            except Exception as e:
+                print(f"Error: batched generation of {len(batch)} prompts failed: {e}")
+
+    def stats(self):
+        return {
+            "batches": self.num_batches,
+            "requests": self.num_requests,
+            "mean_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+            "pending": len(self.pending),
+        }
@@ -0,0 +1,105 @@
+"""
+Per-request overhead of the backend reaching the SoundScape coordinator: signed uAgents queries to a Bureau over local
+HTTP (two per location POST as the backend used to make, and the single combined one of `QueryBridge`), against the
+direct call of `InProcessBridge`.
+
+The coordinator here is a stand-in with the same query handlers and session store as `pipeline_bureau.py`, without the
+upstream agents, so only the transport is measured.
+
+Usage: python -m benchmarks.bureau_bridge [--requests 200] [--port 8016]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+from uagents import Agent, Bureau, Context
+from uagents.resolver import RulesBasedResolver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from bridge import Message, NearbyArea, QueryBridge, SessionState  # noqa: E402
+from sessions import SessionStore  # noqa: E402
+
+sessions = SessionStore()
+
+
+def update_location(session_id, latitude, longitude, radius):
+    session = sessions.update_location(session_id, latitude, longitude, radius)
+    if session.music_prompt is None:
+        session.music_prompt = "Calm ambient pads for a quiet beach evening"
+    return session.music_prompt
+
+
+def current_prompt(session_id):
+    session = sessions.get(session_id)
+    return (session.music_prompt if session is not None else None) or ""
+
+
+def coordinator(port):
+    agent = Agent(name="SoundScapeStandIn", seed="SoundScapeBridgeBenchmark")
+
+    @agent.on_query(model=NearbyArea, replies={SessionState})
+    async def save_coordinates(ctx: Context, sender: str, msg: NearbyArea):
+        music_prompt = update_location(msg.session_id, msg.latitude, msg.longitude, msg.radius)
+        await ctx.send(sender, SessionState(prompt=music_prompt, weather="clear", time={}))
+
+    @agent.on_query(model=Message, replies={Message})
+    async def get_audio(ctx: Context, sender: str, msg: Message):
+        await ctx.send(sender, Message(msg=current_prompt(msg.msg)))
+
+    bureau = Bureau(port=port, endpoint=f"http://127.0.0.1:{port}/submit")
+    bureau.add(agent)
+    return agent, bureau
+
+
+async def timed(request, count):
+    latencies = []
+    for i in range(count):
+        start = perf_counter()
+        prompt = await request(i)
+        latencies.append(perf_counter() - start)
+        assert prompt, "the coordinator did not answer"
+    return np.array(latencies) * 1e3
+
+
+async def main(count, port):
+    agent, bureau = coordinator(port)
+    bureau_task = asyncio.create_task(bureau.run_async())
+    await asyncio.sleep(2.0)
+
+    resolver = RulesBasedResolver({agent.address: f"http://127.0.0.1:{port}/submit"})
+    remote = QueryBridge(agent.address, resolver=resolver)
+
+    async def two_queries(i):
+        await remote.update_location(f"session-{i % 10}", 34.0156, -118.4944, 10.0)
+        return await remote.prompt(f"session-{i % 10}")
+
+    async def one_query(i):
+        return (await remote.update_location(f"session-{i % 10}", 34.0156, -118.4944, 10.0)).prompt
+
+    async def in_process(i):
+        return update_location(f"session-{i % 10}", 34.0156, -118.4944, 10.0)
+
+    modes = {"query, location + prompt": two_queries, "query, combined": one_query, "in-process": in_process}
+    print(f"{'mode':>26} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for name, request in modes.items():
+        # warm up connections and caches before measuring
+        await timed(request, 5)
+        latencies = await timed(request, count)
+        print(
+            f"{name:>26} {latencies.mean():>10.3f} {np.percentile(latencies, 50):>10.3f} "
+            f"{np.percentile(latencies, 95):>10.3f}"
+        )
+
+    bureau_task.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8016)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.port))
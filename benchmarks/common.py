@@ -0,0 +1,71 @@
+import torch
+
+from transformers import (
+    EncodecConfig,
+    MusicgenConfig,
+    MusicgenDecoderConfig,
+    MusicgenForConditionalGeneration,
+    T5Config,
+)
+
+
+# decoder sizes of the randomly initialised models used by the benchmarks, so they run offline and in CI
+MODEL_SIZES = {
+    "tiny": dict(hidden_size=64, num_hidden_layers=2, num_attention_heads=4),
+    "small": dict(hidden_size=256, num_hidden_layers=4, num_attention_heads=8),
+    "medium": dict(hidden_size=512, num_hidden_layers=8, num_attention_heads=8),
+}
+
+
+def tiny_musicgen(size="tiny", num_codebooks=4, codebook_size=2048, seed=0):
+    """
+    Builds a randomly initialised MusicGen with the same codec layout as `facebook/musicgen-small` (32 kHz, 50 Hz
+    frame rate, 4 codebooks of 2048 entries) but a much smaller text encoder, decoder and codec.
+    """
+    torch.manual_seed(seed)
+    sizes = MODEL_SIZES[size]
+    hidden_size = sizes["hidden_size"]
+    num_attention_heads = sizes["num_attention_heads"]
+
+    text_encoder_config = T5Config(
+        vocab_size=32128,
+        d_model=hidden_size,
+        d_kv=hidden_size // num_attention_heads,
+        d_ff=4 * hidden_size,
+        num_layers=2,
+        num_heads=num_attention_heads,
+    )
+    audio_encoder_config = EncodecConfig(
+        sampling_rate=32000,
+        audio_channels=1,
+        target_bandwidths=[2.2],
+        upsampling_ratios=[8, 5, 4, 4],
+        codebook_size=codebook_size,
+        hidden_size=64,
+        num_filters=8,
+        num_lstm_layers=2,
+        normalize=False,
+        use_causal_conv=False,
+    )
+    decoder_config = MusicgenDecoderConfig(
+        vocab_size=codebook_size,
+        hidden_size=hidden_size,
+        num_hidden_layers=sizes["num_hidden_layers"],
+        num_attention_heads=num_attention_heads,
+        ffn_dim=4 * hidden_size,
+        num_codebooks=num_codebooks,
+        pad_token_id=codebook_size,
+        bos_token_id=codebook_size,
+    )
+    config = MusicgenConfig(
+        text_encoder=text_encoder_config.to_dict(),
+        audio_encoder=audio_encoder_config.to_dict(),
+        decoder=decoder_config.to_dict(),
+    )
+    model = MusicgenForConditionalGeneration(config).eval()
+
+    model.generation_config.decoder_start_token_id = codebook_size
+    model.generation_config.pad_token_id = codebook_size
+    model.generation_config.do_sample = True
+    model.generation_config.guidance_scale = 3.0
+    return model
@@ -0,0 +1,170 @@
+"""
+Benchmark of the generation path (`model.generate` driving a `MusicgenStreamer`) on randomly initialised MusicGen
+models, so it runs offline and in CI. Every configuration of the sweep runs in its own process, which isolates its
+peak RSS and its torch thread count.
+
+Usage:
+    python -m benchmarks.generation                          # full sweep, writes bench_generation.json
+    python -m benchmarks.generation --quick                  # tiny model only, for CI
+    python -m benchmarks.generation --quick --baseline old.json  # exits with 1 on a regression
+"""
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from benchmarks.common import tiny_musicgen
+from musicgen_streamer import MusicgenStreamer
+
+
+SWEEP = dict(
+    size=["tiny", "small", "medium"],
+    play_steps_s=[0.5, 1.5],
+    duration_s=[10.0, 30.0],
+    num_threads=[1, 4],
+)
+QUICK_SWEEP = dict(
+    size=["tiny"],
+    play_steps_s=[1.5],
+    duration_s=[10.0],
+    num_threads=[1],
+)
+# metrics compared against the baseline, all of which are better when lower
+REGRESSION_METRICS = ["time_to_first_chunk_s", "steady_state_rtf", "decode_s_per_chunk"]
+
+
+class TimedMusicgenStreamer(MusicgenStreamer):
+    """Records when each chunk is ready and how long each codec decode takes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_times = []
+        self.chunk_lengths = []
+        self.decode_times = []
+
+    def decode_codes(self, audio_codes):
+        start = time.perf_counter()
+        audio_values = super().decode_codes(audio_codes)
+        self.decode_times.append(time.perf_counter() - start)
+        return audio_values
+
+    def on_finalized_audio(self, audio, stream_end=False):
+        self.chunk_times.append(time.perf_counter())
+        self.chunk_lengths.append(len(audio))
+        super().on_finalized_audio(audio, stream_end=stream_end)
+
+
+def run(size, play_steps_s, duration_s, num_threads, incremental=True, seed=0):
+    torch.set_num_threads(num_threads)
+    model = tiny_musicgen(size, seed=seed)
+    frame_rate = model.audio_encoder.config.frame_rate
+    sampling_rate = model.audio_encoder.config.sampling_rate
+    max_new_tokens = int(frame_rate * duration_s)
+
+    input_ids = torch.randint(0, model.config.text_encoder.vocab_size, (1, 16))
+    streamer = TimedMusicgenStreamer(
+        model,
+        play_steps=int(frame_rate * play_steps_s),
+        incremental=incremental,
+        max_new_tokens=max_new_tokens,
+    )
+
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    with torch.no_grad():
+        model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            streamer=streamer,
+            max_new_tokens=max_new_tokens,
+        )
+    elapsed = time.perf_counter() - start
+
+    # steady state: everything after the first chunk, so that the warm-up and prompt encoding are excluded
+    steady_s = streamer.chunk_times[-1] - streamer.chunk_times[0]
+    steady_audio_s = sum(streamer.chunk_lengths[1:]) / sampling_rate
+    return {
+        "size": size,
+        "play_steps_s": play_steps_s,
+        "duration_s": duration_s,
+        "num_threads": num_threads,
+        "incremental": incremental,
+        "generation_s": elapsed,
+        "time_to_first_chunk_s": streamer.chunk_times[0] - start,
+        "steady_state_rtf": steady_s / steady_audio_s if steady_audio_s else None,
+        "tokens_per_s": max_new_tokens / elapsed,
+        "decode_s_per_chunk": sum(streamer.decode_times) / len(streamer.decode_times),
+        "num_chunks": len(streamer.chunk_times),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def sweep(grid):
+    results = []
+    keys = list(grid)
+    for values in itertools.product(*(grid[key] for key in keys)):
+        config = dict(zip(keys, values))
+        args = [sys.executable, "-m", "benchmarks.generation", "--run", json.dumps(config)]
+        output = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{config}: ttfc {result['time_to_first_chunk_s']:.2f}s, rtf {result['steady_state_rtf']:.2f}, "
+            f"{result['tokens_per_s']:.1f} tokens/s, decode {result['decode_s_per_chunk'] * 1e3:.1f}ms/chunk, "
+            f"peak rss {result['peak_rss_mb']:.0f}MB"
+        )
+        results.append(result)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Lists the metrics that got worse than the baseline by more than `tolerance` (relative)."""
+    config_keys = list(SWEEP)
+    baseline = {tuple(result[key] for key in config_keys): result for result in baseline}
+    found = []
+    for result in results:
+        previous = baseline.get(tuple(result[key] for key in config_keys))
+        if previous is None:
+            continue
+        for metric in REGRESSION_METRICS:
+            if result[metric] is None or not previous[metric]:
+                continue
+            if result[metric] > previous[metric] * (1 + tolerance):
+                found.append((result, metric, previous[metric]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run", help="run a single configuration, given as JSON")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--output", default="bench_generation.json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run(**json.loads(args.run))))
+        return
+
+    results = sweep(QUICK_SWEEP if args.quick else SWEEP)
+    with open(args.output, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for result, metric, previous in found:
+            config = {key: result[key] for key in SWEEP}
+            print(f"Regression: {metric} went from {previous:.4f} to {result[metric]:.4f} for {config}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Microbenchmark of the time agent's time-zone resolution: a new `TimezoneFinder` per message, as the agent used to do,
+against the shared `TimeContextResolver` with a cold and a warm zone cache, and its batch API over many sessions.
+
+Usage: python -m benchmarks.timezone_lookup [--sessions 500]
+"""
+import argparse
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import pytz
+from timezonefinder import TimezoneFinder
+
+from time_context import TimeContextResolver
+
+
+def per_message_finder(latitude, longitude):
+    """The previous handler: build a finder, look the zone up and format the local time."""
+    tf = TimezoneFinder()
+    timezone_str = tf.timezone_at(lat=latitude, lng=longitude)
+    current_time = datetime.now(pytz.timezone(timezone_str))
+    return f"{current_time.hour}:{current_time.minute:02d}"
+
+
+def sessions(count, seed=0):
+    """Listeners clustered around a few cities, like real traffic."""
+    rng = np.random.default_rng(seed)
+    cities = np.array([[34.02, -118.49], [40.71, -74.01], [51.51, -0.13], [35.68, 139.69], [48.86, 2.35]])
+    centres = cities[rng.integers(0, len(cities), count)]
+    return centres + rng.normal(0, 0.05, (count, 2))
+
+
+def timed(fn, points):
+    start = perf_counter()
+    for latitude, longitude in points:
+        fn(latitude, longitude)
+    return (perf_counter() - start) / len(points) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=500)
+    args = parser.parse_args()
+
+    points = sessions(args.sessions)
+
+    print(f"{'method':>28} {'us/lookup':>12}")
+    # the per-message finder is slow enough that a few lookups are representative
+    print(f"{'finder per message':>28} {timed(per_message_finder, points[:20]):>12.1f}")
+
+    start = perf_counter()
+    resolver = TimeContextResolver()
+    print(f"{'resolver construction':>28} {(perf_counter() - start) * 1e6:>12.1f}")
+    print(f"{'resolver, cold cache':>28} {timed(resolver.resolve, points):>12.1f}")
+    print(f"{'resolver, warm cache':>28} {timed(resolver.resolve, points):>12.1f}")
+
+    resolver = TimeContextResolver()
+    start = perf_counter()
+    resolver.resolve_many(points)
+    print(f"{'batch, cold cache':>28} {(perf_counter() - start) / len(points) * 1e6:>12.1f}")
+    start = perf_counter()
+    resolver.resolve_many(points)
+    print(f"{'batch, warm cache':>28} {(perf_counter() - start) / len(points) * 1e6:>12.1f}")
+    print(resolver.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Microbenchmark of the MusicgenStreamer token cache: the previous per-step `torch.concatenate` against the preallocated
+buffer written in place. Only the token bookkeeping is measured, no codec decoding happens.
+
+Usage: python -m benchmarks.token_buffer
+"""
+from time import perf_counter
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from benchmarks.common import tiny_musicgen
+from musicgen_streamer import MusicgenStreamer
+
+
+DURATIONS_IN_S = (10, 30, 300)
+
+
+class ConcatTokenCache:
+    """The token cache as it was before the preallocated buffer: one allocation and full copy per step."""
+
+    def __init__(self):
+        self.token_cache = None
+
+    def put(self, value):
+        if self.token_cache is None:
+            self.token_cache = value
+        else:
+            self.token_cache = torch.concatenate([self.token_cache, value[:, None]], dim=-1)
+
+
+def feed(cache, values, pad_token_id):
+    cache.put(torch.full((values.shape[-1], 1), pad_token_id, dtype=values.dtype))
+    for value in values:
+        cache.put(value)
+
+
+def measure(make_cache, values, pad_token_id):
+    cache = make_cache()
+    start = perf_counter()
+    feed(cache, values, pad_token_id)
+    per_step_us = (perf_counter() - start) / len(values) * 1e6
+
+    # profile a second run separately so that the profiler overhead does not skew the timing
+    cache = make_cache()
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        feed(cache, values, pad_token_id)
+    allocations = [event.cpu_memory_usage for event in prof.events() if event.cpu_memory_usage > 0]
+    return per_step_us, len(allocations), sum(allocations)
+
+
+def main():
+    model = tiny_musicgen()
+    frame_rate = model.audio_encoder.config.frame_rate
+    num_codebooks = model.decoder.num_codebooks
+    pad_token_id = model.generation_config.pad_token_id
+
+    print(f"{'duration':>10} {'steps':>7} {'cache':>13} {'us/step':>9} {'allocs':>8} {'MB allocated':>13}")
+    for duration in DURATIONS_IN_S:
+        max_new_tokens = int(frame_rate * duration)
+        values = torch.randint(0, pad_token_id, (max_new_tokens, num_codebooks))
+
+        caches = {
+            "concatenate": ConcatTokenCache,
+            # play_steps past the end of the stream, so that only the token buffer is exercised
+            "preallocated": lambda: MusicgenStreamer(
+                model, play_steps=max_new_tokens + 2, max_new_tokens=max_new_tokens
+            ),
+        }
+        for name, make_cache in caches.items():
+            per_step_us, num_allocations, allocated = measure(make_cache, values, pad_token_id)
+            print(
+                f"{duration:>9}s {max_new_tokens:>7} {name:>13} {per_step_us:>9.2f} {num_allocations:>8} "
+                f"{allocated / 2**20:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import time
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from places_cache import distance_m
+from prompt_cache import context_key
+from sessions import Session
+from time_context import TimeContext
+
+CONTEXT_INPUTS = ("buildings", "weather", "time")
+
+
+class ChangeDetector:
+    """
+    Decides, tick by tick, which inputs of a session's context can have changed and whether its music prompt has to be
+    generated again.
+
+    - the nearby places are fetched again once the listener moved more than `move_fraction` of the search radius from
+      where they were last fetched, the radius changed, or they are older than `places_ttl` seconds;
+    - the weather once the listener moved more than `weather_move_m` or it is older than `weather_ttl` seconds, which
+      falls within the weather service's refresh window (`ttl - refresh_before` to `ttl`), so that a listener staying
+      still gets a cached answer and has the service renew it in the background instead of waiting on a miss;
+    - the time zone once the listener moved more than `zone_move_m`; in between, the local time is computed from the
+      known zone without asking the time agent.
+
+    The prompt is regenerated only when the context fingerprint changes: the nearest places, the weather category and
+    the part of the day, the same normalization the prompt cache is keyed on.
+    """
+
+    def __init__(
+        self,
+        places_ttl: float = 900.0,
+        weather_ttl: float = 570.0,
+        move_fraction: float = 0.5,
+        weather_move_m: float = 2500.0,
+        zone_move_m: float = 25000.0,
+    ):
+        self.places_ttl = places_ttl
+        self.weather_ttl = weather_ttl
+        self.move_fraction = move_fraction
+        self.weather_move_m = weather_move_m
+        self.zone_move_m = zone_move_m
+
+        self.ticks = 0
+        self.skipped_rounds = 0
+        self.skipped_prompts = 0
+        self.refreshed_inputs: Counter = Counter()
+
+    def moved(self, session: Session, name: str) -> float:
+        latitude, longitude, _, _ = session.refreshed[name]
+        return distance_m(latitude, longitude, session.latitude, session.longitude)
+
+    def stale(self, session: Session) -> List[str]:
+        """The inputs of the session that have to be fetched this tick."""
+        self.ticks += 1
+        now = time.monotonic()
+        stale = []
+        for name in CONTEXT_INPUTS:
+            if name not in session.refreshed:
+                stale.append(name)
+                continue
+            _, _, radius, refreshed = session.refreshed[name]
+            moved = self.moved(session, name)
+            if name == "buildings":
+                is_stale = (
+                    moved > self.move_fraction * session.radius
+                    or radius != session.radius
+                    or now - refreshed > self.places_ttl
+                )
+            elif name == "weather":
+                is_stale = moved > self.weather_move_m or now - refreshed > self.weather_ttl
+            else:
+                is_stale = moved > self.zone_move_m or session.time_context is None
+            if is_stale:
+                stale.append(name)
+        if not stale:
+            self.skipped_rounds += 1
+        return stale
+
+    def refreshed(self, session: Session, names: Iterable[str]):
+        """Records that the given inputs were fetched for the current position of the session."""
+        now = time.monotonic()
+        for name in names:
+            session.refreshed[name] = (session.latitude, session.longitude, session.radius, now)
+            self.refreshed_inputs[name] += 1
+
+    def update_time(self, session: Session):
+        """Moves the session's local time forward from its known zone."""
+        if session.time_context is not None:
+            session.time_context = TimeContext.at(session.time_context.timezone)
+
+    def changed(self, session: Session) -> Optional[str]:
+        """
+        The fingerprint of the session's context if it differs from the one its prompt was generated for, else `None`.
+        The caller stores it in `session.fingerprint` once the new prompt is in place.
+        """
+        fingerprint = context_key(session.nearby_places, session.weather, session.time_context)
+        if fingerprint == session.fingerprint:
+            self.skipped_prompts += 1
+            return None
+        return fingerprint
+
+    def stats(self) -> dict:
+        return {
+            "ticks": self.ticks,
+            "skipped_rounds": self.skipped_rounds,
+            "skipped_prompts": self.skipped_prompts,
+            "refreshed_inputs": dict(self.refreshed_inputs),
+        }
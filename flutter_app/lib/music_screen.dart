@@ -4,8 +4,10 @@ import 'package:mini_music_visualizer/mini_music_visualizer.dart';
 import 'related.dart';
 import 'package:location/location.dart';
 import 'dart:async';
+import 'dart:convert';
 import 'package:http/http.dart' as http;
 import 'package:dio/dio.dart';
+import 'package:web_socket_channel/web_socket_channel.dart';
 
 class MusicScreen extends StatefulWidget {
   const MusicScreen({Key? key}) : super(key: key);
@@ -62,6 +64,18 @@ class _MusicScreenState extends State<MusicScreen>
 
   Timer? timer;
   bool isActive = true; // flag
+  // identifies this listener to the backend so its soundscape is kept apart from other users'
+  final String sessionId =
+      math.Random.secure().nextInt(1 << 32).toRadixString(16);
+  // push channel to the backend: locations go up when they change, soundscape updates come down when they change
+  WebSocketChannel? channel;
+  // a dropped channel is reconnected after 1, 2, 4... seconds, and given up for polling after maxReconnectAttempts
+  static const int maxReconnectAttempts = 5;
+  int reconnectAttempts = 0;
+  Timer? reconnectTimer;
+  StreamSubscription<LocationData>? locationSubscription;
+  LocationData? lastSent;
+  String? musicPrompt;
 
   @override
   void initState() {
@@ -91,7 +105,109 @@ class _MusicScreenState extends State<MusicScreen>
 
     checkServerConnectivity("192.168.61.134");
 
-    startPeriodic();
+    startPush();
+  }
+
+  Future<void> startPush() async {
+    var locationService = LocationService();
+    if (!await connect()) {
+      print('Push channel unavailable, polling instead');
+      startPeriodic();
+      return;
+    }
+
+    // the first fix also asks for the permissions
+    var data = await locationService.getLocation();
+    if (data != null) {
+      sendLocation(data);
+    }
+    locationSubscription =
+        locationService.location.onLocationChanged.listen(sendLocation);
+  }
+
+  Future<bool> connect() async {
+    WebSocketChannel socket;
+    try {
+      socket = WebSocketChannel.connect(
+          Uri.parse('ws://192.168.61.134:4000/ws/sessions/$sessionId'));
+      await socket.ready;
+    } catch (error) {
+      print('Push channel failed to connect: $error');
+      return false;
+    }
+    if (!isActive || !mounted) {
+      socket.sink.close();
+      return false;
+    }
+    channel = socket;
+    reconnectAttempts = 0;
+
+    socket.stream.listen((message) {
+      var update = jsonDecode(message);
+      if (update['type'] == 'update' && mounted) {
+        setState(() {
+          musicPrompt = update['prompt'];
+        });
+      }
+    }, onError: (error) {
+      print('Push channel failed: $error');
+      reconnect();
+    }, onDone: () {
+      print('Push channel closed');
+      reconnect();
+    });
+    return true;
+  }
+
+  void reconnect() {
+    channel = null;
+    // errors are followed by the end of the stream, only one reconnection is scheduled for both
+    if (!isActive || !mounted || reconnectTimer?.isActive == true) {
+      return;
+    }
+    if (reconnectAttempts >= maxReconnectAttempts) {
+      print('Push channel lost, polling instead');
+      startPeriodic();
+      return;
+    }
+    var delay = Duration(seconds: 1 << reconnectAttempts);
+    reconnectAttempts++;
+    reconnectTimer = Timer(delay, () async {
+      if (!await connect()) {
+        reconnect();
+        return;
+      }
+      // the backend only hears about moves, so it is told where the listener is as soon as it is back
+      var last = lastSent;
+      lastSent = null;
+      if (last != null) {
+        sendLocation(last);
+      }
+    });
+  }
+
+  void sendLocation(LocationData data) {
+    if (!isActive || data.latitude == null || data.longitude == null) {
+      return;
+    }
+    // only moves of a few metres are worth a message
+    if (lastSent != null && distanceInMetres(lastSent!, data) < 5.0) {
+      return;
+    }
+    lastSent = data;
+    channel?.sink.add(jsonEncode({
+      'latitude': data.latitude,
+      'longitude': data.longitude,
+      'radius': 10.0,
+    }));
+  }
+
+  double distanceInMetres(LocationData a, LocationData b) {
+    const earthRadius = 6371000.0;
+    var latitude = (a.latitude! + b.latitude!) / 2 * math.pi / 180;
+    var dx = (b.longitude! - a.longitude!) * math.pi / 180 * math.cos(latitude);
+    var dy = (b.latitude! - a.latitude!) * math.pi / 180;
+    return math.sqrt(dx * dx + dy * dy) * earthRadius;
   }
 
   Future<void> checkServerConnectivity(String serverIP) async {
@@ -114,7 +230,7 @@ class _MusicScreenState extends State<MusicScreen>
   }
 
   void startPeriodic() {
-    Timer.periodic(Duration(seconds: 5), (Timer timer) async {
+    timer = Timer.periodic(Duration(seconds: 5), (Timer timer) async {
       if (isActive) {
         try {
           var data = await LocationService().getLocation();
@@ -129,6 +245,7 @@ class _MusicScreenState extends State<MusicScreen>
           var response = await dio.post(
             'http://192.168.61.134:4000/api/location',
             data: {
+              'session_id': sessionId,
               'latitude': data?.latitude.toString(),
               'longitude': data?.longitude.toString(),
               'radius': '10.0',
@@ -137,7 +254,7 @@ class _MusicScreenState extends State<MusicScreen>
           print(response);
           if (mounted) {
             setState(() {
-              print("hi");
+              musicPrompt = response.data['prompt'];
             });
           }
         } catch (error) {
@@ -156,7 +273,10 @@ class _MusicScreenState extends State<MusicScreen>
   void dispose() {
     _animationController.dispose();
     _wavyAnimationController.dispose();
-    // timer?.cancel();
+    timer?.cancel();
+    reconnectTimer?.cancel();
+    locationSubscription?.cancel();
+    channel?.sink.close();
     super.dispose();
   }
 
@@ -201,6 +321,23 @@ class _MusicScreenState extends State<MusicScreen>
             ),
             body: Stack(
               children: [
+                if (musicPrompt != null)
+                  Positioned(
+                    top: MediaQuery.of(context).size.height * 0.05,
+                    left: MediaQuery.of(context).size.width * 0.1,
+                    right: MediaQuery.of(context).size.width * 0.1,
+                    child: Text(
+                      musicPrompt!,
+                      textAlign: TextAlign.center,
+                      maxLines: 3,
+                      overflow: TextOverflow.ellipsis,
+                      style: TextStyle(
+                        fontFamily: 'ProductSans',
+                        fontSize: 16,
+                        color: Colors.black87,
+                      ),
+                    ),
+                  ),
                 Positioned(
                   top: MediaQuery.of(context).size.height * 0.2,
                   left: 0,
@@ -0,0 +1,96 @@
+"""
+The MusicGen generation stack shared by the Gradio demo (`app.py`) and the FastAPI backend: the model registry, the
+track archive, and `stream_chunks`, which replays a prompt from the archive or generates it.
+"""
+import os
+
+from transformers import MusicgenConfig, MusicgenProcessor
+
+from batching import GenerationBatcher
+from model_registry import ModelRegistry, load_musicgen
+from quantization import OUTPUT_DIR, load_quantized_model
+from track_archive import TrackArchive
+from worker_pool import GenerationWorkerPool
+
+
+model_id = "facebook/musicgen-small"
+# the codec rates come from the config, so that nothing heavy is loaded before it is needed
+config = MusicgenConfig.from_pretrained(model_id)
+sampling_rate = config.audio_encoder.sampling_rate
+frame_rate = config.audio_encoder.frame_rate
+
+track_archive = TrackArchive()
+
+registry = ModelRegistry()
+registry.register("musicgen", lambda: load_musicgen(model_id))
+registry.register("processor", lambda: MusicgenProcessor.from_pretrained(model_id))
+# INT8 decoder produced by `python quantization.py quantize` with Intel® Neural Compressor
+registry.register("musicgen-int8", lambda: load_quantized_model(model_id, OUTPUT_DIR))
+registry.register("batcher-fp32", lambda: GenerationBatcher(registry.get("musicgen"), registry.get("processor")))
+registry.register("batcher-int8", lambda: GenerationBatcher(registry.get("musicgen-int8"), registry.get("processor")))
+# with SOUNDSCAPE_WORKERS set, fp32 requests run in forked worker processes instead of the in-process batcher, started
+# by `start_workers`
+num_workers = int(os.environ.get("SOUNDSCAPE_WORKERS", "0"))
+registry.register(
+    "pool-fp32", lambda: GenerationWorkerPool(registry.get("musicgen"), registry.get("processor"), num_workers)
+)
+
+backends = ["fp32", "int8"] if os.path.isdir(OUTPUT_DIR) else ["fp32"]
+# what serves fp32 requests, for callers that want it loaded before the first one
+generator_name = "pool-fp32" if num_workers else "batcher-fp32"
+
+
+class BackendUnavailableError(ValueError):
+    pass
+
+
+def start_workers():
+    """
+    Loads the model and forks the worker pool if `SOUNDSCAPE_WORKERS` is set, a no-op otherwise. To be called once at
+    startup, before the process starts any other thread or runs any inference: forking after that can hang the workers,
+    so the pool is never created lazily on a request.
+    """
+    if num_workers:
+        registry.get("pool-fp32")
+
+
+def track_id(text_prompt, max_new_tokens, play_steps, seed, backend="fp32"):
+    """The name of the track a generation is archived under."""
+    backend_model_id = model_id if backend == "fp32" else f"{model_id}-{backend}"
+    return track_archive.key(backend_model_id, text_prompt, seed, max_new_tokens / frame_rate, play_steps)
+
+
+def archived_chunks(key, play_steps):
+    """Decodes an archived track `play_steps` frames at a time, the codec is the same for every backend."""
+    return track_archive.stream(key, registry.get("musicgen").audio_encoder, play_steps)
+
+
+def stream_chunks(text_prompt, max_new_tokens, play_steps, seed, backend="fp32"):
+    """
+    Yields the audio chunks for a prompt, decoding them from the track archive if they were generated before.
+    Raises `BackendUnavailableError` for a backend that is not set up, and `PoolBusyError` when the worker pool is full.
+    """
+    if backend not in backends:
+        raise BackendUnavailableError(
+            f"The {backend} backend is not available, run `python quantization.py quantize` first."
+        )
+    backend_model_id = model_id if backend == "fp32" else f"{model_id}-{backend}"
+
+    key = track_id(text_prompt, max_new_tokens, play_steps, seed, backend)
+    archived = track_archive.get(key)
+    print(f"Track archive {'hit' if archived is not None else 'miss'}: {track_archive.stats()}")
+    if archived is not None:
+        yield from archived_chunks(key, play_steps)
+        return
+
+    if num_workers and backend == "fp32":
+        if not registry.loaded("pool-fp32"):
+            raise BackendUnavailableError("The generation workers are not running, call `start_workers()` at startup.")
+        streamer = registry.get("pool-fp32").submit(text_prompt, max_new_tokens, play_steps, seed=seed)
+    else:
+        batcher = registry.get(f"batcher-{backend}")
+        streamer = batcher.submit(text_prompt, max_new_tokens, play_steps, seed=seed, incremental=True)
+    yield from streamer
+    track_archive.save(
+        key, streamer.audio_codes(), frame_rate, sampling_rate, model_id=backend_model_id, prompt=text_prompt, seed=seed
+    )
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import random
+from typing import Any, Dict, Optional
+
+import httpx
+
+# statuses worth another try: rate limiting and transient upstream failures
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# the upstreams can be pointed at a local stub server for testing
+PLACES_URL = os.environ.get("SOUNDSCAPE_PLACES_URL", "https://maps.googleapis.com")
+WEATHER_URL = os.environ.get("SOUNDSCAPE_WEATHER_URL", "https://api.openweathermap.org")
+
+
+class HTTPClient:
+    """
+    Shared async HTTP client for the upstream APIs of the agents. Connections are pooled and kept alive across calls,
+    every call has a timeout, transient failures are retried with exponential backoff and full jitter, and at most
+    `max_concurrency` calls are in flight at once so a burst of sessions cannot flood an upstream.
+
+    The underlying `httpx.AsyncClient` and the semaphore are created on first use, so they belong to the event loop
+    the agents run on.
+    """
+
+    def __init__(
+        self,
+        base_url: str = "",
+        timeout: float = 5.0,
+        retries: int = 2,
+        backoff: float = 0.25,
+        max_concurrency: int = 16,
+        max_connections: int = 32,
+        max_keepalive: int = 16,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._limit: Optional[asyncio.Semaphore] = None
+
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            self._limit = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def get_json(self, path: str, params: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None) -> Any:
+        """
+        GETs `path` and returns the decoded JSON body. Raises `httpx.HTTPError` once the retries are used up, or
+        straight away for a status that is not worth retrying.
+        """
+        return await self.request_json("GET", path, params=params, timeout=timeout)
+
+    async def post_json(
+        self, path: str, body: Any, headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None
+    ) -> Any:
+        """POSTs `body` as JSON to `path` and returns the decoded JSON reply, retrying like `get_json`."""
+        return await self.request_json("POST", path, body=body, headers=headers, timeout=timeout)
+
+    async def request_json(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Any = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        client = self.client
+        for attempt in range(self.retries + 1):
+            self.requests += 1
+            try:
+                async with self._limit:
+                    response = await client.request(
+                        method, path, params=params, json=body, headers=headers, timeout=timeout or self.timeout
+                    )
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response.json()
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    self.failures += 1
+                    raise
+            except httpx.HTTPStatusError:
+                self.failures += 1
+                raise
+            self.retried += 1
+            await asyncio.sleep(random.uniform(0, self.backoff * 2**attempt))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "retried": self.retried, "failures": self.failures}
+
+
+places_client = HTTPClient(PLACES_URL)
+weather_client = HTTPClient(WEATHER_URL)
+
+
+async def places_nearby(api_key: str, latitude: float, longitude: float, radius: float) -> dict:
+    """Google Places Nearby Search; returns the same response as `googlemaps.Client.places_nearby`."""
+    return await places_client.get_json(
+        "/maps/api/place/nearbysearch/json",
+        params={
+            "location": f"{latitude},{longitude}",
+            "radius": radius,
+            # Keyword or category filtering can be added here (optional)
+            "type": "point_of_interest",
+            "key": api_key,
+        },
+    )
+
+
+async def current_weather(api_key: str, latitude: float, longitude: float) -> str:
+    """Returns the OpenWeather description of the current weather at a location, e.g. "light rain"."""
+    weather_data = await weather_client.get_json(
+        "/data/2.5/weather",
+        params={"lat": latitude, "lon": longitude, "appid": api_key, "units": "metric"},
+    )
+    return weather_data["weather"][0]["description"]
@@ -0,0 +1,116 @@
+"""
+Long-form generation with audiocraft's MusicGen in fixed-length windows. Each window is conditioned on the codes of the
+tail of the previous one and can switch to the next segment's text prompt; its audio is written to disk as soon as it is
+decoded. Attention cost, the KV cache and the audio held in memory are therefore bounded by the window length, whatever
+the total duration.
+"""
+import re
+from typing import List, Optional
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from audio_output import StreamingLoudnessNormalizer
+
+
+# ordinal markers of the "FIRSTLY ..., SECONDLY - ..., THIRD: ..." structured prompts
+SEGMENT_MARKER = re.compile(
+    r"\b(?:FIRST|SECOND|THIRD|FOURTH|FIFTH|SIXTH|SEVENTH|EIGHTH|NINTH|TENTH)(?:LY)?\b\s*[-:]*\s*"
+)
+
+
+def split_segments(description: str) -> List[str]:
+    """
+    Splits a description structured as "... FIRSTLY <a>, SECONDLY - <b>, ..." into the prompts of its segments. The text
+    before the first marker only describes the structure and is dropped. A description without markers is one segment.
+    """
+    parts = SEGMENT_MARKER.split(description)
+    if len(parts) == 1:
+        return [description]
+    segments = [part.strip(" ,.*") for part in parts[1:]]
+    return [segment for segment in segments if segment]
+
+
+def generate_longform(
+    model,
+    prompts: List[str],
+    duration: float,
+    path: str,
+    window: float = 30.0,
+    context: float = 10.0,
+    segment_duration: Optional[float] = None,
+    fade: float = 0.05,
+    normalize: bool = True,
+) -> torch.Tensor:
+    """
+    Generates `duration` seconds of audio with `model` (an audiocraft `MusicGen`) and writes it to `path` window by
+    window.
+    Parameters:
+        prompts (`List[str]`):
+            The text prompt of each segment, in order. The window starting at time `t` uses the prompt of the segment
+            `t` falls in.
+        duration (`float`):
+            The total duration to generate, in seconds.
+        path (`str`):
+            The audio file the windows are appended to.
+        window (`float`, *optional*, defaults to 30.0):
+            The length of each generation window, context included, in seconds. At most MusicGen's 30 s training length.
+        context (`float`, *optional*, defaults to 10.0):
+            How much of the tail of the previous window each window is conditioned on, in seconds.
+        segment_duration (`float`, *optional*):
+            The duration of each segment. If `None`, the duration is split evenly between the prompts.
+        fade (`float`, *optional*, defaults to 0.05):
+            The length of the cross-fade between consecutive windows, in seconds.
+        normalize (`bool`, *optional*, defaults to `True`):
+            Whether to normalize the loudness of the output as it is written, see `StreamingLoudnessNormalizer`.
+    Returns the codes of the whole track, `(num_codebooks, frames)`, which are small enough to keep.
+    """
+    frame_rate = model.frame_rate
+    sample_rate = model.sample_rate
+    hop_length = sample_rate // frame_rate
+    total_frames = int(duration * frame_rate)
+    context_frames = int(context * frame_rate)
+    fade_samples = min(int(fade * sample_rate), context_frames * hop_length)
+    segment_duration = segment_duration if segment_duration is not None else duration / len(prompts)
+
+    model.set_generation_params(duration=window)
+    normalizer = StreamingLoudnessNormalizer(sample_rate) if normalize else None
+
+    codes = []
+    prompt_tokens = None
+    held_audio = None
+    generated = 0
+    with sf.SoundFile(path, "w", samplerate=sample_rate, channels=model.audio_channels) as outfile:
+        while generated < total_frames:
+            description = prompts[min(int(generated / frame_rate // segment_duration), len(prompts) - 1)]
+            with torch.no_grad():
+                attributes, _ = model._prepare_tokens_and_attributes([description], None)
+                # the generated tokens start with the prompt tokens
+                tokens = model._generate_tokens(attributes, prompt_tokens)
+                start = 0 if prompt_tokens is None else prompt_tokens.shape[-1]
+                new_frames = min(tokens.shape[-1] - start, total_frames - generated)
+                # decode the context frames too, so that the new audio is decoded with its left context
+                audio = model.compression_model.decode(tokens[..., : start + new_frames])
+
+            audio = audio[0, :, start * hop_length - (fade_samples if held_audio is not None else 0) :]
+            audio = audio.cpu().float().numpy().T
+            if held_audio is not None:
+                ramp = np.linspace(0.0, 1.0, fade_samples, dtype=audio.dtype)[:, None]
+                audio[:fade_samples] = held_audio * (1.0 - ramp) + audio[:fade_samples] * ramp
+
+            generated += new_frames
+            if generated < total_frames and fade_samples > 0:
+                held_audio = audio[-fade_samples:]
+                audio = audio[:-fade_samples]
+            if normalizer is not None:
+                audio = normalizer.process(audio)
+            outfile.write(np.clip(audio, -1.0, 1.0))
+
+            codes.append(tokens[0, :, start : start + new_frames].cpu().to(torch.int16))
+            prompt_tokens = tokens[..., start + new_frames - context_frames : start + new_frames]
+
+        if normalizer is not None:
+            outfile.write(normalizer.flush())
+
+    return torch.cat(codes, dim=-1)
@@ -0,0 +1,92 @@
+import os
+import time
+from threading import Lock, Thread
+from typing import Any, Callable, Dict
+
+import torch
+
+from transformers import MusicgenForConditionalGeneration
+
+
+def current_rss_mb() -> float:
+    """The resident memory of this process, from /proc (Linux only, 0 elsewhere)."""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def module_size_mb(module) -> float:
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) / 2**20
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Holds the long-lived heavy objects of the app (models, processors, chatbots, batchers). Each one is built by its
+        loader the first time it is asked for, exactly once even under concurrent requests, and the same ready-to-use
+        handle is returned from then on, so nothing heavy is rebuilt per request.
+        """
+        self.loaders: Dict[str, Callable[[], Any]] = {}
+        self.handles: Dict[str, Any] = {}
+        self.load_stats: Dict[str, Dict[str, float]] = {}
+        self.locks: Dict[str, Lock] = {}
+
+    def register(self, name: str, loader: Callable[[], Any]):
+        self.loaders[name] = loader
+        self.locks[name] = Lock()
+
+    def get(self, name: str):
+        if name in self.handles:
+            return self.handles[name]
+
+        with self.locks[name]:
+            if name not in self.handles:
+                rss_before = current_rss_mb()
+                start = time.perf_counter()
+                handle = self.loaders[name]()
+                load_s = time.perf_counter() - start
+
+                memory_mb = current_rss_mb() - rss_before
+                if isinstance(handle, torch.nn.Module):
+                    memory_mb = module_size_mb(handle)
+                self.load_stats[name] = {"load_s": load_s, "memory_mb": memory_mb}
+                print(f"Loaded {name} in {load_s:.1f}s ({memory_mb:.0f} MB)")
+                self.handles[name] = handle
+        return self.handles[name]
+
+    def loaded(self, name: str) -> bool:
+        return name in self.handles
+
+    def preload(self, *names: str):
+        """Loads the given handles in a background thread."""
+
+        def load():
+            for name in names:
+                self.get(name)
+
+        Thread(target=load, daemon=True).start()
+
+    def stats(self):
+        return dict(self.load_stats)
+
+
+def default_device() -> str:
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def load_musicgen(model_id: str, device: str = None):
+    """Loads MusicGen once with its device placement and dtype, optimized with IPEX when running on an Intel CPU."""
+    device = device if device is not None else default_device()
+    dtype = torch.float16 if device.startswith("cuda") else torch.float32
+    model = MusicgenForConditionalGeneration.from_pretrained(model_id, torch_dtype=dtype).to(device).eval()
+
+    if device == "cpu":
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError:
+            return model
+        model = ipex.optimize(model, dtype=dtype, inplace=True)
+    return model
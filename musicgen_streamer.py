@@ -0,0 +1,243 @@
+from queue import Queue
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from transformers import MusicgenForConditionalGeneration
+from transformers.generation.streamers import BaseStreamer
+
+
+class MusicgenStreamer(BaseStreamer):
+    def __init__(
+        self,
+        model: MusicgenForConditionalGeneration,
+        device: Optional[str] = None,
+        play_steps: Optional[int] = 10,
+        stride: Optional[int] = None,
+        timeout: Optional[float] = None,
+        incremental: bool = False,
+        overlap_steps: Optional[int] = None,
+        max_new_tokens: Optional[int] = None,
+    ):
+        """
+        Streamer that stores playback-ready audio in a queue, to be used by a downstream application as an iterator. This is
+        useful for applications that benefit from accessing the generated audio in a non-blocking way (e.g. in an interactive
+        Gradio demo).
+        Parameters:
+            model (`MusicgenForConditionalGeneration`):
+                The MusicGen model used to generate the audio waveform.
+            device (`str`, *optional*):
+                The torch device on which to run the computation. If `None`, will default to the device of the model.
+            play_steps (`int`, *optional*, defaults to 10):
+                The number of generation steps with which to return the generated audio array. Using fewer steps will 
+                mean the first chunk is ready faster, but will require more codec decoding steps overall. This value 
+                should be tuned to your device and latency requirements.
+            stride (`int`, *optional*):
+                The window (stride) between adjacent audio samples. Using a stride between adjacent audio samples reduces
+                the hard boundary between them, giving smoother playback. If `None`, will default to a value equivalent to 
+                play_steps // 6 in the audio space.
+            timeout (`int`, *optional*):
+                The timeout for the audio queue. If `None`, the queue will block indefinitely. Useful to handle exceptions
+                in `.generate()`, when it is called in a separate thread.
+            incremental (`bool`, *optional*, defaults to `False`):
+                Whether to only decode the frames generated since the last chunk (plus `overlap_steps` frames of left
+                context) instead of re-decoding the whole token history at every `play_steps` boundary. The seam with
+                the previous chunk is cross-faded over `stride` samples, so the decode cost per chunk stays constant
+                regardless of the stream length.
+            overlap_steps (`int`, *optional*):
+                The number of already-played frames re-decoded as left context in incremental mode. More overlap gives
+                output closer to a full re-decode at a higher cost per chunk. If `None`, will default to `play_steps`.
+            max_new_tokens (`int`, *optional*):
+                The `max_new_tokens` passed to `.generate()`. Used to size the token buffer up front so that each
+                generation step is written in place. If `None`, the buffer starts small and doubles when full.
+        """
+        self.decoder = model.decoder
+        self.audio_encoder = model.audio_encoder
+        self.generation_config = model.generation_config
+        self.device = device if device is not None else model.device
+
+        # variables used in the streaming process
+        self.play_steps = play_steps
+        if stride is not None:
+            self.stride = stride
+        else:
+            hop_length = np.prod(self.audio_encoder.config.upsampling_ratios)
+            self.stride = hop_length * (play_steps - self.decoder.num_codebooks) // 6
+        self.token_buffer = None
+        self.num_steps = 0
+        self.max_new_tokens = max_new_tokens
+        self.to_yield = 0
+
+        # variables used in the incremental decoding process
+        self.incremental = incremental
+        self.hop_length = int(np.prod(self.audio_encoder.config.upsampling_ratios))
+        self.overlap_steps = overlap_steps if overlap_steps is not None else play_steps
+        self.held_audio = None
+
+        # varibles used in the thread process
+        self.audio_queue = Queue()
+        self.stop_signal = None
+        self.timeout = timeout
+        self.finished = False
+
+    @property
+    def token_cache(self):
+        """A view of the tokens generated so far, with shape `(num_codebooks, num_steps)`."""
+        if self.token_buffer is None:
+            return None
+        return self.token_buffer[:, : self.num_steps]
+
+    def write_tokens(self, tokens):
+        """Writes `tokens` of shape `(num_codebooks, steps)` into the token buffer, growing it only if it is full."""
+        steps = tokens.shape[-1]
+        if self.token_buffer is None:
+            capacity = steps + (self.max_new_tokens if self.max_new_tokens is not None else self.play_steps)
+            self.token_buffer = tokens.new_empty((tokens.shape[0], capacity))
+        elif self.num_steps + steps > self.token_buffer.shape[-1]:
+            token_buffer = self.token_buffer.new_empty((tokens.shape[0], 2 * self.token_buffer.shape[-1]))
+            token_buffer[:, : self.num_steps] = self.token_buffer[:, : self.num_steps]
+            self.token_buffer = token_buffer
+
+        self.token_buffer[:, self.num_steps : self.num_steps + steps] = tokens
+        self.num_steps += steps
+
+    def apply_delay_pattern_mask(self, input_ids):
+        # build the delay pattern mask for offsetting each codebook prediction by 1 (this behaviour is specific to MusicGen)
+        _, decoder_delay_pattern_mask = self.decoder.build_delay_pattern_mask(
+            input_ids[:, :1],
+            pad_token_id=self.generation_config.decoder_start_token_id,
+            max_length=input_ids.shape[-1],
+        )
+        # apply the pattern mask to the input ids
+        input_ids = self.decoder.apply_delay_pattern_mask(input_ids, decoder_delay_pattern_mask)
+
+        # revert the pattern delay mask by filtering the pad token id
+        input_ids = input_ids[input_ids != self.generation_config.pad_token_id].reshape(
+            1, self.decoder.num_codebooks, -1
+        )
+
+        return self.decode_codes(input_ids)
+
+    def decode_codes(self, audio_codes):
+        # append the frame dimension back to the audio codes
+        audio_codes = audio_codes[None, ...]
+
+        # send the audio codes to the correct device
+        audio_codes = audio_codes.to(self.audio_encoder.device)
+
+        output_values = self.audio_encoder.decode(
+            audio_codes,
+            audio_scales=[None],
+        )
+        audio_values = output_values.audio_values[0, 0]
+        return audio_values.cpu().float().numpy()
+
+    @property
+    def num_frames(self):
+        """The number of frames for which every codebook has been generated."""
+        return max(0, self.num_steps - self.decoder.num_codebooks)
+
+    def audio_codes(self, start_frame: int = 0, end_frame: Optional[int] = None):
+        """Returns the codes of frames `start_frame` to `end_frame` with the delay pattern undone, as `(num_codebooks, frames)`."""
+        end_frame = self.num_frames if end_frame is None else end_frame
+        # frame `f` of codebook `k` was generated at step `f + k + 1`
+        return torch.stack(
+            [self.token_cache[k, start_frame + k + 1 : end_frame + k + 1] for k in range(self.decoder.num_codebooks)]
+        )
+
+    def decode_window(self):
+        """Decodes the audio from `to_yield` onwards, using only a bounded window of frames from the token cache."""
+        if self.num_frames == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        start_frame = max(0, self.to_yield // self.hop_length - self.overlap_steps)
+        audio_values = self.decode_codes(self.audio_codes(start_frame)[None, ...])
+        audio_values = audio_values[self.to_yield - start_frame * self.hop_length :]
+
+        # cross-fade with the tail of the previous window that was held back
+        if self.held_audio is not None:
+            fade = min(len(self.held_audio), len(audio_values))
+            ramp = np.linspace(0.0, 1.0, fade, dtype=audio_values.dtype)
+            audio_values[:fade] = self.held_audio[:fade] * (1.0 - ramp) + audio_values[:fade] * ramp
+        return audio_values
+
+    def put(self, value):
+        batch_size = value.shape[0] // self.decoder.num_codebooks
+        if batch_size > 1:
+            raise ValueError("MusicgenStreamer only supports batch size 1")
+
+        self.write_tokens(value if value.dim() == 2 else value[:, None])
+
+        if self.num_steps % self.play_steps == 0:
+            if self.incremental:
+                audio_values = self.decode_window()
+                if len(audio_values) > self.stride:
+                    self.on_finalized_audio(audio_values[: -self.stride])
+                    self.held_audio = audio_values[-self.stride :]
+                    self.to_yield += len(audio_values) - self.stride
+                return
+
+            audio_values = self.apply_delay_pattern_mask(self.token_cache)
+            self.on_finalized_audio(audio_values[self.to_yield : -self.stride])
+            self.to_yield += len(audio_values) - self.to_yield - self.stride
+
+    def end(self):
+        """Flushes any remaining cache and appends the stop symbol."""
+        if self.token_cache is not None and self.incremental:
+            self.on_finalized_audio(self.decode_window(), stream_end=True)
+            return
+
+        if self.token_cache is not None:
+            audio_values = self.apply_delay_pattern_mask(self.token_cache)
+        else:
+            audio_values = np.zeros(self.to_yield)
+
+        self.on_finalized_audio(audio_values[self.to_yield :], stream_end=True)
+
+    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False):
+        """Put the new audio in the queue. If the stream is ending, also put a stop signal in the queue."""
+        self.audio_queue.put(audio, timeout=self.timeout)
+        if stream_end:
+            self.finished = True
+            self.audio_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.audio_queue.get(timeout=self.timeout)
+        if not isinstance(value, np.ndarray) and value == self.stop_signal:
+            raise StopIteration()
+        else:
+            return value
+
+
+class BatchedMusicgenStreamer(BaseStreamer):
+    def __init__(self, streamers: List[MusicgenStreamer]):
+        """
+        Streamer for a batched `.generate()` call, which splits the codes of each step per batch element and forwards
+        them to that element's own `MusicgenStreamer`, so every request reads its audio from its own queue.
+        Parameters:
+            streamers (`List[MusicgenStreamer]`):
+                One streamer per batch element, in the same order as the prompts passed to `.generate()`. A streamer
+                with a `max_new_tokens` shorter than the batch is ended as soon as it has received that many steps.
+        """
+        self.streamers = streamers
+        self.num_codebooks = streamers[0].decoder.num_codebooks
+
+    def put(self, value):
+        values = value.reshape(len(self.streamers), self.num_codebooks, *value.shape[1:])
+        for streamer, streamer_value in zip(self.streamers, values):
+            if streamer.finished:
+                continue
+            streamer.put(streamer_value)
+            # the first step holds the decoder start tokens, every following step is a new token
+            if streamer.max_new_tokens is not None and streamer.num_steps > streamer.max_new_tokens:
+                streamer.end()
+
+    def end(self):
+        """Ends every streamer that has not already been ended."""
+        for streamer in self.streamers:
+            if not streamer.finished:
+                streamer.end()
@@ -0,0 +1,386 @@
+import asyncio
+import os
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, AsyncMongoClient, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from time_context import TimeContext
+
+# the `db` service of docker-compose.yml, or a local mongod
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+MONGO_DATABASE = os.environ.get("MONGO_DATABASE", "soundscape")
+
+# nearest places kept with a resolved context, as many as its prompt was generated from
+PLACES_PER_CONTEXT = 3
+
+POINT = {
+    "bsonType": "object",
+    "required": ["type", "coordinates"],
+    "properties": {"type": {"enum": ["Point"]}, "coordinates": {"bsonType": "array", "minItems": 2, "maxItems": 2}},
+}
+
+# $jsonSchema validators of the collections; documents that do not match are rejected by the server
+SCHEMAS = {
+    "sessions": {
+        "bsonType": "object",
+        "required": ["_id", "location", "radius", "updated_at"],
+        "properties": {
+            "_id": {"bsonType": "string"},
+            "location": POINT,
+            "radius": {"bsonType": "double"},
+            "prompt": {"bsonType": "string"},
+            "updated_at": {"bsonType": "date"},
+        },
+    },
+    "contexts": {
+        "bsonType": "object",
+        "required": ["session_id", "created_at", "location", "fingerprint"],
+        "properties": {
+            "session_id": {"bsonType": "string"},
+            "created_at": {"bsonType": "date"},
+            "location": POINT,
+            "fingerprint": {"bsonType": "string"},
+            "places": {"bsonType": "array"},
+            "weather": {"bsonType": "string"},
+            "time": {"bsonType": ["object", "null"]},
+        },
+    },
+    "prompts": {
+        "bsonType": "object",
+        "required": ["session_id", "created_at", "location", "prompt"],
+        "properties": {
+            "session_id": {"bsonType": "string"},
+            "created_at": {"bsonType": "date"},
+            "location": POINT,
+            "prompt": {"bsonType": "string"},
+            "fingerprint": {"bsonType": ["string", "null"]},
+        },
+    },
+    "tracks": {
+        "bsonType": "object",
+        "required": ["_id", "session_id", "created_at", "prompt"],
+        "properties": {
+            "_id": {"bsonType": "string"},
+            "session_id": {"bsonType": "string"},
+            "created_at": {"bsonType": "date"},
+            "location": POINT,
+            "prompt": {"bsonType": "string"},
+            "duration": {"bsonType": "double"},
+            "seed": {"bsonType": ["int", "long"]},
+            "backend": {"bsonType": "string"},
+            "weather": {"bsonType": "string"},
+            "time_bucket": {"bsonType": "string"},
+        },
+    },
+}
+
+
+def point(latitude: float, longitude: float) -> dict:
+    """GeoJSON point of a location, as the 2dsphere indexes expect it (longitude first)."""
+    return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+
+
+def now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class Persistence:
+    """
+    MongoDB store of the sessions, the contexts they were resolved to, the prompts generated for them and the tracks
+    generated from those, on the async driver with one pooled client.
+
+    The `record_*` methods only queue the write and return straight away, a background task sends the queue in
+    `bulk_write` batches of up to `batch_size`, at least every `flush_interval` seconds. Location updates of the same
+    session within a batch are merged into one upsert. While the database is unreachable the writes wait in the queue,
+    and once `max_queue` are waiting new ones are dropped, so a database outage never slows down a request.
+
+    `start` and the `record_*` methods must be called on the event loop the store is used from.
+    """
+
+    def __init__(
+        self,
+        url: str = MONGO_URL,
+        database: str = MONGO_DATABASE,
+        session_ttl: float = 24 * 3600.0,
+        batch_size: int = 500,
+        flush_interval: float = 0.5,
+        max_queue: int = 10000,
+        max_pool_size: int = 20,
+        retry_interval: float = 5.0,
+    ):
+        self.url = url
+        self.database = database
+        self.session_ttl = session_ttl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_pool_size = max_pool_size
+        self.retry_interval = retry_interval
+
+        self.client: Optional[AsyncMongoClient] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.flusher: Optional[asyncio.Task] = None
+        self.ready = False
+
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failures = 0
+
+    @property
+    def db(self):
+        return self.client[self.database]
+
+    async def start(self):
+        """Connects and starts the background writer. Safe to call more than once, e.g. by a Bureau running in-process."""
+        if self.flusher is not None:
+            return
+        # connecting is lazy, so this does not wait for the server
+        self.client = AsyncMongoClient(
+            self.url, maxPoolSize=self.max_pool_size, serverSelectionTimeoutMS=5000, tz_aware=True
+        )
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.flusher = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Writes what is still queued and closes the client."""
+        if self.flusher is None:
+            return
+        # the writer writes out the batch it holds and the rest of the queue before it stops
+        self.flusher.cancel()
+        try:
+            await self.flusher
+        except asyncio.CancelledError:
+            pass
+        await self.client.close()
+        self.flusher = None
+        self.ready = False
+
+    async def ensure_schema(self):
+        """Creates the collections with their validators, or updates the validators, and builds the indexes."""
+        existing = set(await self.db.list_collection_names())
+        for name, schema in SCHEMAS.items():
+            validator = {"$jsonSchema": schema}
+            if name in existing:
+                await self.db.command("collMod", name, validator=validator)
+            else:
+                await self.db.create_collection(name, validator=validator)
+
+        # sessions disappear once they have not moved for session_ttl
+        await self.db.sessions.create_index("updated_at", expireAfterSeconds=int(self.session_ttl))
+        await self.db.sessions.create_index([("location", GEOSPHERE)])
+        # the history of a session, newest first
+        for name in ("contexts", "prompts", "tracks"):
+            await self.db[name].create_index([("session_id", ASCENDING), ("created_at", DESCENDING)])
+            await self.db[name].create_index([("location", GEOSPHERE)])
+        await self.db.contexts.create_index("fingerprint")
+        # newest tracks first, to rebuild the backend's index of tracks by location at startup
+        await self.db.tracks.create_index([("created_at", DESCENDING)])
+
+    def enqueue(self, collection: str, key: Optional[str], fields: dict):
+        """Queues an insert of `fields`, or with a `key` an upsert of them into the document with that `_id`."""
+        if self.queue is None:
+            return
+        try:
+            self.queue.put_nowait((collection, key, fields))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def record_session(
+        self, session_id: str, latitude: float, longitude: float, radius: float, music_prompt: Optional[str] = None
+    ):
+        fields = {"location": point(latitude, longitude), "radius": float(radius), "updated_at": now()}
+        if music_prompt:
+            fields["prompt"] = music_prompt
+        self.enqueue("sessions", session_id, fields)
+
+    def record_context(
+        self,
+        session_id: str,
+        latitude: float,
+        longitude: float,
+        fingerprint: str,
+        nearby_places: Optional[dict],
+        weather: str,
+        time_context: Optional[TimeContext],
+    ):
+        places = [
+            {"place_id": place.get("place_id"), "name": place.get("name"), "types": place.get("types", [])}
+            for place in (nearby_places or {}).get("results", [])[:PLACES_PER_CONTEXT]
+        ]
+        self.enqueue(
+            "contexts",
+            None,
+            {
+                "session_id": session_id,
+                "created_at": now(),
+                "location": point(latitude, longitude),
+                "fingerprint": fingerprint,
+                "places": places,
+                "weather": weather,
+                "time": asdict(time_context) if time_context is not None else None,
+            },
+        )
+
+    def record_prompt(
+        self, session_id: str, latitude: float, longitude: float, music_prompt: str, fingerprint: Optional[str] = None
+    ):
+        self.enqueue(
+            "prompts",
+            None,
+            {
+                "session_id": session_id,
+                "created_at": now(),
+                "location": point(latitude, longitude),
+                "prompt": music_prompt,
+                "fingerprint": fingerprint,
+            },
+        )
+
+    def record_track(
+        self,
+        track_id: str,
+        session_id: str,
+        music_prompt: str,
+        duration: float,
+        seed: int,
+        backend: str = "fp32",
+        location: Optional[Tuple[float, float]] = None,
+        weather: str = "",
+        time_bucket: str = "",
+    ):
+        fields = {
+            "session_id": session_id,
+            "created_at": now(),
+            "prompt": music_prompt,
+            "duration": float(duration),
+            "seed": int(seed),
+            "backend": backend,
+            "weather": weather,
+            "time_bucket": time_bucket,
+        }
+        if location is not None:
+            fields["location"] = point(*location)
+        self.enqueue("tracks", track_id, fields)
+
+    @staticmethod
+    def take(*records) -> Dict[str, list]:
+        """Turns queued records into bulk operations per collection, merging the upserts of the same document."""
+        inserts: Dict[str, list] = {}
+        upserts: Dict[Tuple[str, str], dict] = {}
+        for collection, key, fields in records:
+            if key is None:
+                inserts.setdefault(collection, []).append(InsertOne(fields))
+            else:
+                upserts.setdefault((collection, key), {}).update(fields)
+        for (collection, key), fields in upserts.items():
+            inserts.setdefault(collection, []).append(UpdateOne({"_id": key}, {"$set": fields}, upsert=True))
+        return inserts
+
+    async def flush(self, operations: Dict[str, list]):
+        """
+        Sends the operations, removing those of each collection once they are written so that a retry after a
+        connection error does not insert them twice. Rejected documents are reported and dropped, not retried.
+        """
+        for collection in list(operations):
+            requests = operations[collection]
+            try:
+                await self.db[collection].bulk_write(requests, ordered=False)
+                self.written += len(requests)
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                self.written += len(requests) - len(errors)
+                self.dropped += len(errors)
+                print(f"Error: MongoDB rejected {len(errors)} {collection} records: {errors[0]['errmsg']}")
+            del operations[collection]
+        self.batches += 1
+
+    async def run(self):
+        while not self.ready:
+            try:
+                await self.ensure_schema()
+                self.ready = True
+            except PyMongoError as e:
+                self.failures += 1
+                print(f"Error: Could not set up MongoDB at {self.url}, retrying in {self.retry_interval}s: {e}")
+                await asyncio.sleep(self.retry_interval)
+
+        loop = asyncio.get_running_loop()
+        # records taken off the queue but not turned into operations yet, and the operations not written yet
+        held = []
+        operations: Dict[str, list] = {}
+        try:
+            while True:
+                held.append(await self.queue.get())
+                # collect what arrives within flush_interval, up to a full batch
+                deadline = loop.time() + self.flush_interval
+                while len(held) < self.batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0 or not await self.collect(held, remaining):
+                        break
+
+                operations, count, held = self.take(*held), len(held), []
+                while True:
+                    try:
+                        await self.flush(operations)
+                        break
+                    except PyMongoError as e:
+                        # the batch is kept and sent again, new records queue up behind it meanwhile
+                        self.failures += 1
+                        print(f"Error: MongoDB write of {count} records failed, retrying: {e}")
+                        await asyncio.sleep(self.retry_interval)
+        except asyncio.CancelledError:
+            await self.write_out(operations, held)
+            raise
+
+    async def collect(self, held: list, timeout: float) -> bool:
+        """
+        Waits up to `timeout` seconds for the next record and appends it to `held`. Unlike `asyncio.wait_for`, a
+        cancellation arriving together with a record is not swallowed, and the record is kept rather than lost.
+        """
+        getter = asyncio.ensure_future(self.queue.get())
+        try:
+            await asyncio.wait({getter}, timeout=timeout)
+        finally:
+            arrived = getter.done()
+            if arrived:
+                held.append(getter.result())
+            else:
+                # a record it was woken up for stays in the queue
+                getter.cancel()
+        return arrived
+
+    async def write_out(self, operations: Dict[str, list], held: list):
+        """Writes the pending operations, then the held and still queued records, once and without retrying."""
+        held = held + [self.queue.get_nowait() for _ in range(self.queue.qsize())]
+        count = sum(len(requests) for requests in operations.values()) + len(held)
+        try:
+            # in two steps, so that an upsert still pending is not overtaken by a later one of the same document
+            if operations:
+                await self.flush(operations)
+            if held:
+                await self.flush(self.take(*held))
+        except PyMongoError as e:
+            print(f"Error: Could not write the last {count} records to MongoDB: {e}")
+
+    async def recent_tracks(self, limit: int = 50000) -> List[dict]:
+        """The last tracks generated for a location, newest first."""
+        cursor = self.db.tracks.find({"location": {"$exists": True}}).sort("created_at", DESCENDING).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
+
+
+# shared by the backend and the Bureau, which start it on the loop they run on
+persistence = Persistence()
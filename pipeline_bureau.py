@@ -1,22 +1,49 @@
 # Import libraries
-import vertexai, googlemaps
-from vertexai.generative_models import GenerativeModel, Part
-import json, requests
+import json
 from uagents import Agent, Context, Bureau, Model
 
-from timezonefinder import TimezoneFinder
-from datetime import datetime
-import pytz
-import asyncio, httpx
+import asyncio
+import httpx
+import os
+from dataclasses import asdict
+from typing import Callable, List, Optional
+
+from change_detection import ChangeDetector
+from http_client import HTTPClient, places_nearby
+from persistence import persistence
+from places_cache import PlacesCache
+from prompt_cache import MusicPromptGenerator, PromptCache, weather_category
+from prompt_retrieval import PromptIndex
+from rounds import RoundTracker
+from sessions import Session, SessionStore
+from time_context import TimeContext, TimeContextResolver
+from weather_service import WeatherService
 
 
 class NearbyArea(Model):
+    session_id: str
+    latitude: float
+    longitude: float
+    radius: float
+
+
+class SessionState(Model):
+    prompt: str
+    # weather category, empty until the weather of the session is known
+    weather: str
+    # TimeContext fields of the local time at the session's location
+    time: dict
+
+
+class AreaRequest(Model):
+    round_id: str
     latitude: float
     longitude: float
     radius: float
 
 
 class Buildings(Model):
+    round_id: str
     buildings: dict
 
 
@@ -24,114 +51,129 @@ class Message(Model):
     msg: str
 
 
-sound_scape = Agent(name="SoundScape", seed="EnvironmentToMusic")
-nearby_buildings = Agent(name="NearbyBuildings", seed="WhatsNearby")
-weather_API = Agent(name="WeatherAPI", seed="WeatherWhiz")
-time_API = Agent(name="TimeAPI", seed="TimeWhiz")
+class ContextReply(Model):
+    round_id: str
+    msg: str
 
 
-def generate_response(project_id: str, location: str, query: str) -> str:
-    # Initialize Vertex AI
-    vertexai.init(project=project_id, location=location)
-    # Load the model
-    multimodal_model = GenerativeModel("gemini-1.0-pro-vision")
+class TimeReply(Model):
+    round_id: str
+    timezone: str
+    hour: int
+    minute: int
+    bucket: str
 
-    # Query the model
-    response = multimodal_model.generate_content(
-        [
-            # Add an example query
-            query
-        ]
-    )
-
-    return response
 
+sound_scape = Agent(name="SoundScape", seed="EnvironmentToMusic")
+nearby_buildings = Agent(name="NearbyBuildings", seed="WhatsNearby")
+weather_API = Agent(name="WeatherAPI", seed="WeatherWhiz")
+time_API = Agent(name="TimeAPI", seed="TimeWhiz")
 
-@nearby_buildings.on_message(model=NearbyArea)
-async def get_nearby_buildings(ctx: Context, sender: str, msg: NearbyArea):
+# nearby-places searches by geohash cell, so listeners that stay in the same area do not hit Places every tick
+places_cache = PlacesCache(ttl=900.0)
+# weather per ~5 km grid cell, shared by all sessions in it and refreshed in the background before it expires
+weather_service = WeatherService(ttl=600.0)
+# loads the time zone polygons once, at import rather than on the event loop
+time_resolver = TimeContextResolver()
+# music prompts by place set, weather category and part of the day, kept across restarts; the Gemini client is built
+# once, for the Gemini Pro server in LA, California
+prompt_generator = MusicPromptGenerator(
+    PromptCache("cache/prompts.json"),
+    location="us-west2",
+    # the closest prompt of dataset.csv answers when Gemini is slow or down
+    retrieval=PromptIndex("dataset.csv"),
+)
+# which inputs of a session to fetch again each tick, and whether its prompt has to be regenerated; the weather is
+# asked for again halfway through the service's refresh window, which a 10 s tick cannot overshoot
+change_detector = ChangeDetector(weather_ttl=weather_service.ttl - weather_service.refresh_before / 2)
+# correlates the replies of the buildings, weather and time agents with the round that asked for them
+rounds = RoundTracker()
+# how long a round waits for the upstream agents before going ahead with what it has
+ROUND_TIMEOUT = 8.0
+
+# per-listener coordinates, context and prompt; sessions that stop polling expire after ten minutes
+sessions = SessionStore(ttl=600.0)
+# how many sessions run their round at the same time, so a crowd of listeners does not flood the upstream APIs
+MAX_CONCURRENT_ROUNDS = 32
+# called with (session_id, music_prompt) whenever the prompt of a session changes, e.g. by a backend running the
+# Bureau in-process to push it to its clients
+prompt_listeners: List[Callable[[str, str], None]] = []
+# a backend running apart from the Bureau is sent the prompt changes here, instead of polling for them
+BACKEND_URL = os.environ.get("SOUNDSCAPE_BACKEND_URL")
+# shared with the backend, which rejects every prompt notification without it
+PUSH_TOKEN = os.environ.get("SOUNDSCAPE_PUSH_TOKEN", "")
+if BACKEND_URL and not PUSH_TOKEN:
+    print("Error: SOUNDSCAPE_BACKEND_URL is set without SOUNDSCAPE_PUSH_TOKEN, prompt changes are not pushed")
+backend_client = HTTPClient(BACKEND_URL) if BACKEND_URL and PUSH_TOKEN else None
+notifications = set()
+
+
+@nearby_buildings.on_message(model=AreaRequest)
+async def get_nearby_buildings(ctx: Context, sender: str, msg: AreaRequest):
     ctx.logger.info(f"Building received message")
     # Get stored values and message values
     GOOGLE_MAPS_KEY = ctx.storage.get("GOOGLE_MAPS_KEY")
-    latitude = msg.latitude
-    longitude = msg.longitude
-    radius = msg.radius
-
-    client = googlemaps.Client(key=GOOGLE_MAPS_KEY)
-
-    # Define search request
-    search_request = {
-        "location": (latitude, longitude),
-        "radius": radius,
-        # Keyword or category filtering can be added here (optional)
-        "type": "point_of_interest",  # Example for category filter
-    }
 
-    # Send Nearby Search request
-    nearby_places = client.places_nearby(**search_request)
+    nearby_places = places_cache.get(msg.latitude, msg.longitude, msg.radius)
+    if nearby_places is None:
+        # Send Nearby Search request, over a wider area than asked so the next ticks can be answered from the cache
+        fetch_radius = places_cache.fetch_radius(msg.radius)
+        try:
+            response = await places_nearby(
+                GOOGLE_MAPS_KEY, msg.latitude, msg.longitude, fetch_radius
+            )
+            places_cache.put(msg.latitude, msg.longitude, fetch_radius, response)
+            nearby_places = response
+            if response.get("status") == "OK":
+                nearby_places = places_cache.within(
+                    response, msg.latitude, msg.longitude, msg.radius
+                )
+        except httpx.HTTPError as e:
+            print(f"Error: Nearby search request failed: {e}")
+            nearby_places = {"status": "REQUEST_FAILED"}
+    else:
+        ctx.logger.info(f"Nearby places served from cache: {places_cache.stats()}")
 
     # Process search results
     if not nearby_places["status"] == "OK":
         print("Error: Nearby search failed")
-        await ctx.send(sound_scape.address, Buildings(buildings={}))
+        await ctx.send(sound_scape.address, Buildings(round_id=msg.round_id, buildings={}))
     else:
-        await ctx.send(sound_scape.address, Buildings(buildings=nearby_places))
+        await ctx.send(sound_scape.address, Buildings(round_id=msg.round_id, buildings=nearby_places))
 
 
-@weather_API.on_message(model=NearbyArea)
-async def get_weather_description(ctx: Context, sender: str, msg: NearbyArea):
+@weather_API.on_message(model=AreaRequest)
+async def get_weather_description(ctx: Context, sender: str, msg: AreaRequest):
     ctx.logger.info(f"Weather received message")
     # Get stored values and message values
     OPEN_WEATHER_KEY = ctx.storage.get("OPEN_WEATHER_KEY")
-    latitude = msg.latitude
-    longitude = msg.longitude
-
-    # Build the API URL with your API key, coordinates, and units (metric)
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={OPEN_WEATHER_KEY}&units=metric"
-
-    # Make the API call using requests library
-    response = requests.get(url)
-
-    # Check for successful response (status code 200)
-    if response.status_code == 200:
-        # Parse the JSON response
-        weather_data = response.json()
 
-        # Extract relevant weather information
-        description = weather_data["weather"][0]["description"]
-
-        await ctx.send(sound_scape.address, Message(msg=description))
-    else:
+    try:
+        description = await weather_service.get(OPEN_WEATHER_KEY, msg.latitude, msg.longitude)
+    except (httpx.HTTPError, KeyError, IndexError) as e:
         # Handle error if API call fails
-        print(f"Error: API request failed with status code {response.status_code}")
-        await ctx.send(sound_scape.address, Message(msg=""))
+        print(f"Error: Weather request failed: {e}")
+        description = ""
 
+    await ctx.send(sound_scape.address, ContextReply(round_id=msg.round_id, msg=description))
 
-@time_API.on_message(model=NearbyArea)
-async def get_time_of_day(ctx: Context, sender: str, msg: NearbyArea):
+
+@time_API.on_message(model=AreaRequest)
+async def get_time_of_day(ctx: Context, sender: str, msg: AreaRequest):
     ctx.logger.info(f"Time received message")
-    # Get stored values and message values
-    latitude = msg.latitude
-    longitude = msg.longitude
-
-    # Get timezone
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=latitude, lng=longitude)
-
-    # Get current time in the timezone
-    tz = pytz.timezone(timezone_str)
-    current_time = datetime.now(tz)
-    hour_min = str(current_time.hour) + ":"
-    mins = str(current_time.minute)
-    if current_time.minute < 10:
-        mins = "0" + str(current_time.minute)
-    hour_min += mins
-
-    if current_time.hour < 12:
-        hour_min += " AM"
-    else:
-        hour_min += " PM"
 
-    await ctx.send(sound_scape.address, Message(msg=hour_min))
+    time_context = time_resolver.resolve(msg.latitude, msg.longitude)
+
+    await ctx.send(
+        sound_scape.address,
+        TimeReply(
+            round_id=msg.round_id,
+            timezone=time_context.timezone,
+            hour=time_context.hour,
+            minute=time_context.minute,
+            bucket=time_context.bucket,
+        ),
+    )
 
 
 def read_variables_from_file(file_path):
@@ -181,186 +223,215 @@ async def sound_scape_startup(ctx: Context):
     GOOGLE_PROJECT_KEY = variables["PROJECTKEY"]
 
     ctx.storage.set("GOOGLE_PROJECT_KEY", GOOGLE_PROJECT_KEY)
-
-    ctx.storage.set("time_received", False)
-    ctx.storage.set("buildings_received", False)
-    ctx.storage.set("weather_received", False)
+    # resolved contexts and generated prompts are written to MongoDB in the background
+    await persistence.start()
     ctx.logger.info(
         f"startup complete for SoundScape agent with address: " + sound_scape.address
     )
 
 
-@sound_scape.on_query(model=NearbyArea, replies={Message})
-async def save_coordinates(ctx: Context, sender: str, msg: NearbyArea):
-    ctx.storage.set("latitude", msg.latitude)
-    ctx.storage.set("longitude", msg.longitude)
-    ctx.storage.set("radius", msg.radius)
-
-    await ctx.send(sender, Message(msg="success"))
+@sound_scape.on_event("shutdown")
+async def sound_scape_shutdown(ctx: Context):
+    await persistence.stop()
 
 
-@sound_scape.on_query(model=Message, replies={Message})
-async def get_audio(ctx: Context, sender: str, msg: NearbyArea):
-    music_prompt = ctx.storage.get("music_prompt")
-    await ctx.send(sender, Message(msg=music_prompt))
+def update_location(session_id: str, latitude: float, longitude: float, radius: float) -> SessionState:
+    """
+    Moves a session, creating it if needed, and returns its current music prompt (empty if it has none yet) with the
+    conditions it plays in, which are known even before the first prompt.
+    """
+    session = sessions.update_location(session_id, latitude, longitude, radius)
+    return SessionState(
+        prompt=session.music_prompt or "",
+        weather=weather_category(session.weather) if session.weather else "",
+        time=asdict(time_resolver.resolve(latitude, longitude)),
+    )
 
 
-@sound_scape.on_interval(10)
-async def generate_prompt(ctx: Context):
-    ctx.logger.info(f"generating prompt for music")
+def current_prompt(session_id: str) -> str:
+    session = sessions.get(session_id)
+    return (session.music_prompt if session is not None else None) or ""
 
-    GOOGLE_PROJECT_KEY = ctx.storage.get("GOOGLE_PROJECT_KEY")
 
+async def notify_backend(session_id: str, music_prompt: str):
     try:
-        latitude = ctx.storage.get("latitude")
-        longitude = ctx.storage.get("longitude")
-        radius = ctx.storage.get("radius")
-    except:
-        ctx.logger.error("Missing a value for latitude, longitude, or radius")
+        await backend_client.post_json(
+            "/api/internal/prompts",
+            {"session_id": session_id, "prompt": music_prompt},
+            headers={"X-SoundScape-Token": PUSH_TOKEN},
+        )
+    except httpx.HTTPError as e:
+        print(f"Error: Could not notify the backend of the prompt of session {session_id}: {e!r}")
+
+
+def push_to_backend(session_id: str, music_prompt: str):
+    # set_prompt runs on the Bureau's loop; the tasks are kept referenced until they are done
+    task = asyncio.ensure_future(notify_backend(session_id, music_prompt))
+    notifications.add(task)
+    task.add_done_callback(notifications.discard)
+
+
+if backend_client is not None:
+    prompt_listeners.append(push_to_backend)
+
+
+def set_prompt(session: Session, music_prompt: Optional[str]):
+    if music_prompt is None or music_prompt == session.music_prompt:
         return
+    session.music_prompt = music_prompt
+    for listener in prompt_listeners:
+        listener(session.session_id, music_prompt)
+
+
+@sound_scape.on_query(model=NearbyArea, replies={SessionState})
+async def save_coordinates(ctx: Context, sender: str, msg: NearbyArea):
+    # the reply carries the session's prompt, so a location update and a prompt fetch are one round-trip
+    await ctx.send(sender, update_location(msg.session_id, msg.latitude, msg.longitude, msg.radius))
+
+
+@sound_scape.on_query(model=Message, replies={Message})
+async def get_audio(ctx: Context, sender: str, msg: Message):
+    # the query carries the id of the session asking for its prompt
+    await ctx.send(sender, Message(msg=current_prompt(msg.msg)))
 
-    if latitude == None or longitude == None or radius == None:
-        ctx.logger.error("Missing a value for latitude, longitude, or radius")
+
+@sound_scape.on_interval(10)
+async def generate_prompts(ctx: Context):
+    expired = sessions.expire()
+    if expired:
+        ctx.logger.info(f"Expired {len(expired)} idle sessions")
+
+    active = sessions.active()
+    if not active:
         return
 
-    # Location of Gemini Pro server in LA, California
-    location = "us-west2"
+    ctx.logger.info(f"generating prompts for {len(active)} sessions")
 
-    nearby_area = NearbyArea(latitude=latitude, longitude=longitude, radius=radius)
+    # resolve the zones of all sessions in one pass, so the time agent's lookups during the rounds hit its cache
+    time_resolver.resolve_many([(session.latitude, session.longitude) for session in active])
 
-    await ctx.send(nearby_buildings.address, nearby_area)
+    # created here rather than at import so it belongs to the loop the Bureau runs on
+    limit = asyncio.Semaphore(MAX_CONCURRENT_ROUNDS)
 
-    await ctx.send(weather_API.address, nearby_area)
+    async def run(session: Session):
+        async with limit:
+            try:
+                await generate_prompt(ctx, session)
+            except Exception as e:
+                ctx.logger.error(f"Failed to generate a prompt for session {session.session_id}: {e}")
 
-    await ctx.send(time_API.address, nearby_area)
+    await asyncio.gather(*(run(session) for session in active))
 
-    while (
-        ctx.storage.get("time_received") != True
-        or ctx.storage.get("buildings_received") != True
-        or ctx.storage.get("weather_received") != True
-    ):
-        await asyncio.sleep(0.5)
-        # print(ctx.storage.get('time_received'), ctx.storage.get('buildings_received'), ctx.storage.get('weather_received'))
 
-    ctx.storage.set("time_received", False)
-    ctx.storage.set("buildings_received", False)
-    ctx.storage.set("weather_received", False)
+async def generate_prompt(ctx: Context, session: Session):
+    GOOGLE_PROJECT_KEY = ctx.storage.get("GOOGLE_PROJECT_KEY")
 
-    nearby_places = ctx.storage.get("nearby_places")
-    weather = ctx.storage.get("weather")
-    time_of_day = ctx.storage.get("time_of_day")
+    stale = change_detector.stale(session)
+    if stale:
+        await refresh_context(ctx, session, stale)
+    change_detector.update_time(session)
 
-    ctx.logger.info("time_of_day: " + time_of_day)
+    nearby_places = session.nearby_places
+    weather = session.weather
+    time_context = session.time_context
 
-    ctx.storage.set("music_prompt", "Hi there :)")
+    fingerprint = change_detector.changed(session)
+    if fingerprint is None or nearby_places is None:
+        # nothing that shapes the music changed, keep the current prompt
+        return
 
-    return
+    time_of_day = time_context.describe() if time_context is not None else ""
 
-    if nearby_places is not None:
-        with open("queries.txt", "w") as outfile:
-            buildings_found = False
-            try:
-                vicinity = nearby_places["results"][0]["vicinity"]
-                name = []
-                for i in range(0, 3):
-                    try:
-                        name[i] = nearby_places["results"][i]["name"]
-                        buildings_found = True
-                    except:
-                        ctx.logger.error(
-                            "Could not process the " + i + " place nearby."
-                        )
-            except:
-                ctx.logger.error(
-                    "No such buildings were found nearby, or a failure occurred during the prompt building process."
-                )
+    ctx.logger.info("time_of_day: " + time_of_day)
 
-            prompt = ""
-
-            if buildings_found:
-                if len(name) == 1:
-                    prompt = (
-                        "Suppose you are near the establishment/building "
-                        + name[0]
-                        + " in "
-                        + vicinity
-                        + "."
-                    )
-                elif len(name) == 2:
-                    prompt = (
-                        "Suppose you are near these two buildings in "
-                        + vicinity
-                        + ", closest being first and furthest away being last: "
-                        + name[0]
-                        + " and "
-                        + name[1]
-                        + "."
-                    )
-                else:
-                    prompt = (
-                        "Suppose you are near these three buildings in "
-                        + vicinity
-                        + ", closest being first and furthest away being last: "
-                        + name[0]
-                        + ", "
-                        + name[1]
-                        + ", "
-                        + name[2]
-                        + "."
-                    )
-
-                prompt += (
-                    " If you had to come up with a vibe of music for these buildings while taking into account the current time of day ("
-                    + time_of_day
-                    + ") and weather of the area ("
-                    + weather
-                    + "), what would that vibe be? Please consolidate the recommendations for the type of vibe into a list. At the end, can you combine those into a prompt for a music generation model and begin the prompt with a @ symbol so I know where it starts?"
-                )
-                outfile.write(prompt + "\n\n")
-            else:
-                prompt = (
-                    "If you had to come up with a vibe of music for the area around "
-                    + vicinity
-                    + " while taking into account the current time of day ("
-                    + time_of_day
-                    + ") and weather of the area ("
-                    + weather
-                    + "), what would that vibe be? Please consolidate the recommendations for the type of vibe into a list. At the end, can you combine those into a prompt for a music generation model and begin the prompt with a @ symbol so I know where it starts?"
-                )
+    if session.music_prompt is None:
+        # a new listener hears something right away, while Gemini works on the real prompt
+        set_prompt(session, prompt_generator.nearest(nearby_places, weather, time_context))
 
-            response = generate_response(GOOGLE_PROJECT_KEY, location, prompt)
+    music_prompt, final = await prompt_generator.generate(
+        GOOGLE_PROJECT_KEY, nearby_places, weather, time_context
+    )
+    if music_prompt is None:
+        ctx.logger.error("Failed to get a music prompt")
+        return
 
-            parts = response.split("@")
+    set_prompt(session, music_prompt)
+    if final:
+        session.fingerprint = fingerprint
+        persistence.record_context(
+            session.session_id, session.latitude, session.longitude, fingerprint, nearby_places, weather, time_context
+        )
+        persistence.record_prompt(session.session_id, session.latitude, session.longitude, music_prompt, fingerprint)
+    # else a dataset prompt stands in for Gemini, the fingerprint stays unset so the next tick picks up its late answer
+    ctx.logger.info(
+        f"Prompt cache: {prompt_generator.cache.stats()}, change detection: {change_detector.stats()}"
+    )
 
-            # Check if there is a "@" symbol and return the second part if it exists
-            if len(parts) > 1:
-                music_prompt = parts[1]
-                ctx.storage.set("music_prompt", music_prompt)
-                with open("queries.txt", "w") as outfile:
-                    outfile.write(music_prompt)
-            else:
-                ctx.logger.error("Failed to get a music prompt")
+    with open("queries.txt", "w") as outfile:
+        outfile.write(music_prompt)
 
     with open("buildings.json", "w") as outfile:
         # Use json.dump to write the dictionary to the file
         json.dump(nearby_places, outfile)
 
 
+async def refresh_context(ctx: Context, session: Session, stale: List[str]):
+    """Asks the agents for the stale inputs of a session and stores their replies in it."""
+    round_id = rounds.open(stale)
+    area_request = AreaRequest(
+        round_id=round_id,
+        latitude=session.latitude,
+        longitude=session.longitude,
+        radius=session.radius,
+    )
+
+    if "buildings" in stale:
+        await ctx.send(nearby_buildings.address, area_request)
+
+    if "weather" in stale:
+        await ctx.send(weather_API.address, area_request)
+
+    if "time" in stale:
+        await ctx.send(time_API.address, area_request)
+
+    replies = await rounds.gather(round_id, timeout=ROUND_TIMEOUT)
+
+    missing = set(stale) - set(replies)
+    if missing:
+        # keep the values of the last round for the agents that did not answer in time, and ask again next tick
+        ctx.logger.warning(
+            f"Round {round_id} of session {session.session_id} got no reply for {', '.join(sorted(missing))}, using the last known values"
+        )
+
+    if "buildings" in replies:
+        session.nearby_places = replies["buildings"]
+    if "weather" in replies:
+        session.weather = replies["weather"]
+    if "time" in replies:
+        session.time_context = replies["time"]
+    # an empty reply is what the agents send when their upstream failed, so those are asked again next tick
+    change_detector.refreshed(session, [name for name, value in replies.items() if value])
+
+
 @sound_scape.on_message(model=Buildings)
 async def building_handler(ctx: Context, sender: str, msg: Buildings):
-    # print(msg.buildings)
-    ctx.storage.set("nearby_places", msg.buildings)
-    ctx.storage.set("buildings_received", True)
-
-
-@sound_scape.on_message(model=Message)
-async def message_handler(ctx: Context, sender: str, msg: Message):
-    if sender == weather_API.address:
-        ctx.storage.set("weather", msg.msg)
-        ctx.storage.set("weather_received", True)
-    elif sender == time_API.address:
-        ctx.storage.set("time_of_day", msg.msg)
-        ctx.storage.set("time_received", True)
+    if not rounds.resolve(msg.round_id, "buildings", msg.buildings):
+        ctx.logger.info(f"Ignoring buildings for finished round {msg.round_id}")
+
+
+@sound_scape.on_message(model=ContextReply)
+async def context_handler(ctx: Context, sender: str, msg: ContextReply):
+    if sender != weather_API.address:
+        return
+    if not rounds.resolve(msg.round_id, "weather", msg.msg):
+        ctx.logger.info(f"Ignoring weather for finished round {msg.round_id}")
+
+
+@sound_scape.on_message(model=TimeReply)
+async def time_handler(ctx: Context, sender: str, msg: TimeReply):
+    time_context = TimeContext(msg.timezone, msg.hour, msg.minute, msg.bucket)
+    if not rounds.resolve(msg.round_id, "time", time_context):
+        ctx.logger.info(f"Ignoring time for finished round {msg.round_id}")
 
 
 bureau = Bureau(port=8006)  # endpoint="http://localhost:8006/submit")
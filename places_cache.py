@@ -0,0 +1,182 @@
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_M = 6371008.8
+
+
+def geohash(latitude: float, longitude: float, precision: int = 6) -> str:
+    """Encodes a coordinate as a geohash of `precision` characters."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # bits alternate between longitude and latitude, starting with longitude
+        interval, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision: int) -> Tuple[float, float]:
+    """Height and width in degrees of a geohash cell of `precision` characters."""
+    lng_bits = math.ceil(5 * precision / 2)
+    lat_bits = 5 * precision - lng_bits
+    return 180.0 / 2**lat_bits, 360.0 / 2**lng_bits
+
+
+def neighbourhood(latitude: float, longitude: float, precision: int) -> Iterator[str]:
+    """The geohash cell of a point and its eight neighbours."""
+    height, width = geohash_cell_size(precision)
+    seen = set()
+    for dlat in (0, -height, height):
+        for dlng in (0, -width, width):
+            lat = max(-90.0, min(90.0, latitude + dlat))
+            lng = (longitude + dlng + 180.0) % 360.0 - 180.0
+            cell = geohash(lat, lng, precision)
+            if cell not in seen:
+                seen.add(cell)
+                yield cell
+
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance in metres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+@dataclass
+class CachedQuery:
+    latitude: float
+    longitude: float
+    radius: float
+    response: dict
+    created: float = field(default_factory=time.monotonic)
+
+    def covers(self, latitude: float, longitude: float, radius: float) -> bool:
+        """Whether a circle around the given point lies completely inside the circle this query searched."""
+        return distance_m(self.latitude, self.longitude, latitude, longitude) + radius <= self.radius
+
+
+class PlacesCache:
+    """
+    TTL cache of Nearby Search responses keyed by the geohash cell of the searched point and a radius bucket. Misses are
+    fetched with the radius rounded up to a bucket of at least `min_fetch_radius`, so a listener who stays put or moves
+    slowly keeps landing inside an earlier search; any lookup whose circle is covered by a cached search (distance
+    between the centres plus the requested radius within the cached radius) is answered from it, with the places
+    filtered to the requested circle and sorted by distance.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 900.0,
+        max_entries: int = 4096,
+        precision: int = 6,
+        radius_buckets: Tuple[float, ...] = (100.0, 250.0, 500.0, 1000.0, 2000.0, 5000.0),
+        min_fetch_radius: float = 250.0,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.radius_buckets = radius_buckets
+        self.min_fetch_radius = min_fetch_radius
+        self.entries: "OrderedDict[Tuple[str, float], CachedQuery]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def radius_bucket(self, radius: float) -> float:
+        for bucket in self.radius_buckets:
+            if radius <= bucket:
+                return bucket
+        return radius
+
+    def fetch_radius(self, radius: float) -> float:
+        """The radius to search upstream for a miss of `radius`, so the response can serve later nearby lookups."""
+        return self.radius_bucket(max(radius, self.min_fetch_radius))
+
+    def neighbourhood(self, latitude: float, longitude: float) -> Iterator[str]:
+        return neighbourhood(latitude, longitude, self.precision)
+
+    def get(self, latitude: float, longitude: float, radius: float) -> Optional[dict]:
+        """Returns the places within `radius` metres of the point from a covering cached search, or `None`."""
+        now = time.monotonic()
+        for cell in self.neighbourhood(latitude, longitude):
+            for bucket in self.radius_buckets:
+                if bucket < radius:
+                    continue
+                key = (cell, bucket)
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if now - entry.created > self.ttl:
+                    del self.entries[key]
+                    continue
+                if entry.covers(latitude, longitude, radius):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.within(entry.response, latitude, longitude, radius)
+        self.misses += 1
+        return None
+
+    def put(self, latitude: float, longitude: float, radius: float, response: dict):
+        """Caches the response of a search of `radius` metres around the point."""
+        if response.get("status") not in ("OK", "ZERO_RESULTS"):
+            return
+        key = (geohash(latitude, longitude, self.precision), self.radius_bucket(radius))
+        self.entries[key] = CachedQuery(latitude, longitude, radius, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def within(response: dict, latitude: float, longitude: float, radius: float) -> dict:
+        """Copy of a search response keeping only the places within the circle, closest first."""
+        places: List[Tuple[float, dict]] = []
+        for place in response.get("results", []):
+            try:
+                location = place["geometry"]["location"]
+                distance = distance_m(latitude, longitude, location["lat"], location["lng"])
+            except (KeyError, TypeError):
+                continue
+            if distance <= radius:
+                places.append((distance, place))
+        places.sort(key=lambda item: item[0])
+        filtered = dict(response)
+        filtered["results"] = [place for _, place in places]
+        filtered["status"] = "OK" if places else "ZERO_RESULTS"
+        # a page token would continue the original, larger search
+        filtered.pop("next_page_token", None)
+        return filtered
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import vertexai
+from vertexai.generative_models import GenerativeModel
+
+from prompt_retrieval import PromptIndex
+from time_context import TimeContext
+
+MUSIC_PROMPT_MODEL = "gemini-1.0-pro-vision"
+
+# OpenWeather descriptions ("light intensity drizzle", "broken clouds", ...) grouped into what changes the music
+WEATHER_CATEGORIES = (
+    ("thunderstorm", ("thunderstorm",)),
+    ("snow", ("snow", "sleet")),
+    ("rain", ("rain", "drizzle", "shower")),
+    ("fog", ("mist", "fog", "haze", "smoke", "dust", "sand", "ash")),
+    ("storm", ("squall", "tornado")),
+    ("cloudy", ("overcast", "broken clouds")),
+    ("partly cloudy", ("clouds",)),
+    ("clear", ("clear",)),
+)
+
+QUERY_SUFFIX = (
+    "what would that vibe be? Please consolidate the recommendations for the type of vibe into a list. At the end, can "
+    "you combine those into a prompt for a music generation model and begin the prompt with a @ symbol so I know where "
+    "it starts?"
+)
+
+
+def weather_category(description: str) -> str:
+    description = description.lower()
+    for category, words in WEATHER_CATEGORIES:
+        if any(word in description for word in words):
+            return category
+    return description or "unknown"
+
+
+def nearest_places(nearby_places: dict, count: int = 3) -> List[dict]:
+    return list(nearby_places.get("results", []))[:count] if nearby_places else []
+
+
+def context_key(nearby_places: dict, weather: str, time_context: Optional[TimeContext]) -> str:
+    """
+    Cache key of the context a music prompt is generated from: the ids of the nearest places regardless of their order,
+    the weather category and the part of the day. Contexts that only differ in the minute or in the wording of the
+    weather share a prompt.
+    """
+    places = sorted(place.get("place_id", place.get("name", "")) for place in nearest_places(nearby_places))
+    bucket = time_context.bucket if time_context is not None else "unknown"
+    key = json.dumps([places, weather_category(weather), bucket])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def build_query(nearby_places: dict, weather: str, time_of_day: str) -> Optional[str]:
+    """The question asked to Gemini for a music prompt, or `None` if there is nothing to describe the area with."""
+    places = nearest_places(nearby_places)
+    if not places:
+        return None
+    vicinity = places[0].get("vicinity", "")
+    names = [place["name"] for place in places if "name" in place]
+    context = f"the current time of day ({time_of_day}) and weather of the area ({weather})"
+
+    if not names:
+        return (
+            f"If you had to come up with a vibe of music for the area around {vicinity} while taking into account "
+            f"{context}, {QUERY_SUFFIX}"
+        )
+    if len(names) == 1:
+        query = f"Suppose you are near the establishment/building {names[0]} in {vicinity}."
+    elif len(names) == 2:
+        query = (
+            f"Suppose you are near these two buildings in {vicinity}, closest being first and furthest away being last: "
+            f"{names[0]} and {names[1]}."
+        )
+    else:
+        query = (
+            f"Suppose you are near these three buildings in {vicinity}, closest being first and furthest away being "
+            f"last: {names[0]}, {names[1]}, {names[2]}."
+        )
+    return (
+        f"{query} If you had to come up with a vibe of music for these buildings while taking into account {context}, "
+        f"{QUERY_SUFFIX}"
+    )
+
+
+def extract_music_prompt(response: str) -> Optional[str]:
+    """The part of a Gemini answer after the "@" it was asked to start the music prompt with."""
+    parts = response.split("@")
+    if len(parts) > 1 and parts[1].strip():
+        return parts[1].strip()
+    return None
+
+
+class GeminiClient:
+    """Initializes Vertex AI and loads the model once, instead of on every prompt."""
+
+    def __init__(self, project_id: str, location: str, model_name: str = MUSIC_PROMPT_MODEL):
+        vertexai.init(project=project_id, location=location)
+        self.model = GenerativeModel(model_name)
+
+    def generate(self, query: str) -> str:
+        return self.model.generate_content([query]).text
+
+
+class PromptCache:
+    """
+    Music prompts keyed by `context_key`, with a TTL and LRU eviction, persisted to a JSON file so that a restart keeps
+    them. The file is rewritten atomically on every insert; it only holds short strings.
+    """
+
+    def __init__(self, path: str = "cache/prompts.json", ttl: float = 6 * 3600.0, max_entries: int = 4096):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        # seconds of LLM calls the hits did not have to make
+        self.saved_seconds = 0.0
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not read the prompt cache {self.path}: {e}")
+            return
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]["last_used"]):
+            self.entries[key] = entry
+        self.expire()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        for key in [key for key, entry in self.entries.items() if entry["created"] < deadline]:
+            del self.entries[key]
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None and entry["created"] < time.time() - self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        entry["last_used"] = time.time()
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry["latency_s"]
+        return entry["prompt"]
+
+    def put(self, key: str, prompt: str, latency_s: float):
+        now = time.time()
+        self.entries[key] = {"prompt": prompt, "created": now, "last_used": now, "latency_s": latency_s}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.save()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_llm_calls": self.hits,
+            "saved_llm_seconds": round(self.saved_seconds, 3),
+        }
+
+
+class MusicPromptGenerator:
+    """
+    Turns a session's context into a music prompt, from the cache when the context was seen before. With a retrieval
+    index, the closest prompt of the dataset stands in when Gemini takes longer than `llm_timeout` seconds or fails; a
+    late answer still fills the cache for the next tick.
+    """
+
+    def __init__(
+        self,
+        cache: PromptCache,
+        location: str,
+        retrieval: Optional[PromptIndex] = None,
+        llm_timeout: float = 5.0,
+    ):
+        self.cache = cache
+        self.location = location
+        self.retrieval = retrieval
+        self.llm_timeout = llm_timeout
+        self.client: Optional[GeminiClient] = None
+        self.fallbacks = 0
+
+    def gemini(self, project_id: str) -> GeminiClient:
+        if self.client is None:
+            self.client = GeminiClient(project_id, self.location)
+        return self.client
+
+    def nearest(self, nearby_places: dict, weather: str, time_context: Optional[TimeContext]) -> Optional[str]:
+        """The dataset prompt closest to the context, a fast first answer while the real one is generated."""
+        if self.retrieval is None:
+            return None
+        time_of_day = time_context.describe() if time_context is not None else ""
+        query = build_query(nearby_places, weather, time_of_day)
+        return self.retrieval.nearest(query) if query is not None else None
+
+    async def generate(
+        self, project_id: str, nearby_places: dict, weather: str, time_context: Optional[TimeContext]
+    ) -> Tuple[Optional[str], bool]:
+        """
+        Returns the music prompt, or `None` if none could be generated, and whether it is final: `False` for the dataset
+        prompt standing in for a slow or failed Gemini call, which callers should ask for again on a later tick so that
+        the late answer is picked up from the cache.
+        """
+        key = context_key(nearby_places, weather, time_context)
+        music_prompt = self.cache.get(key)
+        if music_prompt is not None:
+            return music_prompt, True
+
+        time_of_day = time_context.describe() if time_context is not None else ""
+        query = build_query(nearby_places, weather, time_of_day)
+        if query is None:
+            return None, True
+
+        client = self.gemini(project_id)
+        start = time.perf_counter()
+
+        def store(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            music_prompt = extract_music_prompt(future.result())
+            if music_prompt is not None:
+                self.cache.put(key, music_prompt, time.perf_counter() - start)
+
+        # the Vertex AI client is blocking, keep it off the event loop the agents share
+        future = asyncio.get_running_loop().run_in_executor(None, client.generate, query)
+        future.add_done_callback(store)
+        try:
+            response = await asyncio.wait_for(asyncio.shield(future), timeout=self.llm_timeout)
+        except Exception as e:
+            if self.retrieval is None:
+                raise
+            self.fallbacks += 1
+            print(f"Error: Gemini failed or timed out ({e!r}), using the closest dataset prompt")
+            return self.retrieval.nearest(query), False
+        return extract_music_prompt(response), True
@@ -0,0 +1,146 @@
+import csv
+import io
+import os
+import re
+import time
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def features(text: str) -> List[str]:
+    """Word unigrams and bigrams, plus character trigrams of every word so that misspelled place names still match."""
+    words = TOKEN_PATTERN.findall(text.lower())
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f"<{word}>"
+        grams.extend(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class PromptIndex:
+    """
+    Nearest-neighbour search over the scenario -> music prompt pairs of `dataset.csv`: each scenario is hashed into
+    `n_features` n-gram counts and scored against the query by cosine similarity of TF-IDF weights, all in numpy.
+
+    Rows appended to the file are picked up by `refresh`, which only hashes the new rows; the TF-IDF weights are then
+    recomputed from the stored counts in one vectorized pass. A file that shrank or was rewritten is indexed again from
+    scratch.
+    """
+
+    def __init__(self, path: str = "dataset.csv", n_features: int = 2**13, refresh_interval: float = 30.0):
+        self.path = path
+        self.n_features = n_features
+        self.refresh_interval = refresh_interval
+
+        self.scenarios: List[str] = []
+        self.prompts: List[str] = []
+        self.counts = np.zeros((0, n_features), dtype=np.float32)
+        self.weights = np.zeros((0, n_features), dtype=np.float32)
+        self.idf = np.ones(n_features, dtype=np.float32)
+        self.offset = 0
+        self.header: Optional[List[str]] = None
+        # whether the last indexed row was not terminated by a line break
+        self.partial = False
+        self.checked = 0.0
+
+        self.refresh(force=True)
+
+    def vectorize(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.n_features, dtype=np.float32)
+        for gram in features(text):
+            vector[zlib.crc32(gram.encode()) % self.n_features] += 1
+        return vector
+
+    def refresh(self, force: bool = False) -> int:
+        """Indexes the rows appended to the file since the last check, and returns how many there were."""
+        now = time.monotonic()
+        if not force and now - self.checked < self.refresh_interval:
+            return 0
+        self.checked = now
+
+        try:
+            size = os.path.getsize(self.path)
+        except OSError as e:
+            print(f"Error: Could not read the prompt dataset {self.path}: {e}")
+            return 0
+        if size < self.offset:
+            self.scenarios, self.prompts = [], []
+            self.counts = np.zeros((0, self.n_features), dtype=np.float32)
+            self.offset = 0
+            self.header = None
+            self.partial = False
+        if size == self.offset and not self.partial:
+            return 0
+
+        removed = 0
+        if self.partial:
+            # the last row had no line break yet and may have grown since, read it again
+            self.drop_last()
+            removed = 1
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # the offset only moves past complete lines; an unterminated last row is indexed but read again next time
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        complete, tail = data[:end].decode("utf-8", errors="replace"), data[end:].decode("utf-8", errors="replace")
+
+        rows = self.parse(complete)
+        tail_rows = self.parse(tail) if tail.strip() else []
+        if tail_rows:
+            rows.append(tail_rows[-1])
+            self.partial = True
+        if rows:
+            self.scenarios.extend(scenario for scenario, _ in rows)
+            self.prompts.extend(prompt for _, prompt in rows)
+            self.counts = np.concatenate([self.counts, np.stack([self.vectorize(scenario) for scenario, _ in rows])])
+        if rows or removed:
+            self.reweight()
+        return len(rows) - removed
+
+    def parse(self, text: str) -> List[Tuple[str, str]]:
+        reader = csv.reader(io.StringIO(text), skipinitialspace=True)
+        if self.header is None:
+            self.header = [column.strip() for column in next(reader, [])]
+        scenario_column = self.header.index("prompt")
+        prompt_column = self.header.index("response")
+
+        rows = []
+        for row in reader:
+            if len(row) > max(scenario_column, prompt_column) and row[prompt_column].strip():
+                rows.append((row[scenario_column].strip(), row[prompt_column].strip()))
+        return rows
+
+    def drop_last(self):
+        self.scenarios.pop()
+        self.prompts.pop()
+        self.counts = self.counts[:-1]
+        self.partial = False
+
+    def reweight(self):
+        num_documents = len(self.counts)
+        document_frequency = np.count_nonzero(self.counts, axis=0)
+        self.idf = (np.log((1 + num_documents) / (1 + document_frequency)) + 1).astype(np.float32)
+        weights = np.log1p(self.counts) * self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        self.weights = weights / np.maximum(norms, 1e-12)
+
+    def search(self, query: str, k: int = 1) -> List[Tuple[float, str]]:
+        """Returns the music prompts of the `k` scenarios most similar to `query`, with their similarity."""
+        self.refresh()
+        if not self.prompts:
+            return []
+        vector = np.log1p(self.vectorize(query)) * self.idf
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        scores = self.weights @ vector
+        best = np.argsort(-scores)[:k]
+        return [(float(scores[i]), self.prompts[i]) for i in best]
+
+    def nearest(self, query: str) -> Optional[str]:
+        results = self.search(query, k=1)
+        return results[0][1] if results else None
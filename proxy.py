@@ -54,14 +54,33 @@ def make_post_request(base_url):
         print(f"Request failed with status code: {response.status_code}")
 
 
+def watch_prompt(base_url, session_id="default"):
+    """Long-polls the session's state, printing each new prompt as soon as the backend has it."""
+    etag = None
+    while True:
+        headers = {"If-None-Match": etag} if etag else {}
+        try:
+            response = requests.get(
+                f"{base_url}/sessions/{session_id}/state", params={"wait": 25}, headers=headers, timeout=35
+            )
+        except requests.RequestException as e:
+            print(f"Error: {e}")
+            time.sleep(5)
+            continue
+
+        if response.status_code == 200:
+            etag = response.headers.get("ETag")
+            print(str(response.json().get("prompt")))
+        elif response.status_code != 304:
+            print(f"Request failed with status code: {response.status_code}")
+            time.sleep(5)
+
+
 def main():
     base_url = "http://192.168.61.134:4000/api"
     file_path = "test.wav"
 
-    while True:
-        time.sleep(5)
-        make_get_request(base_url)
-        time.sleep(5)
+    watch_prompt(base_url)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+"""
+Post-training INT8 quantization of the MusicGen decoder with Intel® Neural Compressor, and a CPU latency report
+comparing it against FP32.
+
+Usage:
+    python quantization.py quantize     # writes the quantized decoder to ./output
+    python quantization.py report       # writes quantization_report.json
+"""
+import argparse
+import csv
+import ctypes
+import gc
+import json
+import subprocess
+import sys
+import time
+
+import torch
+
+from transformers import MusicgenForConditionalGeneration, MusicgenProcessor, set_seed
+
+from musicgen_streamer import MusicgenStreamer
+
+
+MODEL_ID = "facebook/musicgen-small"
+OUTPUT_DIR = "./output"
+
+
+def calibration_prompts(path="dataset.csv"):
+    """The music prompts of `dataset.csv`, which are representative of what the decoder is asked to generate."""
+    with open(path, "r", newline="") as file:
+        rows = list(csv.DictReader(file, skipinitialspace=True))
+    return [row["response"].strip() for row in rows if row.get("response")]
+
+
+def calibration_set(model, processor, prompts, max_new_tokens=100, seed=0):
+    """
+    Builds one decoder batch per prompt: the text encoder states and the decoder input ids that FP32 MusicGen actually
+    generates for it, along with the FP32 next-token predictions the quantized decoder is scored against.
+    """
+    samples = []
+    for prompt in prompts:
+        inputs = processor(text=prompt, padding=True, return_tensors="pt")
+        # with play_steps past the end of the stream the streamer only records the tokens
+        streamer = MusicgenStreamer(model, play_steps=max_new_tokens + 2, max_new_tokens=max_new_tokens)
+        set_seed(seed)
+        with torch.no_grad():
+            model.generate(**inputs, streamer=streamer, max_new_tokens=max_new_tokens, guidance_scale=1.0)
+
+            encoder_hidden_states = model.text_encoder(**inputs).last_hidden_state
+            if getattr(model, "enc_to_dec_proj", None) is not None:
+                encoder_hidden_states = model.enc_to_dec_proj(encoder_hidden_states)
+            encoder_hidden_states = encoder_hidden_states * inputs.attention_mask[..., None]
+
+            # mask the tokens the way generate() does before feeding them back to the decoder
+            input_ids = streamer.token_cache.clone()
+            _, delay_pattern_mask = model.decoder.build_delay_pattern_mask(
+                input_ids[:, :1],
+                pad_token_id=model.generation_config.decoder_start_token_id,
+                max_length=input_ids.shape[-1],
+            )
+            input_ids = model.decoder.apply_delay_pattern_mask(input_ids, delay_pattern_mask)
+
+            decoder_inputs = dict(
+                input_ids=input_ids,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=inputs.attention_mask,
+            )
+            labels = model.decoder(**decoder_inputs).logits.argmax(-1)
+        samples.append((decoder_inputs, labels))
+    return samples
+
+
+def top1_agreement(decoder, samples):
+    """The fraction of next-token predictions on which `decoder` agrees with FP32."""
+    agree, total = 0, 0
+    with torch.no_grad():
+        for decoder_inputs, labels in samples:
+            predictions = decoder(**decoder_inputs).logits.argmax(-1)
+            agree += (predictions == labels).sum().item()
+            total += labels.numel()
+    return agree / total
+
+
+def quantize(model_id=MODEL_ID, output_dir=OUTPUT_DIR, dataset_path="dataset.csv"):
+    """
+    Quantizes the linear layers of the decoder to INT8 and saves them to `output_dir`. Activations are quantized
+    dynamically, which suits autoregressive decoding on CPU; the calibration prompts drive the accuracy-aware tuning,
+    which keeps the top-1 agreement with FP32 within 1% by falling back layers to FP32 where needed.
+    """
+    from neural_compressor import PostTrainingQuantConfig
+    from neural_compressor.config import AccuracyCriterion
+    from neural_compressor.quantization import fit
+
+    model = MusicgenForConditionalGeneration.from_pretrained(model_id).eval()
+    processor = MusicgenProcessor.from_pretrained(model_id)
+    samples = calibration_set(model, processor, calibration_prompts(dataset_path))
+
+    conf = PostTrainingQuantConfig(
+        approach="dynamic",
+        # only the linear layers are quantized, the codebook embeddings stay in FP32
+        op_type_dict={"Embedding": {"weight": {"dtype": ["fp32"]}, "activation": {"dtype": ["fp32"]}}},
+        accuracy_criterion=AccuracyCriterion(criterion="relative", tolerable_loss=0.01),
+    )
+    q_model = fit(model=model.decoder, conf=conf, eval_func=lambda decoder: top1_agreement(decoder, samples))
+    q_model.save(output_dir)
+    return q_model
+
+
+def load_quantized_model(model_id=MODEL_ID, output_dir=OUTPUT_DIR):
+    """
+    Loads MusicGen with its decoder replaced by the INT8 decoder saved by `quantize`. The INT8 modules are built from
+    the FP32 decoder, whose weights are released once it is replaced.
+    """
+    from neural_compressor.utils.pytorch import load
+
+    model = MusicgenForConditionalGeneration.from_pretrained(model_id).eval()
+    model.decoder = load(output_dir, model.decoder)
+    release_memory()
+    return model
+
+
+def rss_mb(field="VmRSS"):
+    """The resident memory of this process in MB: current with `VmRSS`, the high-water mark with `VmHWM` (Linux)."""
+    with open("/proc/self/status", "r") as file:
+        for line in file:
+            if line.startswith(field + ":"):
+                # reported in kB
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def release_memory():
+    """Returns the memory freed so far to the OS, so that the resident memory reflects what is still in use."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def reset_peak_rss():
+    """Restarts the `VmHWM` high-water mark from the current resident memory. Returns `False` where it cannot."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def measure(backend, model_id=MODEL_ID, output_dir=OUTPUT_DIR, duration_s=10.0, seed=0):
+    """
+    Generates `duration_s` seconds on CPU with the given backend and returns its throughput, the resident memory once
+    the model is loaded, and the peak resident memory while generating. Loading the INT8 model goes through the FP32
+    weights, so the peak is reset after loading rather than read over the lifetime of the process.
+    """
+    if backend == "int8":
+        model = load_quantized_model(model_id, output_dir)
+    else:
+        model = MusicgenForConditionalGeneration.from_pretrained(model_id).eval()
+    processor = MusicgenProcessor.from_pretrained(model_id)
+    release_memory()
+    load_rss_mb = rss_mb()
+    peak_reset = reset_peak_rss()
+
+    max_new_tokens = int(model.audio_encoder.config.frame_rate * duration_s)
+    inputs = processor(text=calibration_prompts()[0], padding=True, return_tensors="pt")
+    streamer = MusicgenStreamer(model, play_steps=max_new_tokens + 2, max_new_tokens=max_new_tokens)
+
+    set_seed(seed)
+    start = time.perf_counter()
+    with torch.no_grad():
+        model.generate(**inputs, streamer=streamer, max_new_tokens=max_new_tokens)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "backend": backend,
+        "duration_s": duration_s,
+        "generation_s": elapsed,
+        "tokens_per_s": max_new_tokens / elapsed,
+        "real_time_factor": elapsed / duration_s,
+        "load_rss_mb": load_rss_mb,
+        # without a reset the high-water mark would include loading
+        "peak_rss_mb": rss_mb("VmHWM") if peak_reset else None,
+    }
+
+
+def report(path="quantization_report.json", **kwargs):
+    """Measures both backends, each in a fresh process so that their peak memory is not mixed up."""
+    results = []
+    for backend in ("fp32", "int8"):
+        args = [sys.executable, __file__, "measure", backend] + [f"--{k.replace('_', '-')}={v}" for k, v in kwargs.items()]
+        output = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    with open(path, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+
+    print(f"{'backend':>8} {'tokens/s':>9} {'RTF':>6} {'loaded RSS (MB)':>16} {'peak RSS (MB)':>14}")
+    for result in results:
+        peak = f"{result['peak_rss_mb']:>14.0f}" if result["peak_rss_mb"] is not None else f"{'n/a':>14}"
+        print(
+            f"{result['backend']:>8} {result['tokens_per_s']:>9.1f} {result['real_time_factor']:>6.2f} "
+            f"{result['load_rss_mb']:>16.0f} {peak}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["quantize", "measure", "report"])
+    parser.add_argument("backend", nargs="?", choices=["fp32", "int8"], default="fp32")
+    parser.add_argument("--model-id", default=MODEL_ID)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--duration-s", type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.command == "quantize":
+        quantize(args.model_id, args.output_dir)
+    elif args.command == "measure":
+        print(json.dumps(measure(args.backend, args.model_id, args.output_dir, args.duration_s)))
+    else:
+        report(model_id=args.model_id, output_dir=args.output_dir, duration_s=args.duration_s)
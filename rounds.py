@@ -0,0 +1,43 @@
+import asyncio
+import uuid
+from typing import Any, Dict, Iterable
+
+
+class RoundTracker:
+    """
+    Correlates the replies of a fan-out with the round that asked for them. Each round gets an id that is sent along
+    with the requests and echoed back in the replies; a reply resolves the future of its round, and the coordinator
+    awaits all of them with a deadline instead of polling for flags.
+    """
+
+    def __init__(self):
+        self.rounds: Dict[str, Dict[str, asyncio.Future]] = {}
+
+    def open(self, expected: Iterable[str]) -> str:
+        """Starts a round waiting for one reply per key in `expected`, and returns its id."""
+        loop = asyncio.get_running_loop()
+        round_id = uuid.uuid4().hex
+        self.rounds[round_id] = {key: loop.create_future() for key in expected}
+        return round_id
+
+    def resolve(self, round_id: str, key: str, value: Any) -> bool:
+        """Delivers a reply. Returns `False` if it belongs to a round that is over or was not expected."""
+        future = self.rounds.get(round_id, {}).get(key)
+        if future is None or future.done():
+            return False
+        future.set_result(value)
+        return True
+
+    async def gather(self, round_id: str, timeout: float) -> Dict[str, Any]:
+        """
+        Waits for the replies of a round for at most `timeout` seconds and closes it. Returns the replies that arrived,
+        so the caller can fall back for the missing ones.
+        """
+        futures = self.rounds[round_id]
+        try:
+            await asyncio.wait(list(futures.values()), timeout=timeout)
+        finally:
+            del self.rounds[round_id]
+        for future in futures.values():
+            future.cancel()
+        return {key: future.result() for key, future in futures.items() if future.done() and not future.cancelled()}
@@ -0,0 +1,69 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from time_context import TimeContext
+
+
+@dataclass
+class Session:
+    """The location of one listener, and the context and prompt that were generated for it."""
+
+    session_id: str
+    latitude: float
+    longitude: float
+    radius: float
+    last_seen: float = field(default_factory=time.monotonic)
+    nearby_places: Optional[dict] = None
+    weather: str = ""
+    time_context: Optional[TimeContext] = None
+    music_prompt: Optional[str] = None
+    # input name -> (latitude, longitude, radius, monotonic time) it was last fetched for
+    refreshed: Dict[str, Tuple[float, float, float, float]] = field(default_factory=dict)
+    # context the current music prompt was generated for
+    fingerprint: Optional[str] = None
+
+
+class SessionStore:
+    """
+    Keeps the state of every listener of the agent keyed by session id, so concurrent users do not overwrite each
+    other's location. A session stays active as long as its client keeps posting locations or asking for its prompt,
+    and is dropped after `ttl` seconds without either.
+    """
+
+    def __init__(self, ttl: float = 600.0):
+        self.ttl = ttl
+        self.sessions: Dict[str, Session] = {}
+
+    def update_location(self, session_id: str, latitude: float, longitude: float, radius: float) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = Session(session_id, latitude, longitude, radius)
+            self.sessions[session_id] = session
+        else:
+            session.latitude = latitude
+            session.longitude = longitude
+            session.radius = radius
+            session.last_seen = time.monotonic()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def expire(self) -> List[str]:
+        """Drops the sessions that have been idle for longer than the ttl, and returns their ids."""
+        deadline = time.monotonic() - self.ttl
+        expired = [session_id for session_id, session in self.sessions.items() if session.last_seen < deadline]
+        for session_id in expired:
+            del self.sessions[session_id]
+        return expired
+
+    def active(self) -> List[Session]:
+        self.expire()
+        return list(self.sessions.values())
+
+    def __len__(self) -> int:
+        return len(self.sessions)
@@ -0,0 +1,56 @@
+import pytest
+import torch
+from transformers import BatchEncoding, GenerationConfig
+
+from batching import GenerationBatcher, logits_warpers
+from benchmarks.common import tiny_musicgen
+
+
+class TokenIdProcessor:
+    """Stands in for the T5 tokenizer: each prompt is a space separated list of token ids of the same length."""
+
+    def __call__(self, text, padding=True, return_tensors="pt"):
+        input_ids = torch.tensor([[int(token) for token in prompt.split()] for prompt in text])
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_musicgen()
+
+
+def generate(batcher, requests):
+    streamers = [batcher.submit(prompt, 40, 20, seed=seed) for prompt, seed in requests]
+    for streamer in streamers:
+        # drain the audio, the codes are complete once the stream has ended
+        list(streamer)
+    return [streamer.audio_codes() for streamer in streamers]
+
+
+def test_seeded_request_is_reproduced_in_a_batch(model):
+    # a long window so that the requests submitted together land in one batch
+    batcher = GenerationBatcher(model, TokenIdProcessor(), batch_window_s=0.5)
+
+    (solo_codes,) = generate(batcher, [("5 6 7 1", 3)])
+    (batched_codes, other_codes) = generate(batcher, [("5 6 7 1", 3), ("9 8 7 1", 4)])
+
+    assert batcher.stats()["batches"] == 2
+    assert torch.equal(solo_codes, batched_codes)
+    assert not torch.equal(batched_codes, other_codes)
+
+
+def test_seeds_give_different_generations(model):
+    batcher = GenerationBatcher(model, TokenIdProcessor(), batch_window_s=0.5)
+    (first, second) = generate(batcher, [("5 6 7 1", 1), ("5 6 7 1", 2)])
+    assert not torch.equal(first, second)
+
+
+def test_warpers_follow_the_generation_config():
+    config = GenerationConfig(do_sample=True, temperature=0.5, top_k=2, top_p=0.9)
+    scores = torch.tensor([[4.0, 3.0, 2.0, 1.0]])
+    warped = logits_warpers(config)(torch.zeros(1, 1, dtype=torch.long), scores.clone())
+
+    # only the top-2 tokens are kept, at twice the logits
+    assert torch.isinf(warped[0, 2:]).all()
+    assert torch.equal(warped[0, :2], scores[0, :2] / 0.5)
+    assert len(logits_warpers(GenerationConfig(do_sample=True, top_k=0, top_p=1.0))) == 0
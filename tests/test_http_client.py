@@ -0,0 +1,134 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import http_client
+from http_client import HTTPClient
+
+
+class StubServer:
+    """Local HTTP server answering each path with a scripted list of statuses, the last one repeating."""
+
+    def __init__(self):
+        self.scripts = {}
+        self.calls = {}
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    calls = stub.calls.get(self.path, 0)
+                    stub.calls[self.path] = calls + 1
+                    script = stub.scripts.get(self.path, [200])
+                    status = script[min(calls, len(script) - 1)]
+                time.sleep(stub.delay)
+                body = json.dumps({"status": status}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with stub.lock:
+                    stub.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    with StubServer() as server:
+        yield server
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the backoff delays instead of waiting them out."""
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(http_client.asyncio, "sleep", record)
+    return delays
+
+
+def run(client, call):
+    """Runs `call()` on a fresh event loop, which the client's connections are bound to, and closes the client."""
+
+    async def main():
+        try:
+            return await call()
+        finally:
+            await client.close()
+
+    return asyncio.run(main())
+
+
+def test_retries_transient_statuses_then_succeeds(stub, sleeps):
+    stub.scripts["/flaky"] = [429, 503, 200]
+    client = HTTPClient(stub.url, retries=2, backoff=0.25)
+
+    assert run(client, lambda: client.get_json("/flaky")) == {"status": 200}
+    assert stub.calls["/flaky"] == 3
+    assert client.stats() == {"requests": 3, "retried": 2, "failures": 0}
+    # full jitter: each wait is drawn from [0, backoff * 2**attempt]
+    assert len(sleeps) == 2
+    for attempt, delay in enumerate(sleeps):
+        assert 0.0 <= delay <= 0.25 * 2**attempt
+
+
+def test_gives_up_after_the_retries(stub, sleeps):
+    stub.scripts["/down"] = [503]
+    client = HTTPClient(stub.url, retries=2, backoff=0.25)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(client, lambda: client.get_json("/down"))
+    assert stub.calls["/down"] == 3
+    assert client.stats() == {"requests": 3, "retried": 2, "failures": 1}
+
+
+def test_does_not_retry_other_errors(stub, sleeps):
+    stub.scripts["/missing"] = [404]
+    client = HTTPClient(stub.url, retries=2)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(client, lambda: client.get_json("/missing"))
+    assert stub.calls["/missing"] == 1
+    assert sleeps == []
+
+
+def test_limits_the_calls_in_flight(stub):
+    stub.delay = 0.1
+    client = HTTPClient(stub.url, max_concurrency=3)
+
+    async def get_many():
+        return await asyncio.gather(*(client.get_json(f"/item/{i}") for i in range(10)))
+
+    assert len(run(client, get_many)) == 10
+    assert stub.max_in_flight == 3
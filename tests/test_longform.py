@@ -0,0 +1,117 @@
+import numpy as np
+import soundfile as sf
+import torch
+
+from longform import generate_longform, split_segments
+
+FRAME_RATE = 50
+SAMPLE_RATE = 800
+HOP_LENGTH = SAMPLE_RATE // FRAME_RATE
+SCALE = 8000.0
+# added to the audio of each decode, so that the windows differ where they overlap
+WINDOW_OFFSET = 0.1
+
+
+class FakeCompressionModel:
+    def __init__(self):
+        self.calls = 0
+
+    def decode(self, tokens):
+        # frame `f` decodes to the samples `f * HOP_LENGTH ...`, so audio placed at the wrong offset shows up
+        samples = tokens[0, 0, :, None].float() * HOP_LENGTH + torch.arange(HOP_LENGTH)
+        audio = samples.reshape(1, 1, -1) / SCALE + WINDOW_OFFSET * self.calls
+        self.calls += 1
+        return audio
+
+
+class FakeMusicGen:
+    """Stands in for audiocraft's `MusicGen`: every window continues the frame count of its prompt tokens."""
+
+    frame_rate = FRAME_RATE
+    sample_rate = SAMPLE_RATE
+    audio_channels = 1
+    num_codebooks = 4
+
+    def __init__(self):
+        self.compression_model = FakeCompressionModel()
+        self.descriptions = []
+        self.prompt_tokens = []
+
+    def set_generation_params(self, duration):
+        self.window_frames = int(duration * self.frame_rate)
+
+    def _prepare_tokens_and_attributes(self, descriptions, prompt):
+        self.descriptions.extend(descriptions)
+        return descriptions, None
+
+    def _generate_tokens(self, attributes, prompt_tokens):
+        self.prompt_tokens.append(prompt_tokens)
+        first = 0 if prompt_tokens is None else int(prompt_tokens[0, 0, 0])
+        frames = torch.arange(first, first + self.window_frames)
+        return frames.expand(1, self.num_codebooks, -1).clone()
+
+
+def generate(tmp_path, duration=4.5, context=0.5, fade=0.1, **kwargs):
+    model = FakeMusicGen()
+    path = str(tmp_path / "track.wav")
+    codes = generate_longform(
+        model, ["a", "b"], duration, path, window=2.0, context=context, fade=fade, normalize=False, **kwargs
+    )
+    audio, sample_rate = sf.read(path, dtype="float32")
+    assert sample_rate == SAMPLE_RATE
+    return model, codes, audio
+
+
+def expected_audio(num_samples, window_ends, fade_samples):
+    """The decoded ramp, shifted by each window's offset and cross-faded over `fade_samples` before each window end."""
+    audio = np.arange(num_samples) / SCALE
+    offsets = np.zeros(num_samples)
+    for end in window_ends[:-1]:
+        offsets[end:] += WINDOW_OFFSET
+        offsets[end - fade_samples : end] += WINDOW_OFFSET * np.linspace(0.0, 1.0, fade_samples)
+    return audio + offsets
+
+
+def test_writes_the_duration_and_returns_the_codes_without_the_context(tmp_path):
+    model, codes, audio = generate(tmp_path)
+    # windows of 100 frames, each after the first starting with the 25 context frames: 100 + 75 + 50 (cut short)
+    assert len(audio) == 225 * HOP_LENGTH
+    assert codes.dtype == torch.int16 and codes.shape == (4, 225)
+    assert torch.equal(codes, torch.arange(225, dtype=torch.int16).expand(4, -1))
+
+
+def test_conditions_each_window_on_the_tail_of_the_previous_one(tmp_path):
+    model, _, _ = generate(tmp_path)
+    assert model.prompt_tokens[0] is None
+    assert [tokens[0, 0].tolist() for tokens in model.prompt_tokens[1:]] == [
+        list(range(75, 100)),
+        list(range(150, 175)),
+    ]
+
+
+def test_cross_fades_the_windows_where_they_overlap(tmp_path):
+    _, _, audio = generate(tmp_path, fade=0.1)
+    fade_samples = int(0.1 * SAMPLE_RATE)
+    expected = expected_audio(len(audio), [100 * HOP_LENGTH, 175 * HOP_LENGTH, 225 * HOP_LENGTH], fade_samples)
+    np.testing.assert_allclose(audio, expected, atol=1e-4)
+
+
+def test_the_cross_fade_is_at_most_the_context(tmp_path):
+    # a 1 frame context leaves a single frame of overlap to fade over
+    _, _, audio = generate(tmp_path, duration=4.0, context=1 / FRAME_RATE, fade=0.5)
+    window_ends = [100 * HOP_LENGTH, 199 * HOP_LENGTH, 200 * HOP_LENGTH]
+    np.testing.assert_allclose(audio, expected_audio(len(audio), window_ends, HOP_LENGTH), atol=1e-4)
+
+
+def test_switches_prompts_by_segment(tmp_path):
+    # windows starting at 0, 2 and 3.5 seconds
+    model, _, _ = generate(tmp_path, segment_duration=2.0)
+    assert model.descriptions == ["a", "b", "b"]
+    model, _, _ = generate(tmp_path, segment_duration=3.0)
+    assert model.descriptions == ["a", "a", "b"]
+
+
+def test_split_segments():
+    description = "music in five parts - FIRSTLY rain on a roof, SECONDLY - waves, THIRD: birds at dawn."
+    assert split_segments(description) == ["rain on a roof", "waves", "birds at dawn"]
+    assert split_segments("rain on a roof") == ["rain on a roof"]
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import torch
+
+from benchmarks.common import tiny_musicgen
+from musicgen_streamer import MusicgenStreamer
+
+
+def generate(model, incremental, play_steps=20, max_new_tokens=120, seed=0):
+    streamer = MusicgenStreamer(model, play_steps=play_steps, incremental=incremental, max_new_tokens=max_new_tokens)
+    prompt_generator = torch.Generator().manual_seed(1)
+    input_ids = torch.randint(0, model.config.text_encoder.vocab_size, (1, 8), generator=prompt_generator)
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            streamer=streamer,
+            max_new_tokens=max_new_tokens,
+        )
+    return list(streamer)
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_musicgen()
+
+
+@pytest.mark.parametrize("play_steps", [10, 20])
+def test_incremental_decoding_matches_full_decode(model, play_steps):
+    # same seed, so both streams decode the same tokens and only the decoding strategy differs
+    full = np.concatenate(generate(model, incremental=False, play_steps=play_steps))
+    incremental = np.concatenate(generate(model, incremental=True, play_steps=play_steps))
+
+    assert incremental.shape == full.shape
+    np.testing.assert_allclose(incremental, full, atol=1e-4 * max(1.0, np.abs(full).max()))
@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import AutoReconnect
+
+import persistence
+from persistence import SCHEMAS, Persistence, point
+
+
+class FakeCollection:
+    """Stands in for an async collection: applies bulk writes to a dict of documents by `_id`."""
+
+    def __init__(self):
+        self.documents = {}
+        self.writes = []
+        self.indexes = []
+        self.failures = 0
+
+    async def bulk_write(self, requests, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect("connection refused")
+        self.writes.append(list(requests))
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self.documents[len(self.documents)] = dict(request._doc)
+            else:
+                key = request._filter["_id"]
+                self.documents.setdefault(key, {"_id": key}).update(request._doc["$set"])
+
+    async def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+        self.validators = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def __getattr__(self, name):
+        return self[name]
+
+    async def list_collection_names(self):
+        return list(self.validators)
+
+    async def create_collection(self, name, validator=None):
+        self.validators[name] = validator
+
+    async def command(self, command, name, validator=None):
+        assert command == "collMod" and name in self.validators
+        self.validators[name] = validator
+
+
+class FakeClient:
+    def __init__(self, *args, **kwargs):
+        self.database = FakeDatabase()
+        self.closed = False
+
+    def __getitem__(self, name):
+        return self.database
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def fake_mongo(monkeypatch):
+    monkeypatch.setattr(persistence, "AsyncMongoClient", FakeClient)
+
+
+def run(main):
+    return asyncio.run(main())
+
+
+async def started(**kwargs):
+    store = Persistence(**kwargs)
+    await store.start()
+    # until the schema is set up
+    while not store.ready:
+        await asyncio.sleep(0)
+    return store
+
+
+def test_creates_the_collections_with_their_validators():
+    async def main():
+        store = await started()
+        db = store.client.database
+        await store.stop()
+        return db
+
+    db = run(main)
+    assert db.validators == {name: {"$jsonSchema": schema} for name, schema in SCHEMAS.items()}
+    assert ("updated_at", {"expireAfterSeconds": 24 * 3600}) in db["sessions"].indexes
+
+
+def test_updates_the_validators_of_existing_collections():
+    async def main():
+        store = Persistence()
+        store.client = FakeClient()
+        await store.client.database.create_collection("sessions", validator={})
+        await store.ensure_schema()
+        return store.client.database
+
+    assert run(main).validators["sessions"] == {"$jsonSchema": SCHEMAS["sessions"]}
+
+
+def test_take_merges_the_upserts_of_a_document():
+    operations = Persistence.take(
+        ("sessions", "a", {"radius": 10.0}),
+        ("prompts", None, {"prompt": "rain"}),
+        ("sessions", "a", {"radius": 20.0, "prompt": "waves"}),
+        ("sessions", "b", {"radius": 5.0}),
+    )
+    assert operations == {
+        "prompts": [InsertOne({"prompt": "rain"})],
+        "sessions": [
+            UpdateOne({"_id": "a"}, {"$set": {"radius": 20.0, "prompt": "waves"}}, upsert=True),
+            UpdateOne({"_id": "b"}, {"$set": {"radius": 5.0}}, upsert=True),
+        ],
+    }
+
+
+def test_writes_the_records_of_a_window_in_one_batch():
+    async def main():
+        store = await started(flush_interval=0.05)
+        for radius in (10.0, 20.0, 30.0):
+            store.record_session("a", 34.0, -118.0, radius)
+        store.record_prompt("a", 34.0, -118.0, "rain")
+        await asyncio.sleep(0.2)
+        db = store.client.database
+        await store.stop()
+        return store, db
+
+    store, db = run(main)
+    # the three location updates are merged into one upsert
+    assert [len(requests) for requests in db["sessions"].writes] == [1]
+    assert db["sessions"].documents["a"]["radius"] == 30.0
+    assert db["sessions"].documents["a"]["location"] == point(34.0, -118.0)
+    assert list(db["prompts"].documents.values())[0]["prompt"] == "rain"
+    assert store.stats()["batches"] == 1 and store.stats()["written"] == 2
+
+
+def test_retries_a_failed_batch():
+    async def main():
+        store = await started(flush_interval=0.01, retry_interval=0.01)
+        store.client.database["tracks"].failures = 2
+        store.record_track("t", "a", "rain", 30.0, 0, location=(34.0, -118.0))
+        await asyncio.sleep(0.2)
+        await store.stop()
+        return store
+
+    store = run(main)
+    assert store.client.database["tracks"].documents["t"]["prompt"] == "rain"
+    assert store.stats()["failures"] == 2
+
+
+def test_stop_writes_the_held_records():
+    async def main():
+        # a window long enough that the records are still held by the writer when it is stopped
+        store = await started(flush_interval=60.0)
+        for i in range(3):
+            store.record_prompt(f"session-{i}", 34.0, -118.0, "rain")
+        await asyncio.sleep(0.05)
+        assert store.stats()["queued"] == 0 and store.stats()["written"] == 0
+        client = store.client
+        await store.stop()
+        return store, client
+
+    store, client = run(main)
+    sessions = sorted(document["session_id"] for document in client.database["prompts"].documents.values())
+    assert sessions == ["session-0", "session-1", "session-2"]
+    assert client.closed and store.stats()["written"] == 3
+
+
+def test_stop_writes_a_record_queued_as_it_stops():
+    async def main():
+        store = await started(flush_interval=60.0, batch_size=2)
+        # two full batches are written, the fifth record waits for the rest of its batch
+        for i in range(5):
+            store.record_prompt(f"session-{i}", 34.0, -118.0, "rain")
+        await asyncio.sleep(0.05)
+        # wakes up the writer in the same step it is cancelled
+        store.record_prompt("session-5", 34.0, -118.0, "rain")
+        # cancels the writer again should the first cancellation be swallowed, rather than hang
+        watchdog = asyncio.get_running_loop().call_later(2.0, lambda: swallowed.append(store.flusher.cancel()))
+        await store.stop()
+        watchdog.cancel()
+        return store
+
+    swallowed = []
+    store = run(main)
+    assert not swallowed
+    assert store.stats()["written"] == 6 and store.flusher is None
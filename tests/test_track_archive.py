@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from benchmarks.common import tiny_musicgen
+from musicgen_streamer import MusicgenStreamer
+from track_archive import TrackArchive
+
+PLAY_STEPS = 20
+MAX_NEW_TOKENS = 150
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_musicgen()
+
+
+@pytest.fixture(scope="module")
+def streamed(model):
+    """The chunks of an incremental stream, as `stream_chunks` yields them, and the streamer that produced them."""
+    streamer = MusicgenStreamer(model, play_steps=PLAY_STEPS, incremental=True, max_new_tokens=MAX_NEW_TOKENS)
+    prompt_generator = torch.Generator().manual_seed(1)
+    input_ids = torch.randint(0, model.config.text_encoder.vocab_size, (1, 8), generator=prompt_generator)
+    torch.manual_seed(0)
+    with torch.no_grad():
+        model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            streamer=streamer,
+            max_new_tokens=MAX_NEW_TOKENS,
+        )
+    return list(streamer), streamer
+
+
+@pytest.fixture
+def archive(tmp_path, model, streamed):
+    archive = TrackArchive(str(tmp_path))
+    _, streamer = streamed
+    config = model.config.audio_encoder
+    archive.save("track", streamer.audio_codes(), config.frame_rate, config.sampling_rate, prompt="rain", seed=0)
+    return archive
+
+
+def assert_matches(audio, reference):
+    assert audio.shape == reference.shape
+    np.testing.assert_allclose(audio, reference, atol=1e-4 * max(1.0, np.abs(reference).max()))
+
+
+def test_decode_matches_the_streamed_audio(model, streamed, archive):
+    chunks, _ = streamed
+    assert_matches(archive.decode("track", model.audio_encoder), np.concatenate(chunks))
+
+
+def test_stream_replays_the_streamed_audio(model, streamed, archive):
+    chunks, _ = streamed
+    replayed = list(archive.stream("track", model.audio_encoder, PLAY_STEPS))
+    assert all(len(chunk) == PLAY_STEPS * archive.metadata("track")["hop_length"] for chunk in replayed[:-1])
+    assert_matches(np.concatenate(replayed), np.concatenate(chunks))
+
+
+def test_decodes_a_time_range(model, archive):
+    full = archive.decode("track", model.audio_encoder)
+    hop_length = archive.metadata("track")["hop_length"]
+    audio = archive.decode("track", model.audio_encoder, start_s=0.5, end_s=1.5)
+    assert_matches(audio, full[25 * hop_length : 75 * hop_length])
+
+
+def test_codes_are_stored_compactly(streamed, archive):
+    _, streamer = streamed
+    codes = archive.codes("track")
+    assert codes.dtype == np.int16
+    np.testing.assert_array_equal(codes, streamer.audio_codes().numpy())
+    assert archive.get("track")["prompt"] == "rain"
+    assert archive.get("missing") is None
+    assert archive.stats()["hits"] == 1 and archive.stats()["misses"] == 1
+
+
+def test_evicts_the_least_recently_used_tracks(tmp_path):
+    archive = TrackArchive(str(tmp_path))
+    codes = np.zeros((4, 100), dtype=np.int16)
+    for i, track in enumerate(["a", "b", "c"]):
+        archive.save(track, codes, 50, 32000)
+        os.utime(archive.metadata_path(track), (i, i))
+    archive.get("a")
+    archive.max_size_bytes = 2 * archive.entries()[0][1]
+    archive.evict()
+
+    assert archive.tracks() == ["a", "c"]
+    assert not os.path.exists(archive.codes_path("b"))
+    assert "b" not in archive and "a" in archive
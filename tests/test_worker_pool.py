@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+from transformers import BatchEncoding
+
+from batching import GenerationBatcher
+from benchmarks.common import tiny_musicgen
+from worker_pool import GenerationWorkerPool
+
+PLAY_STEPS = 20
+MAX_NEW_TOKENS = 60
+
+
+class TokenIdProcessor:
+    """Stands in for the T5 tokenizer: a prompt is a space separated list of token ids, the pool sends one at a time."""
+
+    def __call__(self, text, padding=True, return_tensors="pt"):
+        prompts = [text] if isinstance(text, str) else text
+        input_ids = torch.tensor([[int(token) for token in prompt.split()] for prompt in prompts])
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_musicgen()
+
+
+@pytest.fixture
+def pool(model):
+    # a chunk timeout, so that a hung worker fails the test instead of blocking it
+    pool = GenerationWorkerPool(model, TokenIdProcessor(), num_workers=2, timeout=60.0)
+    yield pool
+    pool.close()
+
+
+def test_streams_the_requests_from_the_workers(model, pool):
+    streams = [pool.submit(prompt, MAX_NEW_TOKENS, PLAY_STEPS, seed=3) for prompt in ("5 6 7 1", "9 8 7 1")]
+    hop_length = model.config.audio_encoder.sampling_rate // model.config.audio_encoder.frame_rate
+    for stream in streams:
+        chunks = list(stream)
+        codes = stream.audio_codes()
+        assert codes.dtype == torch.int16 and codes.shape[0] == model.config.decoder.num_codebooks
+        # the chunks add up to the audio of the codes
+        assert sum(len(chunk) for chunk in chunks) == codes.shape[1] * hop_length
+        assert all(np.isfinite(chunk).all() for chunk in chunks)
+
+    # sampled like in the batcher, so the same seed gives the same track either way
+    batcher = GenerationBatcher(model, TokenIdProcessor())
+    streamer = batcher.submit("5 6 7 1", MAX_NEW_TOKENS, PLAY_STEPS, seed=3, incremental=True)
+    list(streamer)
+    assert torch.equal(streams[0].audio_codes(), streamer.audio_codes().to(torch.int16))
+
+
+def test_close_stops_the_workers(pool):
+    workers = list(pool.workers)
+    pool.close()
+    assert all(not worker.is_alive() and worker.exitcode == 0 for worker in workers)
+    # the fixture closes the pool again
+    pool.workers = []
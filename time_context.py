@@ -0,0 +1,103 @@
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pytz
+from timezonefinder import TimezoneFinder
+
+# (first hour, bucket) in local time, each bucket lasting until the next one starts
+TIME_BUCKETS = (
+    (0, "night"),
+    (5, "dawn"),
+    (7, "morning"),
+    (12, "afternoon"),
+    (17, "evening"),
+    (21, "night"),
+)
+
+
+def time_bucket(hour: int) -> str:
+    bucket = TIME_BUCKETS[0][1]
+    for start, name in TIME_BUCKETS:
+        if hour >= start:
+            bucket = name
+    return bucket
+
+
+@dataclass(frozen=True)
+class TimeContext:
+    """Local time at a location, and the part of the day it falls in."""
+
+    timezone: str
+    hour: int
+    minute: int
+    bucket: str
+
+    @classmethod
+    def at(cls, timezone: str, now: Optional[datetime] = None) -> "TimeContext":
+        now = now or datetime.now(pytz.utc)
+        local = now.astimezone(pytz.timezone(timezone))
+        return cls(timezone, local.hour, local.minute, time_bucket(local.hour))
+
+    def clock(self) -> str:
+        """The time as "h:mm AM/PM"."""
+        return f"{(self.hour - 1) % 12 + 1}:{self.minute:02d} {'AM' if self.hour < 12 else 'PM'}"
+
+    def describe(self) -> str:
+        return f"{self.clock()}, {self.bucket}"
+
+
+class TimeContextResolver:
+    """
+    Resolves the local time of coordinates. The finder loads its polygon data once, when the resolver is built, and zone
+    lookups are cached by coordinates rounded to `precision` decimals (2 is about 1 km), which is far finer than any
+    time zone border needs for a soundscape.
+    """
+
+    def __init__(self, precision: int = 2, cache_size: int = 65536):
+        self.precision = precision
+        self.finder = TimezoneFinder(in_memory=True)
+        self.zone_at = lru_cache(maxsize=cache_size)(self._zone_at)
+
+    def _zone_at(self, latitude: float, longitude: float) -> str:
+        zone = self.finder.timezone_at(lat=latitude, lng=longitude)
+        if zone is None:
+            # open sea: fall back to the nautical zone of the longitude, whose Etc/ sign is inverted
+            offset = int(round(longitude / 15.0))
+            zone = "Etc/GMT" + (f"{-offset:+d}" if offset else "")
+        return zone
+
+    def timezone(self, latitude: float, longitude: float) -> str:
+        return self.zone_at(round(latitude, self.precision), round(longitude, self.precision))
+
+    def resolve(self, latitude: float, longitude: float, now: Optional[datetime] = None) -> TimeContext:
+        return TimeContext.at(self.timezone(latitude, longitude), now)
+
+    def resolve_many(
+        self, coordinates: Iterable[Tuple[float, float]], now: Optional[datetime] = None
+    ) -> List[TimeContext]:
+        """
+        Resolves many (latitude, longitude) pairs at once: the coordinates are rounded and deduplicated in one numpy
+        pass, each distinct cell is looked up once and the local time is computed once per distinct zone.
+        """
+        points = np.round(np.asarray(list(coordinates), dtype=np.float64).reshape(-1, 2), self.precision)
+        if len(points) == 0:
+            return []
+        cells, inverse = np.unique(points, axis=0, return_inverse=True)
+        zones = [self.zone_at(float(latitude), float(longitude)) for latitude, longitude in cells]
+
+        now = now or datetime.now(pytz.utc)
+        contexts = {zone: TimeContext.at(zone, now) for zone in set(zones)}
+        return [contexts[zones[i]] for i in inverse.reshape(-1)]
+
+    def stats(self) -> dict:
+        info = self.zone_at.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "cached_cells": info.currsize,
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
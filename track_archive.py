@@ -0,0 +1,183 @@
+import hashlib
+import json
+import math
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+import torch
+
+
+class TrackArchive:
+    def __init__(self, archive_dir: str = "archive/tracks", max_size_bytes: int = 2 * 1024**3):
+        """
+        Library of generated tracks stored as their EnCodec codes rather than as waveforms, which doubles as the cache
+        of seeded generations: a track is named by a hash of everything that determines its output, so a request for
+        it is answered by decoding its codes. A track is a `(num_codebooks, frames)` int16 array of codes next to a
+        JSON file of metadata; at 50 frames a second and 4 codebooks a 5 minute track takes 120 KB, against ~19 MB as a
+        32 kHz 16-bit WAV. Codes are memory-mapped on read and only the requested time range is decoded.
+        Tracks are evicted least recently used first once the archive grows past `max_size_bytes`; the modification
+        time of a track's metadata file is bumped on every hit and serves as its last use.
+        Parameters:
+            archive_dir (`str`, *optional*, defaults to `"archive/tracks"`):
+                The directory the tracks are stored in. Created if it does not exist.
+            max_size_bytes (`int`, *optional*, defaults to 2 GiB):
+                The total size of the tracks above which the least recently used ones are evicted.
+        """
+        self.archive_dir = archive_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(archive_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model_id: str, text_prompt: str, seed: int, duration: float, play_steps: Optional[float]) -> str:
+        payload = json.dumps([model_id, text_prompt, seed, float(duration), play_steps])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def codes_path(self, track_id: str) -> str:
+        return os.path.join(self.archive_dir, track_id + ".npy")
+
+    def metadata_path(self, track_id: str) -> str:
+        return os.path.join(self.archive_dir, track_id + ".json")
+
+    def __contains__(self, track_id: str) -> bool:
+        # the metadata is written last, so a track is complete once it exists
+        return os.path.exists(self.metadata_path(track_id))
+
+    def save(self, track_id: str, audio_codes, frame_rate: int, sampling_rate: int, **metadata):
+        """
+        Stores the `(num_codebooks, frames)` codes of a track, along with the codec rates needed to decode them and any
+        extra `metadata` (prompt, seed, model id...).
+        """
+        if isinstance(audio_codes, torch.Tensor):
+            audio_codes = audio_codes.cpu().numpy()
+        audio_codes = np.asarray(audio_codes, dtype=np.int16)
+
+        metadata = dict(
+            metadata,
+            num_codebooks=audio_codes.shape[0],
+            num_frames=audio_codes.shape[1],
+            frame_rate=frame_rate,
+            sampling_rate=sampling_rate,
+            hop_length=sampling_rate // frame_rate,
+        )
+        # write to temporary files first so a concurrent reader never sees a partial track
+        suffix = f".{os.getpid()}.tmp"
+        with open(self.codes_path(track_id) + suffix, "wb") as outfile:
+            np.save(outfile, audio_codes)
+        with open(self.metadata_path(track_id) + suffix, "w") as outfile:
+            json.dump(metadata, outfile)
+        os.replace(self.codes_path(track_id) + suffix, self.codes_path(track_id))
+        os.replace(self.metadata_path(track_id) + suffix, self.metadata_path(track_id))
+        self.evict()
+
+    def metadata(self, track_id: str) -> dict:
+        with open(self.metadata_path(track_id), "r") as file:
+            return json.load(file)
+
+    def get(self, track_id: str) -> Optional[dict]:
+        """Returns the metadata of a track and marks it as used, or `None` on a miss."""
+        try:
+            metadata = self.metadata(track_id)
+            os.utime(self.metadata_path(track_id))
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return metadata
+
+    def codes(self, track_id: str) -> np.ndarray:
+        """Memory-maps the codes of a track, so that only the frames that get decoded are read from disk."""
+        return np.load(self.codes_path(track_id), mmap_mode="r")
+
+    def tracks(self):
+        return sorted(name[: -len(".json")] for name in os.listdir(self.archive_dir) if name.endswith(".json"))
+
+    def decode(
+        self,
+        track_id: str,
+        audio_encoder,
+        start_s: float = 0.0,
+        end_s: Optional[float] = None,
+        context_frames: int = 50,
+    ) -> np.ndarray:
+        """
+        Decodes the audio of a track between `start_s` and `end_s` with `audio_encoder` (`model.audio_encoder`).
+        `context_frames` extra frames are decoded on each side and trimmed off, so that consecutive ranges join
+        without audible seams.
+        """
+        metadata = self.metadata(track_id)
+        frame_rate = metadata["frame_rate"]
+        start_frame = max(0, math.floor(start_s * frame_rate))
+        end_frame = metadata["num_frames"] if end_s is None else math.ceil(end_s * frame_rate)
+        return self.decode_frames(track_id, audio_encoder, metadata, start_frame, end_frame, context_frames)
+
+    def decode_frames(
+        self, track_id: str, audio_encoder, metadata: dict, start_frame: int, end_frame: int, context_frames: int
+    ) -> np.ndarray:
+        num_frames = metadata["num_frames"]
+        hop_length = metadata["hop_length"]
+        end_frame = min(num_frames, end_frame)
+        if end_frame <= start_frame:
+            return np.zeros(0, dtype=np.float32)
+
+        codes = self.codes(track_id)
+        context_start = max(0, start_frame - context_frames)
+        context_end = min(num_frames, end_frame + context_frames)
+        audio_codes = torch.from_numpy(np.asarray(codes[:, context_start:context_end], dtype=np.int64))
+
+        with torch.no_grad():
+            output_values = audio_encoder.decode(
+                audio_codes[None, None, ...].to(audio_encoder.device),
+                audio_scales=[None],
+            )
+        audio_values = output_values.audio_values[0, 0].cpu().float().numpy()
+        offset = (start_frame - context_start) * hop_length
+        return audio_values[offset : offset + (end_frame - start_frame) * hop_length]
+
+    def stream(self, track_id: str, audio_encoder, chunk_frames: int, context_frames: int = 50) -> Iterator[np.ndarray]:
+        """Decodes a whole track `chunk_frames` frames at a time, for replaying it like a generation streams it."""
+        metadata = self.metadata(track_id)
+        for start_frame in range(0, metadata["num_frames"], chunk_frames):
+            yield self.decode_frames(
+                track_id, audio_encoder, metadata, start_frame, start_frame + chunk_frames, context_frames
+            )
+
+    def entries(self):
+        """Lists `(track_id, size, last_used)` for every track, least recently used first."""
+        entries = []
+        for track_id in self.tracks():
+            try:
+                stat = os.stat(self.metadata_path(track_id))
+                size = stat.st_size + os.path.getsize(self.codes_path(track_id))
+            except FileNotFoundError:
+                continue
+            entries.append((track_id, size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for track_id, entry_size, _ in entries:
+            if size <= self.max_size_bytes:
+                break
+            # the metadata goes first, so the track stops being served before its codes disappear
+            for path in (self.metadata_path(track_id), self.codes_path(track_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            size -= entry_size
+
+    def stats(self):
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "tracks": len(entries),
+            "size_bytes": sum(entry[1] for entry in entries),
+            "max_size_bytes": self.max_size_bytes,
+        }
@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Set
+
+from places_cache import distance_m, geohash, geohash_cell_size, neighbourhood
+
+
+@dataclass
+class IndexedTrack:
+    """A generated track, and where and in which conditions its prompt was generated."""
+
+    track_id: str
+    latitude: float
+    longitude: float
+    time_bucket: str
+    weather: str = ""
+    prompt: str = ""
+    created: float = field(default_factory=time.time)
+
+
+class TrackIndex:
+    """
+    Generated tracks by the geohash cell of the location they were generated for, so that a listener arriving in an
+    area that was covered before can hear one right away while their own track is generated.
+
+    A track is compatible with a listener when it was generated for the same part of the day and, if both are known, the
+    same weather category. `nearest` searches the listener's cell and its eight neighbours, so with cells of
+    `precision` it finds every track within about one cell width (~4 km at the default of 5, less towards the poles);
+    `max_distance` is kept below that. The oldest tracks are dropped past `max_entries`.
+    """
+
+    def __init__(self, precision: int = 5, max_distance: float = 3000.0, max_entries: int = 50000):
+        height, width = geohash_cell_size(precision)
+        # at least one cell in every direction is searched, not more than that can be guaranteed
+        if max_distance > min(height, width) * 111320.0:
+            raise ValueError(f"max_distance {max_distance} m is larger than the cells of precision {precision}")
+        self.precision = precision
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.tracks: "OrderedDict[str, IndexedTrack]" = OrderedDict()
+        self.cells: Dict[str, Set[str]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, track: IndexedTrack):
+        self.remove(track.track_id)
+        self.tracks[track.track_id] = track
+        self.cells.setdefault(geohash(track.latitude, track.longitude, self.precision), set()).add(track.track_id)
+        while len(self.tracks) > self.max_entries:
+            self.remove(next(iter(self.tracks)))
+
+    def remove(self, track_id: str):
+        track = self.tracks.pop(track_id, None)
+        if track is None:
+            return
+        cell = geohash(track.latitude, track.longitude, self.precision)
+        self.cells[cell].discard(track_id)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    @staticmethod
+    def compatible(track: IndexedTrack, time_bucket: str, weather: str = "") -> bool:
+        return track.time_bucket == time_bucket and (not weather or not track.weather or track.weather == weather)
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        time_bucket: str,
+        weather: str = "",
+        available: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[IndexedTrack]:
+        """
+        The closest compatible track within `max_distance` metres, or `None`. Tracks for which `available(track_id)` is
+        false (e.g. evicted from the audio cache since) are dropped from the index on the way.
+        """
+        candidates = []
+        for cell in neighbourhood(latitude, longitude, self.precision):
+            for track_id in self.cells.get(cell, ()):
+                track = self.tracks[track_id]
+                if not self.compatible(track, time_bucket, weather):
+                    continue
+                distance = distance_m(latitude, longitude, track.latitude, track.longitude)
+                if distance <= self.max_distance:
+                    candidates.append((distance, track))
+
+        for _, track in sorted(candidates, key=lambda candidate: candidate[0]):
+            if available is None or available(track.track_id):
+                self.hits += 1
+                return track
+            self.remove(track.track_id)
+        self.misses += 1
+        return None
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "tracks": len(self.tracks),
+            "cells": len(self.cells),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,126 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Tuple
+
+from http_client import current_weather
+
+Cell = Tuple[int, int]
+
+
+@dataclass
+class CachedWeather:
+    description: str
+    expires: float
+
+
+class WeatherService:
+    """
+    Weather descriptions cached per grid cell of `grid_deg` degrees (0.05 is about 5 km), since weather barely changes
+    across a few hundred metres or a few minutes and many sessions in a city share a cell.
+
+    Concurrent misses for the same cell share one upstream request, and an entry that is read within `refresh_before`
+    seconds of expiring is refreshed in the background while the cached value is returned, so a listener that keeps
+    polling never waits on the network after its first tick. If a refresh fails the last description keeps being served
+    for up to `stale_s` seconds past its expiry.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str, float, float], Awaitable[str]] = current_weather,
+        ttl: float = 600.0,
+        grid_deg: float = 0.05,
+        refresh_before: float = 60.0,
+        stale_s: float = 1800.0,
+        max_entries: int = 4096,
+    ):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.grid_deg = grid_deg
+        self.refresh_before = refresh_before
+        self.stale_s = stale_s
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Cell, CachedWeather]" = OrderedDict()
+        self.inflight: Dict[Cell, asyncio.Task] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.upstream_calls = 0
+        self.failures = 0
+
+    def cell(self, latitude: float, longitude: float) -> Cell:
+        return math.floor(latitude / self.grid_deg), math.floor(longitude / self.grid_deg)
+
+    def centre(self, cell: Cell) -> Tuple[float, float]:
+        return (cell[0] + 0.5) * self.grid_deg, (cell[1] + 0.5) * self.grid_deg
+
+    async def get(self, api_key: str, latitude: float, longitude: float) -> str:
+        """Returns the weather description for the cell of the point, fetching it if it is not cached."""
+        cell = self.cell(latitude, longitude)
+        entry = self.entries.get(cell)
+        now = time.monotonic()
+
+        if entry is not None and now < entry.expires:
+            self.entries.move_to_end(cell)
+            self.hits += 1
+            if entry.expires - now < self.refresh_before and cell not in self.inflight:
+                self.refreshes += 1
+                self.load(api_key, cell)
+            return entry.description
+
+        self.misses += 1
+        if cell in self.inflight:
+            self.coalesced += 1
+        try:
+            # shielded so a caller that gives up does not cancel the request the other callers are waiting on
+            return await asyncio.shield(self.load(api_key, cell))
+        except Exception:
+            if entry is not None and now < entry.expires + self.stale_s:
+                return entry.description
+            raise
+
+    def load(self, api_key: str, cell: Cell) -> asyncio.Task:
+        """Starts the upstream request for a cell, or returns the one already running."""
+        task = self.inflight.get(cell)
+        if task is None:
+            task = asyncio.ensure_future(self.refresh(api_key, cell))
+            self.inflight[cell] = task
+            task.add_done_callback(lambda _: self.finished(cell, task))
+        return task
+
+    def finished(self, cell: Cell, task: asyncio.Task):
+        self.inflight.pop(cell, None)
+        if not task.cancelled():
+            # marks the error of a background refresh as handled; it was already reported
+            task.exception()
+
+    async def refresh(self, api_key: str, cell: Cell) -> str:
+        self.upstream_calls += 1
+        try:
+            description = await self.fetch(api_key, *self.centre(cell))
+        except Exception as e:
+            self.failures += 1
+            print(f"Error: Weather refresh for cell {cell} failed: {e}")
+            raise
+        self.entries[cell] = CachedWeather(description, time.monotonic() + self.ttl)
+        self.entries.move_to_end(cell)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return description
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "coalesced": self.coalesced,
+            "background_refreshes": self.refreshes,
+            "upstream_calls": self.upstream_calls,
+            "failures": self.failures,
+        }
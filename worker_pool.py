@@ -0,0 +1,182 @@
+import gc
+import multiprocessing
+import os
+import queue
+import uuid
+from threading import Lock, Thread
+from typing import Optional
+
+import torch
+
+from transformers import MusicgenForConditionalGeneration, MusicgenProcessor
+
+from batching import seeded_sampling
+from musicgen_streamer import MusicgenStreamer
+
+
+class PoolBusyError(RuntimeError):
+    """Raised when the request queue of the pool stays full for longer than the submit timeout."""
+
+
+class PooledStream:
+    """The audio chunks of one request, as they come back from a worker process."""
+
+    def __init__(self, request_id: str, timeout: Optional[float] = None):
+        self.request_id = request_id
+        self.timeout = timeout
+        self.chunks = queue.Queue()
+        self.codes = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        kind, value = self.chunks.get(timeout=self.timeout)
+        if kind == "audio":
+            return value
+        if kind == "error":
+            raise RuntimeError(f"Generation failed in worker: {value}")
+        raise StopIteration()
+
+    def audio_codes(self):
+        """The `(num_codebooks, frames)` codes of the track, available once the stream has ended."""
+        return self.codes
+
+
+def worker_main(model, processor, cores, requests, results):
+    # pin this worker to its own slice of cores and size the intra-op thread pool to it
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        request_id, text_prompt, max_new_tokens, play_steps, seed = request
+        try:
+            inputs = processor(text=text_prompt, padding=True, return_tensors="pt")
+            streamer = MusicgenStreamer(model, play_steps=play_steps, incremental=True, max_new_tokens=max_new_tokens)
+
+            failures = []
+
+            def generate():
+                try:
+                    model.generate(
+                        **inputs,
+                        streamer=streamer,
+                        max_new_tokens=max_new_tokens,
+                        # sampled like in the batcher, so both generate the same audio for a seed
+                        logits_processor=seeded_sampling(model, [seed]),
+                    )
+                except Exception as e:
+                    failures.append(e)
+                finally:
+                    # the loop below only ends on the streamer's stop signal, failed or not
+                    if not streamer.finished:
+                        streamer.end()
+
+            thread = Thread(target=generate)
+            thread.start()
+            for new_audio in streamer:
+                results.put((request_id, "audio", new_audio))
+            thread.join()
+            if failures:
+                raise failures[0]
+            results.put((request_id, "codes", streamer.audio_codes().to(torch.int16)))
+            results.put((request_id, "end", None))
+        except Exception as e:
+            results.put((request_id, "error", str(e)))
+
+
+class GenerationWorkerPool:
+    def __init__(
+        self,
+        model: MusicgenForConditionalGeneration,
+        processor: MusicgenProcessor,
+        num_workers: int = 2,
+        max_pending: int = 16,
+        submit_timeout: Optional[float] = 1.0,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Pool of generation worker processes forked after `model` is loaded, so that they all share its weights
+        copy-on-write instead of each holding a copy. Every worker is pinned to its own slice of the available cores and
+        generates one request at a time, outside the GIL of the serving process.
+        Parameters:
+            model (`MusicgenForConditionalGeneration`):
+                The loaded model. No inference should have run in this process yet, as forking after OpenMP threads were
+                started can hang the workers.
+            processor (`MusicgenProcessor`):
+                The processor used by the workers to tokenize the prompts.
+            num_workers (`int`, *optional*, defaults to 2):
+                The number of worker processes. The available cores are split evenly between them.
+            max_pending (`int`, *optional*, defaults to 16):
+                The size of the bounded request queue. Once it is full, `submit` waits up to `submit_timeout` for a slot
+                before raising `PoolBusyError`, which pushes back on the callers instead of queueing without limit.
+            submit_timeout (`float`, *optional*, defaults to 1.0):
+                How long `submit` waits for a slot in the request queue. If `None`, waits indefinitely.
+            timeout (`float`, *optional*):
+                The timeout for each chunk of a stream. If `None`, waits indefinitely.
+        """
+        self.submit_timeout = submit_timeout
+        self.timeout = timeout
+
+        context = multiprocessing.get_context("fork")
+        self.requests = context.Queue(maxsize=max_pending)
+        self.results = context.Queue()
+        self.streams = {}
+        self.lock = Lock()
+
+        model.eval()
+        # keep the objects that exist now out of the garbage collector, whose passes would touch (and copy) their pages
+        gc.freeze()
+
+        cores = sorted(os.sched_getaffinity(0))
+        num_workers = min(num_workers, len(cores))
+        self.workers = []
+        for i in range(num_workers):
+            worker_cores = cores[i::num_workers]
+            worker = context.Process(
+                target=worker_main,
+                args=(model, processor, worker_cores, self.requests, self.results),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+        self.dispatcher = Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, text_prompt: str, max_new_tokens: int, play_steps: int, seed: int = 0) -> PooledStream:
+        request_id = uuid.uuid4().hex
+        stream = PooledStream(request_id, timeout=self.timeout)
+        with self.lock:
+            self.streams[request_id] = stream
+        try:
+            self.requests.put((request_id, text_prompt, max_new_tokens, play_steps, seed), timeout=self.submit_timeout)
+        except queue.Full:
+            with self.lock:
+                del self.streams[request_id]
+            raise PoolBusyError(f"All {len(self.workers)} generation workers are busy, try again later")
+        return stream
+
+    def dispatch(self):
+        """Routes the results coming back from the workers to the stream of their request."""
+        while True:
+            request_id, kind, value = self.results.get()
+            with self.lock:
+                stream = self.streams.get(request_id)
+                if kind in ("end", "error"):
+                    self.streams.pop(request_id, None)
+            if stream is None:
+                continue
+            if kind == "codes":
+                stream.codes = value
+            else:
+                stream.chunks.put((kind, value))
+
+    def close(self):
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()